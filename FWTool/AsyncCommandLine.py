@@ -0,0 +1,270 @@
+from __future__ import absolute_import, print_function
+
+import asyncio
+import json
+import time
+from subprocess import CalledProcessError
+
+from CommandLine import (Association, AssociationTable, Client, ClientTable, DeploymentResolver,
+                         Fileset, FilesetTable, FilesetVersionIndex, FWAdminCommands, ImportResult,
+                         admin_verb, flatten_tree)
+
+
+class AsyncFWAdminClient(FWAdminCommands):
+    """asyncio flavour of FWAdminClient.
+
+    Every admin call is a coroutine running the admin tool as an asyncio
+    subprocess.  At most max_concurrency of them run at once, each call can be
+    given a timeout, and a cancelled call kills its admin process.  Failures
+    are retried by the retry_policy and raise CalledProcessError exactly like
+    FWAdminClient.run_admin.  The options and result parsing are shared with
+    FWAdminClient through FWAdminCommands; the command cache, the thread based
+    limiter and coalesced model updates are not available here.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.max_concurrency = kwargs.pop('max_concurrency', 4)
+        self.timeout = kwargs.pop('timeout', None)
+        super(AsyncFWAdminClient, self).__init__(*args, **kwargs)
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # created lazily so it binds to the loop that actually runs the calls
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def run_admin(self, options, include_connection_options=True, error_expected=False, print_output=None, timeout=None):
+        print_output = print_output or self.print_output
+        process_options = self._process_options(options, include_connection_options)
+        timeout = timeout if timeout is not None else self.timeout
+
+        if print_output:
+            print(process_options)
+
+        verb = admin_verb(process_options)
+        started = time.time()
+        retries = 0
+        while True:
+            async with self.semaphore:
+                process = await asyncio.create_subprocess_exec(
+                    *process_options, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+                try:
+                    output, _ = await asyncio.wait_for(process.communicate(), timeout)
+                except BaseException:
+                    # timed out or cancelled, don't leave the admin tool behind
+                    if process.returncode is None:
+                        process.kill()
+                        await process.wait()
+                    self.instrumentation.record(verb, started, -1, 0, retries)
+                    raise
+            delay = None
+            if process.returncode != 0 and self.retry_policy is not None and not error_expected:
+                delay = self.retry_policy.delay(retries, process.returncode, verb)
+            if delay is None:
+                break
+            retries += 1
+            await asyncio.sleep(delay)
+        self.instrumentation.record(verb, started, process.returncode, len(output), retries)
+
+        if process.returncode != 0:
+            if print_output:
+                print("Command failed, error code: ", process.returncode,
+                      self.describe_exit_status(process.returncode)[1])
+                print("Ouput: ", output)
+            if not error_expected:
+                raise CalledProcessError(process.returncode, process_options, output=output)
+            return output, process.returncode
+
+        if error_expected:
+            raise Exception("Expected an error, but command was successful")
+
+        return self.clean_output(output)
+
+    async def get_version(self, timeout=None):
+        return await self.run_admin("-v", timeout=timeout)
+
+    async def get_help(self, timeout=None):
+        return await self.run_admin("-h", timeout=timeout)
+
+    async def get_clients(self, timeout=None):
+        for record in flatten_tree(json.loads(await self.run_admin("--listClients", timeout=timeout))):
+            yield Client(**record)
+
+    async def get_filesets(self, use_cache=True, timeout=None):
+        records = None
+        if self.inventory_cache is not None and use_cache:
+            records = self.inventory_cache.get(self.inventory_key)
+        if records is None:
+            records = list(flatten_tree(json.loads(await self.run_admin("--listFilesets", timeout=timeout))))
+            if self.inventory_cache is not None and use_cache:
+                self.inventory_cache.put(self.inventory_key, records)
+        for record in records:
+            yield Fileset(**record)
+
+    async def get_fileset_table(self, use_cache=True, timeout=None):
+        """Loads the fileset inventory into a FilesetTable without building Fileset objects."""
+        records = None
+        if self.inventory_cache is not None and use_cache:
+            records = self.inventory_cache.get(self.inventory_key)
+        if records is None:
+            records = flatten_tree(json.loads(await self.run_admin("--listFilesets", timeout=timeout)))
+        table = FilesetTable()
+        for record in records:
+            table.append(record)
+        return table
+
+    async def get_client_table(self, timeout=None):
+        """Loads the client inventory into a ClientTable without building Client objects."""
+        table = ClientTable()
+        for record in flatten_tree(json.loads(await self.run_admin("--listClients", timeout=timeout))):
+            table.append(record)
+        return table
+
+    async def get_association_table(self, timeout=None):
+        table = AssociationTable()
+        for record in json.loads(await self.run_admin(['--listAssociations'], timeout=timeout)):
+            table.append(record)
+        return table
+
+    async def get_deployment_resolver(self, timeout=None):
+        """A DeploymentResolver over the current client tree and associations."""
+        return DeploymentResolver(await self.get_client_table(timeout=timeout),
+                                  await self.get_association_table(timeout=timeout))
+
+    async def can_list_filesets(self, timeout=None):
+        """Checks that the fileset listing works, filling the inventory cache on the way.
+
+        Raises CalledProcessError like get_filesets when the admin tool fails.
+        """
+        async for _ in self.get_filesets(timeout=timeout):
+            break
+        return True
+
+    async def get_version_index(self, use_cache=True, timeout=None):
+        return FilesetVersionIndex([fs async for fs in self.get_filesets(use_cache=use_cache, timeout=timeout)])
+
+    async def get_associations(self, timeout=None):
+        for assoc in json.loads(await self.run_admin(['--listAssociations'], timeout=timeout)):
+            yield Association(**assoc)
+
+    async def create_association(self, client_id, fileset_id, kiosk=False, sw_update=False, error_expected=False, timeout=None):
+        args = self.association_options(client_id, fileset_id, kiosk, sw_update)
+        await self.run_admin(args, error_expected=error_expected, timeout=timeout)
+
+    async def remove_association(self, assoc_id, timeout=None):
+        await self.run_admin(['--deleteAssociation', str(assoc_id)], timeout=timeout)
+
+    async def reconcile_associations(self, desired, scope=None, max_workers=4, dry_run=False, timeout=None):
+        """Makes the associations of the filesets in scope exactly the desired ones.
+
+        Same contract as FWAdminClient.reconcile_associations, with at most
+        max_workers changes in flight.
+        """
+        associations = [assoc async for assoc in self.get_associations(timeout=timeout)]
+        result, to_remove, to_add = self._reconcile_plan(desired, scope, associations)
+        if dry_run or not (to_remove or to_add):
+            return result
+
+        slots = asyncio.Semaphore(max(1, max_workers))
+
+        async def run(action, item):
+            async with slots:
+                try:
+                    if action == 'add':
+                        await self.create_association(*item, timeout=timeout)
+                    else:
+                        await self.remove_association(item.id, timeout=timeout)
+                except Exception as e:
+                    result.errors.append((action, item, e))
+
+        # removals first, see FWAdminClient.reconcile_associations
+        await asyncio.gather(*[run('remove', assoc) for assoc in to_remove])
+        await asyncio.gather(*[run('add', key) for key in self._blocked_adds(result, to_add)])
+        return result
+
+    async def prune_filesets(self, keep=3, bundle_ids=None, max_workers=4, dry_run=False, use_cache=False,
+                             timeout=None):
+        """Removes superseded autopkg filesets, keeping the newest keep versions of each bundle.
+
+        Same contract as FWAdminClient.prune_filesets, with at most
+        max_workers removals in flight.
+        """
+        index = await self.get_version_index(use_cache=use_cache, timeout=timeout)
+        associated = set([assoc.fileset_id async for assoc in self.get_associations(timeout=timeout)])
+        result, doomed = self._prune_plan(index, associated, keep, bundle_ids)
+        if dry_run or not doomed:
+            return result
+
+        slots = asyncio.Semaphore(max(1, max_workers))
+
+        async def run(fileset):
+            async with slots:
+                try:
+                    await self.remove_fileset(fileset.id, timeout=timeout)
+                except Exception as e:
+                    result.errors.append((fileset, e))
+
+        await asyncio.gather(*[run(fileset) for fileset in doomed])
+        return result
+
+    async def import_fileset(self, path, name=None, root=None, target=None, timeout=None, **scripts):
+        options = self.import_options('--importFileset', path, name, root, target, **scripts)
+        return self._imported(await self.run_admin(options, timeout=timeout), path, name, target)
+
+    async def import_folder(self, path, name=None, root=None, target=None, timeout=None, **scripts):
+        options = self.import_options('--importFolder', path, name, root, target, **scripts)
+        return self._imported(await self.run_admin(options, timeout=timeout), path, name, target)
+
+    async def import_batch(self, specs, max_workers=4, timeout=None):
+        """Imports many filesets with at most max_workers imports in flight.
+
+        Same contract as FWAdminClient.import_batch: one ImportResult per
+        spec, in order, failures recorded instead of raised.
+        """
+        slots = asyncio.Semaphore(max(1, max_workers))
+
+        async def run(spec):
+            async with slots:
+                try:
+                    method, args = self._batch_call(spec)
+                    return ImportResult(spec, fileset_id=await method(timeout=timeout, **args))
+                except Exception as e:
+                    return ImportResult(spec, error=e)
+
+        return list(await asyncio.gather(*[run(spec) for spec in specs]))
+
+    async def import_package(self, path, name=None, root=None, target=None, timeout=None):
+        options = self.import_options('--importPackage', path, name, root, target)
+        return self._imported(await self.run_admin(options, timeout=timeout), path, name, target)
+
+    async def import_image(self, path, error_expected=False, timeout=None):
+        import_image_result = await self.run_admin(['--importImage', path], error_expected=error_expected, timeout=timeout)
+        return self._imported(import_image_result, path, None, None,
+                              pattern=self.IMAGE_CREATED_PATTERN, fs_type='imaging')
+
+    async def export_fileset(self, destination, fs_name, fileset_id=None, timeout=None):
+        return self._exported(await self.run_admin(self.export_options(destination, fs_name, fileset_id), timeout=timeout))
+
+    async def export_fileset_to(self, destination, fs_name, fileset_id=None, timeout=None):
+        return self._export_location(await self.run_admin(self.export_options(destination, fs_name, fileset_id), timeout=timeout))
+
+    async def set_property(self, fileset_id, prop_name, prop_value, timeout=None):
+        await self.run_admin(self.property_options(fileset_id, prop_name, prop_value), timeout=timeout)
+        self._property_set(fileset_id, prop_name, prop_value)
+
+    async def remove_fileset(self, fileset_id, timeout=None):
+        await self.run_admin(['--deleteFileset', str(fileset_id)], timeout=timeout)
+        return self._fileset_removed(fileset_id)
+
+    async def set_fileset_critical(self, fileset_id, is_critical, timeout=None):
+        await self.run_admin(self.critical_options(fileset_id, is_critical), timeout=timeout)
+        self._critical_set(fileset_id, is_critical)
+
+    async def model_update(self, timeout=None):
+        await self.run_admin(['--updateModel'], timeout=timeout)
+
+    async def create_empty_fileset(self, name, target=None, timeout=None):
+        result = await self.run_admin(self.empty_fileset_options(name, target), timeout=timeout)
+        return self._empty_fileset_created(result, target)
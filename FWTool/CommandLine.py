@@ -1,19 +1,42 @@
 from __future__ import absolute_import, print_function
 
+import atexit
+import bisect
+import codecs
+import collections
+import hashlib
 import json
 import os
 import os.path
 import platform
+import random
 import re
+import socket
 import subprocess
+import threading
+import time
+import weakref
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import CalledProcessError
 
+try:
+    _intern = intern
+except NameError:
+    from sys import intern as _intern
+
+
+def _intern_value(value):
+    return _intern(value) if isinstance(value, str) else value
+
 
 class Client(object):
+    __slots__ = ('id', 'name', 'type', 'parent_id')
+
     def __init__(self, id, name, type, parent_id, **kwargs):
         self.id = str(id)
         self.name = name
-        self.type = type
+        self.type = _intern_value(type)
         self.parent_id = str(parent_id)
 
     def __str__(self):
@@ -21,6 +44,8 @@ class Client(object):
 
 
 class Association(object):
+    __slots__ = ('id', 'client_id', 'fileset_id', 'kiosk', 'sw_update')
+
     def __init__(self, assoc_id, client_id, fileset_id, kiosk=False, sw_update=False):
         self.id = str(assoc_id)
         self.client_id = str(client_id)
@@ -28,36 +53,1699 @@ class Association(object):
         self.kiosk = kiosk
         self.sw_update = sw_update
 
-    def __str__(self):
-        return "%s - Client: %s, Fileset: %s %s" % (
-            self.id,
-            self.client_id,
-            self.fileset_id,
-            "(Kiosk)" if self.kiosk else ""
-        )
+    def __str__(self):
+        return "%s - Client: %s, Fileset: %s %s" % (
+            self.id,
+            self.client_id,
+            self.fileset_id,
+            "(Kiosk)" if self.kiosk else ""
+        )
+
+
+class Fileset(object):
+    __slots__ = ('id', 'name', 'type', 'size', 'custom_properties', 'parent_id', 'is_critical', 'extra')
+
+    def __init__(self, id, name, type, size, parent_id, custom_properties=None, **kwargs):
+        self.id = str(id)
+        self.name = name
+        self.type = _intern_value(type)
+        self.size = size
+        self.custom_properties = custom_properties
+        self.parent_id = str(parent_id)
+        self.is_critical = kwargs.pop('isCritical', None)
+        # any other attributes reported by the admin tool
+        self.extra = kwargs or None
+
+
+    def __str__(self):
+        return "%s - name: %s, type: %s, parent: %s, props: %s" % (
+            self.id,
+            self.name,
+            self.type,
+            self.parent_id,
+            self.custom_properties
+        )
+
+
+class _ColumnarTable(object):
+    """Parallel arrays of id/parent_id/type/name, one row per record.
+
+    Type names are stored once in a shared table and referenced by code, so
+    filtering by type or parent only walks integer arrays.  Records are only
+    materialised when a row is asked for.
+    """
+
+    NO_PARENT = -1
+
+    def __init__(self):
+        self.ids = array('q')
+        self.parent_ids = array('q')
+        self.type_codes = array('H')
+        self.names = []
+        self.types = []
+        self._type_codes = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.record(row)
+
+    @classmethod
+    def _to_int(cls, value):
+        if value is None or value == '' or value == 'None':
+            return cls.NO_PARENT
+        return int(value)
+
+    def _code(self, table, codes, value):
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(table)
+            table.append(_intern_value(value))
+        return code
+
+    def _append(self, id, name, type, parent_id):
+        self.ids.append(int(id))
+        self.parent_ids.append(self._to_int(parent_id))
+        self.type_codes.append(self._code(self.types, self._type_codes, type))
+        self.names.append(name)
+
+    def select(self, type=None, parent_id=None):
+        """Row numbers matching the given type and/or parent id."""
+        rows = range(len(self))
+        if type is not None:
+            code = self._type_codes.get(type)
+            if code is None:
+                return []
+            type_codes = self.type_codes
+            rows = [row for row in rows if type_codes[row] == code]
+        if parent_id is not None:
+            parent = self._to_int(parent_id)
+            parent_ids = self.parent_ids
+            rows = [row for row in rows if parent_ids[row] == parent]
+        return list(rows)
+
+    def type_of(self, row):
+        return self.types[self.type_codes[row]]
+
+    def _parent_of(self, row):
+        parent_id = self.parent_ids[row]
+        return None if parent_id == self.NO_PARENT else parent_id
+
+
+class ClientTable(_ColumnarTable):
+    """Column-oriented --listClients inventory."""
+
+    def append(self, record):
+        self._append(record['id'], record.get('name'), record.get('type'), record.get('parent_id'))
+
+    def record(self, row):
+        return Client(self.ids[row], self.names[row], self.type_of(row), self._parent_of(row))
+
+
+class FilesetTable(_ColumnarTable):
+    """Column-oriented --listFilesets inventory.
+
+    Custom property keys are kept in a shared key table; each row stores its
+    properties as a tuple of (key code, value) pairs, or None when it has none.
+    """
+
+    def __init__(self):
+        super(FilesetTable, self).__init__()
+        self.sizes = array('q')
+        self.critical = bytearray()
+        self.properties = []
+        self.property_keys = []
+        self._property_key_codes = {}
+
+    def append(self, record):
+        self._append(record['id'], record.get('name'), record.get('type'), record.get('parent_id'))
+        self.sizes.append(int(record.get('size') or 0))
+        self.critical.append(1 if record.get('isCritical') else 0)
+        props = record.get('custom_properties')
+        if props is not None:
+            props = tuple((self._code(self.property_keys, self._property_key_codes, key), value)
+                          for key, value in props.items())
+        self.properties.append(props)
+
+    def custom_properties(self, row):
+        props = self.properties[row]
+        if props is None:
+            return None
+        return dict((self.property_keys[code], value) for code, value in props)
+
+    def property_value(self, row, key):
+        code = self._property_key_codes.get(key)
+        for prop_code, value in self.properties[row] or ():
+            if prop_code == code:
+                return value
+        return None
+
+    def select_property(self, key, value=None):
+        """Row numbers that have the custom property (with the given value, if any)."""
+        code = self._property_key_codes.get(key)
+        if code is None:
+            return []
+        rows = []
+        for row, props in enumerate(self.properties):
+            for prop_code, prop_value in props or ():
+                if prop_code == code and (value is None or prop_value == value):
+                    rows.append(row)
+                    break
+        return rows
+
+    def record(self, row):
+        return Fileset(self.ids[row], self.names[row], self.type_of(row), self.sizes[row],
+                       self._parent_of(row), custom_properties=self.custom_properties(row),
+                       isCritical=bool(self.critical[row]))
+
+
+class AssociationTable(object):
+    """Column-oriented --listAssociations inventory."""
+
+    KIOSK = 1
+    SW_UPDATE = 2
+
+    def __init__(self):
+        self.ids = array('q')
+        self.client_ids = array('q')
+        self.fileset_ids = array('q')
+        self.flags = bytearray()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.record(row)
+
+    def append(self, record):
+        self.ids.append(int(record['assoc_id']))
+        self.client_ids.append(int(record['client_id']))
+        self.fileset_ids.append(int(record['fileset_id']))
+        self.flags.append((self.KIOSK if record.get('kiosk') else 0) |
+                          (self.SW_UPDATE if record.get('sw_update') else 0))
+
+    def select(self, client_id=None, fileset_id=None):
+        rows = range(len(self))
+        if client_id is not None:
+            client_id = int(client_id)
+            rows = [row for row in rows if self.client_ids[row] == client_id]
+        if fileset_id is not None:
+            fileset_id = int(fileset_id)
+            rows = [row for row in rows if self.fileset_ids[row] == fileset_id]
+        return list(rows)
+
+    def record(self, row):
+        flags = self.flags[row]
+        return Association(self.ids[row], self.client_ids[row], self.fileset_ids[row],
+                           kiosk=bool(flags & self.KIOSK), sw_update=bool(flags & self.SW_UPDATE))
+
+
+class DeploymentResolver(object):
+    """Which clients receive which filesets, directly or through their client groups.
+
+    Built in one pass over a ClientTable and an AssociationTable: a parent
+    map, a children map, the associations indexed by target and by fileset
+    and, on first use, a pre-order numbering of the client tree in which every
+    group's devices form one contiguous range.  What a device gets is a walk
+    up its (memoized) ancestors; who gets a fileset is a merge of the device
+    ranges of its targets.  Associations can be added and removed in place;
+    adding or removing clients renumbers the tree on the next query.
+    """
+
+    GROUP_TYPES = ('group',)
+
+    def __init__(self, clients=(), associations=()):
+        self.parents = {}
+        self.children = collections.defaultdict(list)
+        self.groups = set()
+        self._associations = {}
+        self._by_target = collections.defaultdict(dict)
+        self._by_fileset = collections.defaultdict(dict)
+        self._ancestors = {}
+        self._ranges = None
+        self._devices = None
+        if isinstance(clients, ClientTable):
+            for row in range(len(clients)):
+                self._add_client(clients.ids[row], clients.parent_ids[row], clients.type_of(row))
+        else:
+            for client in clients:
+                self.add_client(client)
+        if isinstance(associations, AssociationTable):
+            for row in range(len(associations)):
+                self._add_association(associations.ids[row], associations.client_ids[row],
+                                      associations.fileset_ids[row], associations.flags[row])
+        else:
+            for assoc in associations:
+                self.add_association(assoc)
+
+    @staticmethod
+    def _flags(assoc):
+        return ((AssociationTable.KIOSK if assoc.kiosk else 0) |
+                (AssociationTable.SW_UPDATE if assoc.sw_update else 0))
+
+    def _add_client(self, client_id, parent_id, type):
+        self.parents[client_id] = parent_id
+        self.children[parent_id].append(client_id)
+        if type in self.GROUP_TYPES:
+            self.groups.add(client_id)
+
+    def add_client(self, client):
+        self.remove_client(client.id)
+        self._add_client(int(client.id), _ColumnarTable._to_int(client.parent_id), client.type)
+        self._tree_changed()
+
+    def remove_client(self, client_id):
+        """Removes the client (a group's children stay, without a parent)."""
+        client_id = int(client_id)
+        if client_id not in self.parents:
+            return
+        siblings = self.children[self.parents.pop(client_id)]
+        siblings.remove(client_id)
+        self.groups.discard(client_id)
+        self._tree_changed()
+
+    def _tree_changed(self):
+        self._ancestors.clear()
+        self._ranges = None
+        self._devices = None
+
+    def _add_association(self, assoc_id, target_id, fileset_id, flags):
+        self._associations[assoc_id] = (target_id, fileset_id, flags)
+        self._by_target[target_id][assoc_id] = fileset_id
+        self._by_fileset[fileset_id][assoc_id] = target_id
+
+    def add_association(self, assoc):
+        self.remove_association(assoc.id)
+        self._add_association(int(assoc.id), int(assoc.client_id), int(assoc.fileset_id), self._flags(assoc))
+
+    def remove_association(self, assoc_id):
+        entry = self._associations.pop(int(assoc_id), None)
+        if entry is None:
+            return
+        target_id, fileset_id, _ = entry
+        for index, key in ((self._by_target, target_id), (self._by_fileset, fileset_id)):
+            del index[key][int(assoc_id)]
+            if not index[key]:
+                del index[key]
+
+    def is_device(self, client_id):
+        client_id = int(client_id)
+        return client_id in self.parents and client_id not in self.groups and not self.children.get(client_id)
+
+    def _ancestors_of(self, client_id):
+        ancestors = self._ancestors.get(client_id)
+        if ancestors is None:
+            chain = []
+            node = client_id
+            while node in self.parents and node not in self._ancestors and node not in chain:
+                chain.append(node)
+                node = self.parents[node]
+            ancestors = self._ancestors.get(node, ())
+            for node in reversed(chain):
+                ancestors = self._ancestors[node] = (node,) + ancestors
+        return ancestors
+
+    def ancestors(self, client_id):
+        """The client's ID followed by the IDs of the groups above it, nearest first."""
+        return [str(node) for node in self._ancestors_of(int(client_id))]
+
+    def deployments_for(self, client_id):
+        """The Associations that reach the client, its own and those of its groups."""
+        deployments = []
+        for node in self._ancestors_of(int(client_id)):
+            for assoc_id in self._by_target.get(node, ()):
+                target_id, fileset_id, flags = self._associations[assoc_id]
+                deployments.append(Association(assoc_id, target_id, fileset_id,
+                                               kiosk=bool(flags & AssociationTable.KIOSK),
+                                               sw_update=bool(flags & AssociationTable.SW_UPDATE)))
+        return deployments
+
+    def filesets_for(self, client_id):
+        """IDs of the filesets the client receives."""
+        filesets = set()
+        for node in self._ancestors_of(int(client_id)):
+            filesets.update(str(fileset_id) for fileset_id in self._by_target.get(node, {}).values())
+        return filesets
+
+    def receives(self, client_id, fileset_id):
+        targets = self._by_fileset.get(int(fileset_id))
+        if not targets:
+            return False
+        target_ids = set(targets.values())
+        return any(node in target_ids for node in self._ancestors_of(int(client_id)))
+
+    def _number(self):
+        """Numbers the devices in pre-order; each node maps to its [start, end) device range."""
+        if self._ranges is None:
+            ranges = {}
+            devices = []
+            roots = [node for node in self.parents if self.parents[node] not in self.parents]
+            stack = [(node, False) for node in reversed(sorted(roots))]
+            while stack:
+                node, done = stack.pop()
+                if done:
+                    ranges[node] = (ranges[node], len(devices))
+                    continue
+                if node in ranges:
+                    continue
+                ranges[node] = len(devices)
+                if self.is_device(node):
+                    devices.append(node)
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(self.children.get(node, ())))
+            self._ranges = ranges
+            self._devices = devices
+        return self._ranges, self._devices
+
+    def _device_ranges(self, fileset_id):
+        ranges, _ = self._number()
+        spans = sorted(ranges[target] for target in set(self._by_fileset.get(int(fileset_id), {}).values())
+                       if target in ranges)
+        merged = []
+        for start, end in spans:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            elif start < end:
+                merged.append([start, end])
+        return merged
+
+    def clients_for(self, fileset_id):
+        """IDs of the devices that receive the fileset, in tree order."""
+        _, devices = self._number()
+        return [str(devices[i]) for start, end in self._device_ranges(fileset_id) for i in range(start, end)]
+
+    def count_clients_for(self, fileset_id):
+        return sum(end - start for start, end in self._device_ranges(fileset_id))
+
+
+_VERSION_COMPONENT_RE = re.compile(r'(\d+|[a-z]+|\.)')
+
+
+def version_key(version):
+    """Splits a version the way LooseVersion does into a key that always compares.
+
+    Numeric parts sort before alphabetic ones so mixed versions never raise
+    a TypeError under Python 3.
+    """
+    key = []
+    for part in _VERSION_COMPONENT_RE.split(str(version)):
+        if not part or part == '.':
+            continue
+        try:
+            key.append((0, int(part)))
+        except ValueError:
+            key.append((1, part))
+    return tuple(key)
+
+
+class FilesetVersionIndex(object):
+    """Filesets grouped by their autopkg_app_bundle_id, sorted by autopkg_app_version."""
+
+    BUNDLE_ID_PROPERTY = "autopkg_app_bundle_id"
+    VERSION_PROPERTY = "autopkg_app_version"
+    DIGEST_PROPERTY = "autopkg_content_digest"
+
+    def __init__(self, filesets=()):
+        self._entries = {}
+        self._filesets = {}
+        self._digests = {}
+        self._digest_of = {}
+        for fileset in filesets:
+            self.add(fileset)
+
+    def __len__(self):
+        return len(self._filesets)
+
+    def __contains__(self, bundle_id):
+        return bundle_id in self._entries
+
+    def add(self, fileset):
+        """Indexes the fileset if it carries both autopkg properties (and/or a content digest)."""
+        self.remove(fileset.id)
+        props = fileset.custom_properties or {}
+        digest = props.get(self.DIGEST_PROPERTY)
+        if digest is not None:
+            self._digests[digest] = fileset
+            self._digest_of[fileset.id] = digest
+        bundle_id = props.get(self.BUNDLE_ID_PROPERTY)
+        version = props.get(self.VERSION_PROPERTY)
+        if bundle_id is None or version is None:
+            return False
+        bisect.insort(self._entries.setdefault(bundle_id, []), (version_key(version), fileset.id))
+        self._filesets[fileset.id] = (bundle_id, fileset)
+        return True
+
+    def remove(self, fileset_id):
+        fileset_id = str(fileset_id)
+        digest = self._digest_of.pop(fileset_id, None)
+        # another fileset with the same content may have taken the digest over
+        holder = self._digests.get(digest) if digest is not None else None
+        if holder is not None and holder.id == fileset_id:
+            del self._digests[digest]
+        bundle_id, _ = self._filesets.pop(fileset_id, (None, None))
+        if bundle_id is None:
+            return
+        entries = self._entries[bundle_id]
+        entries[:] = [e for e in entries if e[1] != fileset_id]
+        if not entries:
+            del self._entries[bundle_id]
+
+    def with_digest(self, digest):
+        """A fileset whose imported content has the given digest, or None."""
+        return self._digests.get(digest)
+
+    def bundle_ids(self):
+        return sorted(self._entries)
+
+    def filesets(self, bundle_id):
+        """All filesets for the bundle, oldest version first."""
+        return [self._filesets[fs_id][1] for _, fs_id in self._entries.get(bundle_id, [])]
+
+    def newest(self, bundle_id):
+        """The fileset holding the highest version of the bundle, or None."""
+        entries = self._entries.get(bundle_id)
+        if not entries:
+            return None
+        return self._filesets[entries[-1][1]][1]
+
+    def is_satisfied(self, bundle_id, version):
+        """Returns the oldest fileset whose version is >= version, or None."""
+        entries = self._entries.get(bundle_id)
+        if not entries:
+            return None
+        pos = bisect.bisect_left(entries, (version_key(version),))
+        if pos == len(entries):
+            return None
+        return self._filesets[entries[pos][1]][1]
+
+
+class FilesetGroupResolver(object):
+    """Maps fileset group paths such as "Apps/Browsers/Chrome" to the existing groups.
+
+    The index is built from one fileset listing and kept for the lifetime of
+    the resolver, so every later lookup of a path is a dict access.  Groups
+    are never created here.  When two sibling groups share a name the one
+    with the lowest ID wins.
+    """
+
+    GROUP_TYPE = 'group'
+
+    def __init__(self, client):
+        self.client = client
+        self._paths = None
+        self._name_counts = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def split(path):
+        return [part.strip() for part in str(path).split('/') if part.strip()]
+
+    def _index(self):
+        if self._paths is None:
+            groups = dict((fs.id, fs) for fs in self.client.get_filesets() if fs.type == self.GROUP_TYPE)
+            paths = {}
+
+            def path_of(group_id):
+                # iterative so deep hierarchies can't hit the recursion limit
+                chain = []
+                while group_id in groups and group_id not in paths and group_id not in chain:
+                    chain.append(group_id)
+                    group_id = str(groups[group_id].parent_id)
+                prefix = paths.get(group_id, ())
+                for chain_id in reversed(chain):
+                    prefix = paths[chain_id] = prefix + (groups[chain_id].name,)
+                return prefix
+
+            self._paths = {}
+            for group_id in sorted(groups, key=lambda g: (len(g), g)):
+                self._paths.setdefault(path_of(group_id), group_id)
+            self._name_counts = collections.Counter(group.name for group in groups.values())
+        return self._paths
+
+    def lookup(self, path):
+        """The ID of the group at path, or None."""
+        with self._lock:
+            return self._index().get(tuple(self.split(path)))
+
+    def name_count(self, name):
+        """How many groups, anywhere in the tree, are called name."""
+        with self._lock:
+            self._index()
+            return self._name_counts[name]
+
+    def invalidate(self):
+        with self._lock:
+            self._paths = None
+            self._name_counts = None
+
+
+_group_resolvers = {}
+_group_resolvers_lock = threading.Lock()
+
+
+def get_group_resolver(client):
+    """The resolver shared by every client of the same server in this process."""
+    with _group_resolvers_lock:
+        resolver = _group_resolvers.get(client.inventory_key)
+        if resolver is None:
+            resolver = _group_resolvers[client.inventory_key] = FilesetGroupResolver(client)
+        return resolver
+
+
+def flatten_tree(nodes):
+    """Yields every node of a --listFilesets/--listClients tree depth first.
+
+    The 'children' key is removed from each node.  An explicit stack is used so
+    deep group hierarchies cannot hit the recursion limit.
+    """
+    stack = list(reversed(nodes))
+    while stack:
+        node = stack.pop()
+        children = node.pop('children', None) or []
+        yield node
+        stack.extend(reversed(children))
+
+
+class JsonTreeStream(object):
+    """Incremental parser for the JSON trees printed by --listFilesets/--listClients.
+
+    Text is fed in chunks as it arrives; every fileset or client object is handed
+    out as soon as it is complete, with its 'children' stripped, and is not kept
+    afterwards.  Memory is bounded by the depth of the tree and the chunk size,
+    not by the size of the tree.  Groups bigger than a chunk are handed out
+    after their children, so nodes do not necessarily come out in tree order.
+    """
+
+    _NUMBER_RE = re.compile(r'-?\d+(\.\d+)?([eE][-+]?\d+)?')
+    _NUMBER_CHARS_RE = re.compile(r'[-+0-9.eE]+')
+    _LITERALS = (('true', True), ('false', False), ('null', None))
+    _WHITESPACE = ' \t\r\n'
+
+    # container kinds kept on the stack
+    NODES, NODE, OBJECT, ARRAY = range(4)
+
+    def __init__(self):
+        self._buf = ''
+        self._stack = []
+        self._done = False
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, text, final=False):
+        """Consumes more text and returns the list of nodes completed by it."""
+        self._buf += text
+        nodes = []
+        buf = self._buf
+        pos = 0
+        end = len(buf)
+        while pos < end:
+            c = buf[pos]
+            if c in self._WHITESPACE:
+                pos += 1
+                continue
+            if self._done:
+                raise ValueError("Extra data after the JSON document at %d" % pos)
+            if c == '{' and self._stack and self._stack[-1][0] == self.NODES:
+                # a node whose whole subtree is already buffered is decoded in one go,
+                # anything bigger than the buffer falls back to token by token parsing
+                try:
+                    node, new_pos = self._decoder.raw_decode(buf, pos)
+                except (ValueError, RuntimeError):
+                    # incomplete, or nested deeper than the C decoder's recursion limit
+                    node = None
+                if isinstance(node, dict):
+                    nodes.extend(flatten_tree([node]))
+                    pos = new_pos
+                    continue
+            if c in '{[':
+                self._open(c)
+                pos += 1
+            elif c in '}]':
+                node = self._close(c)
+                if node is not None:
+                    nodes.append(node)
+                pos += 1
+            elif c in ':,':
+                if c == ',' and self._stack and self._stack[-1][0] in (self.NODE, self.OBJECT):
+                    self._stack[-1][2] = None
+                pos += 1
+            elif c == '"':
+                try:
+                    value, new_pos = json.decoder.scanstring(buf, pos + 1)
+                except ValueError:
+                    if final:
+                        raise
+                    break
+                pos = new_pos
+                top = self._stack[-1] if self._stack else None
+                if top is not None and top[0] in (self.NODE, self.OBJECT) and top[2] is None:
+                    top[2] = value
+                else:
+                    self._value(value)
+            else:
+                span = self._NUMBER_CHARS_RE.match(buf, pos)
+                if span is not None:
+                    if span.end() == end and not final:
+                        break
+                    match = self._NUMBER_RE.match(span.group(0))
+                    if match is None or match.end() != span.end() - pos:
+                        raise ValueError("Invalid number %r at %d" % (span.group(0), pos))
+                    number = match.group(0)
+                    self._value(float(number) if match.group(1) or match.group(2) else int(number))
+                    pos = span.end()
+                    continue
+                for literal, value in self._LITERALS:
+                    if buf.startswith(literal, pos):
+                        self._value(value)
+                        pos += len(literal)
+                        break
+                else:
+                    if not final and end - pos < 5:
+                        break
+                    raise ValueError("Unexpected character %r at %d" % (c, pos))
+        self._buf = buf[pos:]
+        if final and (self._stack or self._buf.strip()):
+            raise ValueError("Truncated JSON document")
+        return nodes
+
+    def _open(self, c):
+        top = self._stack[-1] if self._stack else None
+        if c == '[':
+            if top is None or (top[0] == self.NODE and top[2] == 'children'):
+                self._stack.append([self.NODES, None, None])
+            else:
+                self._stack.append([self.ARRAY, [], None])
+        else:
+            kind = self.NODE if top is not None and top[0] == self.NODES else self.OBJECT
+            self._stack.append([kind, {}, None])
+
+    def _close(self, c):
+        kind, value, _ = self._stack.pop()
+        if kind == self.NODE:
+            return value
+        if kind == self.NODES:
+            if self._stack:
+                # the children were handed out already, drop the key
+                self._stack[-1][2] = None
+            else:
+                self._done = True
+            return None
+        self._value(value)
+        return None
+
+    def _value(self, value):
+        if not self._stack:
+            raise ValueError("Expected a list of nodes")
+        top = self._stack[-1]
+        if top[0] == self.ARRAY:
+            top[1].append(value)
+        elif top[0] in (self.NODE, self.OBJECT):
+            top[1][top[2]] = value
+            top[2] = None
+        else:
+            raise ValueError("Expected an object in the node list")
+
+
+def admin_verb(process_options):
+    """Returns the admin verb (e.g. '--listFilesets') of a full command line."""
+    options = iter(process_options[1:])
+    for option in options:
+        # connection options and a leading '--fileset <id>' qualify the verb that follows
+        if option in ('-u', '-p', '-H', '-P', '--fileset'):
+            next(options, None)
+        elif option.startswith('-'):
+            return option
+    return None
+
+
+class AdminCallRecord(object):
+    """Timing and outcome of one admin tool invocation."""
+    __slots__ = ('verb', 'started', 'seconds', 'exit_code', 'output_bytes', 'retries')
+
+    def __init__(self, verb, started, seconds, exit_code, output_bytes, retries=0):
+        self.verb = verb
+        self.started = started
+        self.seconds = seconds
+        self.exit_code = exit_code
+        self.output_bytes = output_bytes
+        self.retries = retries
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class AdminInstrumentation(object):
+    """Collects an AdminCallRecord for every admin call and passes it on to hooks.
+
+    Hooks are callables taking the record; JsonLinesSink and
+    PrometheusTextfileSink are provided.  A failing hook never fails the call.
+    """
+
+    def __init__(self, hooks=None):
+        self.hooks = list(hooks or [])
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def record(self, verb, started, exit_code, output_bytes, retries=0):
+        call = AdminCallRecord(verb, started, time.time() - started, exit_code, output_bytes, retries)
+        with self._lock:
+            self.records.append(call)
+        for hook in self.hooks:
+            try:
+                hook(call)
+            except Exception as e:
+                print("Admin instrumentation hook failed: %s" % e)
+        return call
+
+    def summary(self):
+        """Per verb totals: calls, seconds, errors, output_bytes and retries."""
+        totals = {}
+        with self._lock:
+            records = list(self.records)
+        for call in records:
+            verb = totals.setdefault(call.verb, {
+                'calls': 0, 'seconds': 0.0, 'errors': 0, 'output_bytes': 0, 'retries': 0})
+            verb['calls'] += 1
+            verb['seconds'] += call.seconds
+            verb['errors'] += 1 if call.exit_code else 0
+            verb['output_bytes'] += call.output_bytes
+            verb['retries'] += call.retries
+        return totals
+
+    def breakdown(self):
+        """One line summary such as '--importFolder 1x 3.20s, --setProperty 2x 0.41s'."""
+        summary = self.summary()
+        verbs = sorted(summary, key=lambda verb: -summary[verb]['seconds'])
+        return ", ".join("%s %dx %.2fs%s" % (verb, summary[verb]['calls'], summary[verb]['seconds'],
+                                            " (%d retries)" % summary[verb]['retries'] if summary[verb]['retries'] else "")
+                         for verb in verbs)
+
+
+class JsonLinesSink(object):
+    """Instrumentation hook appending every call as a JSON line to path."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, call):
+        line = json.dumps(call.as_dict(), sort_keys=True)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + "\n")
+
+
+class PrometheusTextfileSink(object):
+    """Instrumentation hook keeping a node_exporter textfile with per verb totals up to date."""
+
+    def __init__(self, path, prefix="filewave_admin"):
+        self.path = path
+        self.prefix = prefix
+        self.instrumentation = AdminInstrumentation()
+
+    def __call__(self, call):
+        with self.instrumentation._lock:
+            self.instrumentation.records.append(call)
+        summary = self.instrumentation.summary()
+        metrics = (
+            ('calls_total', 'counter', 'calls'),
+            ('seconds_total', 'counter', 'seconds'),
+            ('errors_total', 'counter', 'errors'),
+            ('output_bytes_total', 'counter', 'output_bytes'),
+            ('retries_total', 'counter', 'retries'),
+        )
+        lines = []
+        for name, metric_type, field in metrics:
+            lines.append("# TYPE %s_%s %s" % (self.prefix, name, metric_type))
+            for verb in sorted(summary):
+                lines.append('%s_%s{verb="%s"} %s' % (self.prefix, name, verb, summary[verb][field]))
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        getattr(os, 'replace', os.rename)(tmp_path, self.path)
+
+
+# kinds of AdminEvent an FWAdminClient publishes
+FILESET_CREATED = 'fileset_created'
+FILESET_REMOVED = 'fileset_removed'
+FILESET_EXPORTED = 'fileset_exported'
+
+
+class AdminEvent(object):
+    """A change an FWAdminClient made on the server, as handed to event subscribers."""
+
+    __slots__ = ('kind', 'time', 'server', 'fileset_id', 'data')
+
+    def __init__(self, kind, server=None, fileset_id=None, data=None, time=None):
+        self.kind = kind
+        self.time = time
+        self.server = server
+        self.fileset_id = fileset_id
+        self.data = data or {}
+
+    def as_dict(self):
+        event = dict(self.data)
+        event.update(kind=self.kind, time=self.time, server=self.server, fileset_id=self.fileset_id)
+        return event
+
+    def __repr__(self):
+        return "AdminEvent(%s %s)" % (self.kind, self.fileset_id)
+
+
+class AdminEventBus(object):
+    """Hands AdminEvents to any number of subscribers without holding up the admin calls.
+
+    publish() only appends the event to a queue of at most max_queue events; a
+    background thread passes them on to every subscriber in batches of up to
+    batch_size, at the latest flush_interval seconds after they were
+    published.  Subscribers are callables taking a list of events.  When they
+    fall so far behind that the queue is full, the oldest events are dropped
+    instead of blocking the publisher; stats() reports the queue depth, drops
+    and delivery lag.  A failing subscriber never affects the others.
+    """
+
+    def __init__(self, max_queue=1000, batch_size=100, flush_interval=0.2):
+        self.max_queue = max(1, int(max_queue))
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = flush_interval
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.batches = 0
+        self.errors = 0
+        self.max_queued = 0
+        self.max_lag = 0.0
+        self.delivery_seconds = 0.0
+        self._subscribers = ()
+        self._queue = collections.deque()
+        self._in_flight = 0
+        self._flushing = 0
+        self._closed = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def subscribe(self, subscriber, batched=True):
+        """Adds a subscriber and returns what to pass to unsubscribe().
+
+        An unbatched subscriber is called once per event instead of once per batch.
+        """
+        if not batched:
+            callback = subscriber
+
+            def subscriber(events):
+                for event in events:
+                    callback(event)
+        with self._cond:
+            self._subscribers = self._subscribers + (subscriber,)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._cond:
+            self._subscribers = tuple(s for s in self._subscribers if s is not subscriber)
+
+    def publish(self, kind, server=None, fileset_id=None, **data):
+        """Queues the event for the subscribers and returns it, None when nobody subscribed."""
+        if not self._subscribers:
+            return None
+        event = AdminEvent(kind, server, fileset_id, data, time.time())
+        with self._cond:
+            if self._closed:
+                self.dropped += 1
+                return event
+            if len(self._queue) >= self.max_queue:
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append(event)
+            self.published += 1
+            self.max_queued = max(self.max_queued, len(self._queue))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._deliver, name="AdminEventBus")
+                self._thread.daemon = True
+                self._thread.start()
+                _track_event_bus(self)
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+        return event
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            # give the batch a chance to fill up
+            deadline = time.time() + self.flush_interval
+            while (len(self._queue) < self.batch_size and not self._closed and not self._flushing
+                   and time.time() < deadline):
+                self._cond.wait(deadline - time.time())
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            self._in_flight = len(batch)
+            return batch
+
+    def _deliver(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            started = time.time()
+            errors = 0
+            for subscriber in self._subscribers:
+                try:
+                    subscriber(batch)
+                except Exception:
+                    errors += 1
+            with self._cond:
+                self.delivered += len(batch)
+                self.batches += 1
+                self.errors += errors
+                self.delivery_seconds += time.time() - started
+                self.max_lag = max(self.max_lag, started - batch[0].time)
+                self._in_flight = 0
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Waits until every queued event was delivered; returns False if that took longer than timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._flushing += 1
+            try:
+                self._cond.notify_all()
+                while self._queue or self._in_flight:
+                    if self._thread is None or not self._thread.is_alive():
+                        return False
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                return True
+            finally:
+                self._flushing -= 1
+
+    def close(self, timeout=5.0):
+        """Delivers what is queued (waiting at most timeout seconds) and stops the delivery thread."""
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'subscribers': len(self._subscribers),
+                'published': self.published,
+                'delivered': self.delivered,
+                'dropped': self.dropped,
+                'queued': len(self._queue) + self._in_flight,
+                'max_queued': self.max_queued,
+                'batches': self.batches,
+                'errors': self.errors,
+                'max_lag': self.max_lag,
+                'delivery_seconds': self.delivery_seconds,
+            }
+
+
+_event_buses = weakref.WeakSet()
+_event_buses_lock = threading.Lock()
+
+
+def _track_event_bus(bus):
+    with _event_buses_lock:
+        if not _event_buses:
+            atexit.register(_close_event_buses)
+        _event_buses.add(bus)
+
+
+def _close_event_buses():
+    """Delivers the events still queued when the process exits and reports what got lost."""
+    with _event_buses_lock:
+        buses = list(_event_buses)
+    for bus in buses:
+        bus.close()
+        stats = bus.stats()
+        if stats['dropped'] or stats['errors'] or stats['queued']:
+            print("Admin events: %(published)d published, %(dropped)d dropped, %(queued)d undelivered, "
+                  "%(errors)d subscriber errors" % stats)
+
+
+class JsonLinesEventSink(object):
+    """Event subscriber appending every event as a JSON line to path."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, events):
+        lines = "".join(json.dumps(event.as_dict(), sort_keys=True) + "\n" for event in events)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(lines)
+
+
+class SocketEventSink(object):
+    """Event subscriber sending every event as a JSON line to a local socket.
+
+    address is the path of a Unix domain socket or a (host, port) pair.  The
+    connection is made on first use and made again after an error; the
+    batch that failed is lost.
+    """
+
+    def __init__(self, address, timeout=2.0):
+        self.address = address
+        self.timeout = timeout
+        self._socket = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        family = socket.AF_INET if isinstance(self.address, tuple) else socket.AF_UNIX
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def __call__(self, events):
+        payload = "".join(json.dumps(event.as_dict(), sort_keys=True) + "\n" for event in events)
+        with self._lock:
+            if self._socket is None:
+                self._socket = self._connect()
+            try:
+                self._socket.sendall(payload.encode('utf-8'))
+            except Exception:
+                self.close()
+                raise
+
+    def close(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            finally:
+                self._socket = None
+
+
+class AdminCommandCache(object):
+    """Admin command output cached by the full command line, shared by every client of one connection.
+
+    This is not a pool of admin processes: the FileWave Admin command line has
+    no persistent login mode, so every command that runs still starts its own
+    process.  The cache only answers the static queries (version, help) from
+    memory once they ran, lets concurrent identical listings wait for the one
+    already running, and bounds how many admin processes run at once.  The key
+    is the whole command line, connection options and credentials included.
+    """
+
+    # options whose output never changes for a given binary
+    STATIC_OPTIONS = ('-v', '-h')
+    # read-only options that concurrent callers can share
+    SHARED_OPTIONS = ('--listFilesets', '--listClients', '--listAssociations')
+
+    def __init__(self, max_workers=2):
+        self.max_workers = max(1, int(max_workers))
+        self.launches = 0
+        self.memo_hits = 0
+        self.shared_hits = 0
+        self._slots = threading.BoundedSemaphore(self.max_workers)
+        self._lock = threading.Lock()
+        self._memo = {}
+        self._in_flight = {}
+
+    def check_output(self, process_options):
+        """Runs the command in a worker slot, same contract as subprocess.check_output."""
+        key = tuple(process_options)
+        option = admin_verb(process_options)
+
+        if option in self.STATIC_OPTIONS:
+            with self._lock:
+                if key in self._memo:
+                    self.memo_hits += 1
+                    return self._memo[key]
+            output = self._launch(process_options)
+            with self._lock:
+                self._memo[key] = output
+            return output
+
+        if option in self.SHARED_OPTIONS and key[-1] == option:
+            with self._lock:
+                pending = self._in_flight.get(key)
+                owner = pending is None
+                if owner:
+                    pending = self._in_flight[key] = _PendingResult()
+                else:
+                    self.shared_hits += 1
+            if not owner:
+                return pending.wait()
+            try:
+                output = self._launch(process_options)
+                pending.set(output)
+                return output
+            except Exception as e:
+                pending.set_error(e)
+                raise
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+
+        return self._launch(process_options)
+
+    def _launch(self, process_options):
+        return self.launch(lambda: subprocess.check_output(process_options, stderr=subprocess.STDOUT))
+
+    def launch(self, run):
+        """Calls run() in a worker slot, for callers that manage the admin process themselves."""
+        with self._slots:
+            with self._lock:
+                self.launches += 1
+            return run()
+
+
+class _PendingResult(object):
+    def __init__(self):
+        self._event = threading.Event()
+        self._output = None
+        self._error = None
+
+    def set(self, output):
+        self._output = output
+        self._event.set()
+
+    def set_error(self, error):
+        self._error = error
+        self._event.set()
+
+    def wait(self):
+        self._event.wait()
+        if self._error is not None:
+            raise self._error
+        return self._output
+
+
+_command_caches = {}
+_command_caches_lock = threading.Lock()
+
+
+def get_command_cache(key, max_workers=2):
+    """Returns the process-wide command cache for the given connection key, creating it on first use."""
+    with _command_caches_lock:
+        cache = _command_caches.get(key)
+        if cache is None:
+            cache = _command_caches[key] = AdminCommandCache(max_workers=max_workers)
+        return cache
+
+
+class RetryPolicy(object):
+    """Which failed admin calls are tried again, and after how long.
+
+    Only transient server conditions (FWAdminClient.TRANSIENT_EXIT_STATUSES) are
+    retried, at most max_attempts attempts in all, waiting a random time of up
+    to base_delay * 2 ** retry seconds (capped at max_delay) in between.  After
+    a database or model update error a change may already have been made, so
+    calls that change the server are only repeated after a login error, which
+    happens before the command does anything.
+    """
+
+    # verbs that can be repeated without changing the outcome
+    IDEMPOTENT_VERBS = ('-v', '-h', '--listFilesets', '--listClients', '--listAssociations',
+                        '--setProperty', '--setCriticalFlag', '--updateModel')
+
+    def __init__(self, max_attempts=4, base_delay=0.5, max_delay=15.0):
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, retry, returncode, verb):
+        """Seconds to wait before retry number retry + 1 of a call that failed, or None to give up."""
+        if retry + 1 >= self.max_attempts or not FWAdminClient.is_transient(returncode):
+            return None
+        if verb not in self.IDEMPOTENT_VERBS and \
+                FWAdminClient.describe_exit_status(returncode)[0] != 'kExitLoginError':
+            return None
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+
+class AdaptiveLimiter(object):
+    """Additive increase / multiplicative decrease limit on concurrent admin calls.
+
+    Each call that finishes without overloading the server (a transient error,
+    or taking longer than latency_target seconds when one is set) adds
+    1 / limit to the limit, i.e. about one slot per round of calls, up to
+    max_limit.  An overloaded call multiplies it by backoff, down to min_limit,
+    once per round: calls started before the last decrease don't lower it again.
+    """
+
+    def __init__(self, min_limit=1, max_limit=8, initial_limit=None, latency_target=None, backoff=0.5):
+        self.min_limit = max(1, int(min_limit))
+        self.max_limit = max(self.min_limit, int(max_limit))
+        self.limit = float(max(self.min_limit, min(self.max_limit, initial_limit or (self.max_limit + 1) // 2)))
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.in_flight = 0
+        self.calls = 0
+        self.overloads = 0
+        self.decreases = 0
+        self._generation = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Waits for a free slot; returns the token to hand to release()."""
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+            return self._generation
+
+    def release(self, token, seconds, overloaded=False):
+        with self._cond:
+            self.in_flight -= 1
+            self.calls += 1
+            if self.latency_target is not None and seconds > self.latency_target:
+                overloaded = True
+            if overloaded:
+                self.overloads += 1
+                if token == self._generation:
+                    self._generation += 1
+                    self.decreases += 1
+                    self.limit = max(float(self.min_limit), self.limit * self.backoff)
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {'limit': int(self.limit), 'calls': self.calls, 'overloads': self.overloads,
+                    'decreases': self.decreases}
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_adaptive_limiter(key, max_limit=8, latency_target=None):
+    """Returns the process-wide limiter for the given connection key, creating it on first use."""
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = AdaptiveLimiter(max_limit=max_limit, latency_target=latency_target)
+        return limiter
+
+
+class ModelUpdateCoalescer(object):
+    """Turns many requests for a model update into few --updateModel calls.
+
+    Changes only mark the model dirty.  The update is run by flush(), which
+    batch operations call when they are done, and, when debounce is set, by a
+    timer at most debounce seconds after the first change of a window.
+    Requests that didn't need their own update are counted as avoided.
+    """
+
+    def __init__(self, client, debounce=None):
+        self.client = client
+        self.debounce = debounce
+        self.requests = 0
+        self.updates = 0
+        self._dirty = False
+        self._timer = None
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+
+    @property
+    def avoided(self):
+        return max(0, self.requests - self.updates)
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+    def mark_dirty(self):
+        with self._lock:
+            self.requests += 1
+            self._dirty = True
+            if self.debounce is not None and self._timer is None:
+                self._timer = threading.Timer(self.debounce, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Runs one model update if anything changed since the last one; returns whether it did."""
+        with self._update_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return False
+                # changes arriving during the update need another one
+                self._dirty = False
+            try:
+                self.client.model_update()
+            except Exception:
+                with self._lock:
+                    self._dirty = True
+                raise
+            with self._lock:
+                self.updates += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'updates': self.updates, 'avoided': self.avoided,
+                    'pending': self._dirty}
+
+
+_coalescers = {}
+_coalescers_lock = threading.Lock()
+
+
+def get_model_update_coalescer(client, debounce=None):
+    """The coalescer shared by every client of the same server; pending updates are run at exit."""
+    with _coalescers_lock:
+        coalescer = _coalescers.get(client.inventory_key)
+        if coalescer is None:
+            if not _coalescers:
+                atexit.register(_flush_model_updates)
+            coalescer = _coalescers[client.inventory_key] = ModelUpdateCoalescer(client, debounce=debounce)
+        return coalescer
+
+
+def _flush_model_updates():
+    with _coalescers_lock:
+        coalescers = list(_coalescers.values())
+    for coalescer in coalescers:
+        try:
+            coalescer.flush()
+        except CalledProcessError as e:
+            print("Model update failed, error code:", e.returncode,
+                  FWAdminClient.describe_exit_status(e.returncode)[1])
+        if coalescer.updates:
+            print("Model updated %d time(s) for %d changes, %d updates avoided" %
+                  (coalescer.updates, coalescer.requests, coalescer.avoided))
+
+
+def default_cache_dir():
+    """Location for the on-disk caches, FILEWAVE_CACHE_DIR overrides it."""
+    cache_dir = os.environ.get("FILEWAVE_CACHE_DIR")
+    if cache_dir:
+        return cache_dir
+    if 'Darwin' == platform.system():
+        return os.path.expanduser("~/Library/Caches/com.github.autopkg.filewave")
+    return os.path.expanduser("~/.cache/com.github.autopkg.filewave")
+
+
+class FilesetInventoryCache(object):
+    """Flattened --listFilesets output shared in-process and persisted on disk.
+
+    Entries are keyed by server host, port and admin user and expire after ttl
+    seconds.  Changes made through FWAdminClient are patched into the cached
+    inventory so a run never has to re-list the server after its own imports.
+    Patches only change the in-process copy; flush() writes the patched
+    inventories to disk, which clients do after each batch operation and
+    which happens anyway when the process exits.
+    """
+
+    _memory = {}
+    # key -> cache path of the inventories patched since they were written
+    _dirty = {}
+    _lock = threading.RLock()
+
+    def __init__(self, ttl=300, cache_dir=None):
+        self.ttl = ttl
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key_for(host, port, user):
+        return hashlib.sha1(("%s:%s:%s" % (host, port, user)).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, "filesets-%s.json" % key)
+
+    def _is_fresh(self, entry):
+        return entry is not None and time.time() - entry['created'] < self.ttl
+
+    def _load(self, key):
+        entry = self._memory.get(key)
+        if self._is_fresh(entry):
+            return entry
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if not self._is_fresh(entry):
+            return None
+        self._memory[key] = entry
+        return entry
+
+    def _save(self, key, entry):
+        self._memory[key] = entry
+        self._dirty.pop(key, None)
+        self._write(self._path(key), json.dumps(entry))
+
+    @staticmethod
+    def _write(path, data):
+        try:
+            cache_dir = os.path.dirname(path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            getattr(os, 'replace', os.rename)(tmp_path, path)
+        except (IOError, OSError):
+            # the in-process copy is still valid, the disk copy is a bonus
+            pass
+
+    @classmethod
+    def flush(cls):
+        """Writes every inventory patched since it was last written to disk."""
+        with cls._lock:
+            dirty, cls._dirty = cls._dirty, {}
+            # serialised under the lock, written without holding it
+            pending = [(path, json.dumps(cls._memory[key])) for key, path in dirty.items()
+                       if key in cls._memory]
+        for path, data in pending:
+            cls._write(path, data)
+
+    def get(self, key):
+        """Returns the cached fileset records or None when missing/expired."""
+        if self.ttl <= 0:
+            return None
+        with self._lock:
+            entry = self._load(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return list(entry['filesets'].values())
+
+    def put(self, key, records):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._save(key, {
+                'created': time.time(),
+                'filesets': dict((str(r['id']), r) for r in records)
+            })
+
+    def invalidate(self, key):
+        with self._lock:
+            self._memory.pop(key, None)
+            self._dirty.pop(key, None)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _patch(self, key, patcher):
+        with self._lock:
+            entry = self._load(key)
+            if entry is not None:
+                patcher(entry['filesets'])
+                if not self._dirty:
+                    _register_inventory_flush()
+                self._dirty[key] = self._path(key)
+
+    def add_fileset(self, key, record):
+        def patcher(filesets):
+            filesets[str(record['id'])] = record
+        self._patch(key, patcher)
+
+    def remove_fileset(self, key, fileset_id):
+        def patcher(filesets):
+            filesets.pop(str(fileset_id), None)
+        self._patch(key, patcher)
+
+    def update_fileset(self, key, fileset_id, properties=None, **fields):
+        def patcher(filesets):
+            record = filesets.get(str(fileset_id))
+            if record is None:
+                return
+            record.update(fields)
+            if properties:
+                custom_properties = record.get('custom_properties') or {}
+                custom_properties.update(properties)
+                record['custom_properties'] = custom_properties
+        self._patch(key, patcher)
+
+
+_inventory_flush_registered = []
+
+
+def _register_inventory_flush():
+    if not _inventory_flush_registered:
+        _inventory_flush_registered.append(True)
+        atexit.register(FilesetInventoryCache.flush)
+
+
+class ImportResult(object):
+    """Outcome of one entry of FWAdminClient.import_batch."""
+    __slots__ = ('spec', 'fileset_id', 'error')
+
+    def __init__(self, spec, fileset_id=None, error=None):
+        self.spec = spec
+        self.fileset_id = fileset_id
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __str__(self):
+        if self.ok:
+            return "%s -> fileset %s" % (self.spec.get('path'), self.fileset_id)
+        return "%s -> failed: %s" % (self.spec.get('path'), self.error)
+
+
+class ReconcileResult(object):
+    """What FWAdminClient.reconcile_associations changed.
+
+    added holds (client_id, fileset_id, kiosk, sw_update) keys, removed holds
+    Association objects and errors holds (action, item, exception) triples.
+    calls_saved counts the admin calls avoided compared to re-creating every
+    desired association after removing every existing one in scope.
+    """
+    __slots__ = ('added', 'removed', 'unchanged', 'errors', 'calls_saved')
+
+    def __init__(self, added, removed, unchanged, calls_saved):
+        self.added = added
+        self.removed = removed
+        self.unchanged = unchanged
+        self.errors = []
+        self.calls_saved = calls_saved
+
+    def __str__(self):
+        return "added %d, removed %d, unchanged %d, errors %d, %d admin calls saved" % (
+            len(self.added), len(self.removed), self.unchanged, len(self.errors), self.calls_saved)
+
+
+class PruneResult(object):
+    """What FWAdminClient.prune_filesets did (or would do, for a dry run).
+
+    kept, removed and associated map each bundle id to lists of Fileset
+    objects; associated holds superseded filesets left alone because they are
+    still associated.  errors holds (fileset, exception) pairs.
+    """
+    __slots__ = ('kept', 'removed', 'associated', 'errors')
+
+    def __init__(self):
+        self.kept = {}
+        self.removed = {}
+        self.associated = {}
+        self.errors = []
+
+    def __str__(self):
+        count = lambda groups: sum(len(filesets) for filesets in groups.values())
+        return "kept %d, removed %d, associated %d, errors %d" % (
+            count(self.kept), count(self.removed) - len(self.errors), count(self.associated), len(self.errors))
+
+
+class ValidationCache(object):
+    """Remembers successful FWTool validations in-process and on disk for ttl seconds.
+
+    Keys include the admin binary's path and mtime, so upgrading FileWave Admin
+    invalidates the entry, and the password, so a validation done with one
+    password is never reused for another.
+    """
+
+    _memory = {}
+    _lock = threading.Lock()
+
+    def __init__(self, ttl=600, cache_dir=None):
+        self.ttl = ttl
+        self.path = os.path.join(cache_dir or default_cache_dir(), "validation.json")
+
+    @staticmethod
+    def key_for(executable, host, port, user, password=''):
+        """None when the admin binary can't be found (nothing worth caching then).
+
+        Only a digest of the password ends up in the key.
+        """
+        try:
+            mtime = os.path.getmtime(executable)
+        except OSError:
+            return None
+        password_digest = hashlib.sha256(str(password).encode('utf-8')).hexdigest()
+        return hashlib.sha1(("%s:%r:%s:%s:%s:%s" % (executable, mtime, host, port, user,
+                                                    password_digest)).encode('utf-8')).hexdigest()
+
+    def _load_disk(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
 
+    def get(self, key):
+        if key is None or self.ttl <= 0:
+            return None
+        with self._lock:
+            entry = self._memory.get(key) or self._load_disk().get(key)
+        if entry is None or time.time() - entry['created'] >= self.ttl:
+            return None
+        return entry['result']
 
-class Fileset(object):
-    def __init__(self, id, name, type, size, parent_id, custom_properties=None, **kwargs):
-        self.id = str(id)
-        self.name = name
-        self.type = type
-        self.size = size
-        self.custom_properties = custom_properties
-        self.parent_id = str(parent_id)
-        self.is_critical = kwargs.get('isCritical')
+    def put(self, key, result):
+        if key is None or self.ttl <= 0:
+            return
+        entry = {'created': time.time(), 'result': result}
+        with self._lock:
+            self._memory[key] = entry
+            entries = self._load_disk()
+            now = time.time()
+            entries = dict((k, v) for k, v in entries.items() if now - v['created'] < self.ttl)
+            entries[key] = entry
+            try:
+                if not os.path.isdir(os.path.dirname(self.path)):
+                    os.makedirs(os.path.dirname(self.path))
+                tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump(entries, f)
+                getattr(os, 'replace', os.rename)(tmp_path, self.path)
+            except (IOError, OSError):
+                pass
 
 
-    def __str__(self):
-        return "%s - name: %s, type: %s, parent: %s, props: %s" % (
-            self.id,
-            self.name,
-            self.type,
-            self.parent_id,
-            self.custom_properties
-        )
+class FWAdminCommands(object):
+    """What FWAdminClient and AsyncFWAdminClient share: the connection, the
+    admin options of every command and the parsing of their results, and the
+    bookkeeping (inventory cache, events, model updates) after a change.
+
+    Subclasses provide run_admin and the public commands built on it.
+
+    create_fs_callback, remove_fs_callback and export_fs_callback are called
+    with the ID (and export destination) of each fileset created, removed or
+    exported, right after the admin call.  The subscribers of events get the
+    same changes later, from the bus's delivery thread.
+    """
 
-class FWAdminClient(object):
 
     ExitStatusDescription = {
         0: ("kExitOK", "No Error"),
@@ -87,7 +1775,11 @@ class FWAdminClient(object):
                  create_fs_callback=None,
                  remove_fs_callback=None,
                  export_fs_callback=None,
-                 print_output=False):
+                 print_output=False,
+                 inventory_cache=None,
+                 instrumentation=None,
+                 retry_policy=None,
+                 events=None):
 
         self.fwadmin_executable = self.get_admin_tool_path()
         self.connection_options = ['-u', admin_name,
@@ -96,9 +1788,51 @@ class FWAdminClient(object):
                                    '-P', server_port ]
 
         self.print_output = print_output
+        self.events = events if events is not None else AdminEventBus()
         self.create_fs_callback = create_fs_callback
         self.remove_fs_callback = remove_fs_callback
         self.export_fs_callback = export_fs_callback
+        self.inventory_cache = inventory_cache
+        self.instrumentation = instrumentation if instrumentation is not None else AdminInstrumentation()
+        self.retry_policy = retry_policy
+        self.model_updates = None
+
+    @property
+    def connection_key(self):
+        """Identifies the admin binary and server/user this client talks to."""
+        options = dict(zip(self.connection_options[::2], self.connection_options[1::2]))
+        return (self.fwadmin_executable, options['-H'], options['-P'], options['-u'])
+
+    @property
+    def connection_password(self):
+        return self.connection_options[self.connection_options.index('-p') + 1]
+
+    @property
+    def inventory_key(self):
+        _, host, port, user = self.connection_key
+        return FilesetInventoryCache.key_for(host, port, user)
+
+    def publish(self, kind, fileset_id=None, **data):
+        """Publishes an AdminEvent about this client's server on its event bus."""
+        _, host, port, _ = self.connection_key
+        return self.events.publish(kind, "%s:%s" % (host, port), fileset_id, **data)
+
+    def flush_events(self, timeout=None):
+        """Waits until the subscribers got every event published so far.
+
+        Returns False if that took longer than timeout seconds.
+        """
+        return self.events.flush(timeout)
+
+    def _model_changed(self):
+        if self.model_updates is not None:
+            self.model_updates.mark_dirty()
+
+    def _batch_done(self):
+        if self.model_updates is not None:
+            self.model_updates.flush()
+        if self.inventory_cache is not None:
+            self.inventory_cache.flush()
 
     @classmethod
     def get_admin_tool_path(cls):
@@ -119,8 +1853,7 @@ class FWAdminClient(object):
     def get_executable_path(cls):
         return os.environ.get("FILEWAVE_ADMIN_PATH", '/Applications/FileWave')
 
-    def run_admin(self, options, include_connection_options=True, error_expected=False, print_output=None):
-        print_output = print_output or self.print_output
+    def _process_options(self, options, include_connection_options=True):
         process_options = [self.fwadmin_executable]
         if include_connection_options:
             process_options.extend(self.connection_options)
@@ -135,89 +1868,117 @@ class FWAdminClient(object):
             process_options.append(options)
         else:
             process_options.extend(options)
+        return process_options
 
-        got_error = False
-
-        self.run_result_ret = None
-        try:
-            if print_output:
-                print(process_options)
-
-            self.run_result_ret = subprocess.check_output(process_options, stderr=subprocess.STDOUT).decode().rstrip()
-            self.run_result_ret = re.sub(r"QObject::connect.*QNetworkSession::State\)\n", '', self.run_result_ret)
-            self.run_result_ret = re.sub(r"qt.network.ssl: Error receiving trust for a CA certificate\n", '', self.run_result_ret)
-
-        except CalledProcessError as e:
-            got_error = True
-            if print_output:
-                print("Command failed, error code: ", e.returncode)
-                print("Ouput: ", e.output)
-            if not error_expected:
-                raise e
-            else:
-                self.run_result_ret = e.output, e.returncode
-
-        if error_expected and not got_error:
-            raise Exception("Expected an error, but command was successful")
+    # Qt warnings the admin tool mixes into its output
+    NOISE_RE = re.compile(r"QObject::connect.*QNetworkSession::State\)|"
+                          r"qt.network.ssl: Error receiving trust for a CA certificate")
 
-        return self.run_result_ret
+    @staticmethod
+    def clean_output(output):
+        """Decodes admin output and strips the Qt warnings it mixes into it."""
+        output = output.decode().rstrip()
+        if FWAdminCommands.NOISE_RE.search(output):
+            output = "\n".join(line for line in output.split("\n") if not FWAdminCommands.NOISE_RE.search(line))
+        return output
 
-    def get_version(self):
-        version = self.run_admin("-v")
-        return version
+    # exit statuses caused by the state of the server rather than by the command
+    TRANSIENT_EXIT_STATUSES = ('kExitDBError', 'kExitModelUpdateError', 'kExitLoginError')
 
-    def get_clients(self):
-        clients = json.loads(self.run_admin("--listClients"))
+    @classmethod
+    def is_transient(cls, returncode):
+        return cls.describe_exit_status(returncode)[0] in cls.TRANSIENT_EXIT_STATUSES
 
-        def recursive_generator(client):
-            children = client.pop('children', [])
-            yield Client(**client)
-            for child in children:
-                for child_client in recursive_generator(child):
-                    yield child_client
+    @classmethod
+    def describe_exit_status(cls, returncode):
+        """Returns the (name, description) pair for an admin tool exit code."""
+        return cls.ExitStatusDescription.get(
+            returncode, ("kExitUnknown%d" % returncode, "Unknown exit code %d" % returncode))
 
-        for c in clients:
-            for gg in recursive_generator(c):
-                yield gg
+    @staticmethod
+    def association_options(client_id, fileset_id, kiosk=False, sw_update=False):
+        args = ['--createAssociation', '--clientgroup', client_id, '--fileset', fileset_id]
+        if kiosk:
+            args.append('--kiosk')
 
-    def get_filesets(self):
-        filesets = json.loads(self.run_admin("--listFilesets"))
+        if sw_update:
+            args.append('--software_update')
+        return args
 
-        def recursive_generator(fileset):
-            children = fileset.pop('children', [])
-            yield Fileset(**fileset)
-            for child in children:
-                for child_fileset in recursive_generator(child):
-                    yield child_fileset
+    @staticmethod
+    def association_key(client_id, fileset_id, kiosk=False, sw_update=False):
+        return (str(client_id), str(fileset_id), bool(kiosk), bool(sw_update))
 
-        for fs in filesets:
-            for gg in recursive_generator(fs):
-                yield gg
+    def _reconcile_plan(self, desired, scope, associations):
+        """What reconcile_associations has to do.
 
-    def get_associations(self):
-        associations = json.loads(self.run_admin(['--listAssociations']))
+        Returns (ReconcileResult, associations to remove, keys to add).  A
+        client has one association per fileset, so the first desired entry
+        for a client and fileset wins.
+        """
+        pairs = collections.OrderedDict()
+        for item in desired:
+            if isinstance(item, dict):
+                key = self.association_key(**item)
+            else:
+                key = self.association_key(*item)
+            pairs.setdefault(key[:2], key)
+        wanted = list(pairs.values())
+        wanted_keys = set(wanted)
+        scope = set(str(fs_id) for fs_id in scope) if scope is not None else set(k[1] for k in wanted)
 
+        existing = {}
+        to_remove = []
         for assoc in associations:
-            yield Association(**assoc)
-
-    def create_association(self, client_id, fileset_id, kiosk=False, sw_update=False, error_expected=False ):
-        args = ['--createAssociation', '--clientgroup', client_id, '--fileset', fileset_id]
-        if kiosk:
-            args.append('--kiosk')
+            if assoc.fileset_id not in scope:
+                continue
+            key = self.association_key(assoc.client_id, assoc.fileset_id, assoc.kiosk, assoc.sw_update)
+            if key in wanted_keys and key not in existing:
+                existing[key] = assoc
+            else:
+                to_remove.append(assoc)
 
-        if sw_update:
-            args.append('--software_update')
+        to_add = [key for key in wanted if key not in existing]
+        naive_calls = len(wanted) + len(existing) + len(to_remove)
+        result = ReconcileResult(to_add, to_remove, len(existing),
+                                 naive_calls - len(to_add) - len(to_remove))
+        return result, to_remove, to_add
 
-        self.run_admin(args, error_expected=error_expected)
+    @staticmethod
+    def _blocked_adds(result, to_add):
+        """Splits to_add into the keys that can be added and those whose old association is still there.
 
-    def remove_association(self, assoc_id):
-        self.run_admin(['--deleteAssociation', str(assoc_id)])
+        An association whose removal failed keeps its client and fileset
+        taken, the replacement is recorded as an error instead of added.
+        """
+        failed = set((str(item.client_id), str(item.fileset_id))
+                     for action, item, _ in result.errors if action == 'remove')
+        addable = []
+        for key in to_add:
+            if key[:2] in failed:
+                result.errors.append(('add', key, Exception(
+                    "Not added, removing the existing association of client %s and fileset %s failed" % key[:2])))
+            else:
+                addable.append(key)
+        return addable
 
-    def get_help(self):
-        return self.run_admin("-h")
+    @staticmethod
+    def _prune_plan(index, associated, keep, bundle_ids):
+        """What prune_filesets has to do: returns (PruneResult, [filesets to remove])."""
+        result = PruneResult()
+        doomed = []
+        for bundle_id in (bundle_ids if bundle_ids is not None else index.bundle_ids()):
+            filesets = index.filesets(bundle_id)
+            cut = max(0, len(filesets) - max(0, keep))
+            result.kept[bundle_id] = filesets[cut:]
+            result.removed[bundle_id] = [fs for fs in filesets[:cut] if fs.id not in associated]
+            result.associated[bundle_id] = [fs for fs in filesets[:cut] if fs.id in associated]
+            doomed.extend(result.removed[bundle_id])
+        return result, doomed
 
-    def import_fileset(self, path, name=None, root=None, target=None, activation_script=None, requirements_script=None, preflight_script=None, postflight_script=None, preuninstallation_script=None, postuninstallation_script=None, verification_script=None):
-        options = ['--importFileset', path]
+    @staticmethod
+    def import_options(verb, path, name=None, root=None, target=None, activation_script=None, requirements_script=None, preflight_script=None, postflight_script=None, preuninstallation_script=None, postuninstallation_script=None, verification_script=None):
+        options = [verb, path]
         if name:
             options.extend(["--name", name])
         if root:
@@ -238,110 +1999,604 @@ class FWAdminClient(object):
             options.extend(["--addPostuninstallationScript", str(postuninstallation_script)])
         if verification_script:
             options.extend(["--addVerificationScript", str(verification_script)])
+        return options
 
-        import_folder_result = self.run_admin(options)
-        matcher = re.compile(r'new fileset with ID (?P<id>.+) was created')
-        search = matcher.search(import_folder_result)
+    def _imported(self, import_result, path, name, target, pattern=r'new fileset with ID (?P<id>.+) was created', fs_type='fileset'):
+        matcher = re.compile(pattern)
+        search = matcher.search(import_result)
         id = search.group('id')
-        if self.create_fs_callback and hasattr(self.create_fs_callback, '__call__'):
-            self.create_fs_callback(id)
+        self._fileset_created(id, name or os.path.basename(path), target, fs_type=fs_type)
         return id
 
-    def export_fileset(self, destination, fs_name):
-        options = [ '--exportFileset', destination, '--fileset', fs_name, '--name', fs_name]
-        export_result = self.run_admin(options)
-        matcher = re.compile(r'the fileset with ID (?P<id>.+) was exported to \'(?P<to>.+)\'')
-        search = matcher.search(export_result)
+    @staticmethod
+    def export_options(destination, fs_name, fileset_id=None):
+        """Exports fileset_id when given, otherwise the fileset called fs_name."""
+        return [ '--exportFileset', destination, '--fileset', str(fileset_id) if fileset_id is not None else fs_name, '--name', fs_name]
+
+    EXPORTED_PATTERN = re.compile(r'the fileset with ID (?P<id>.+) was exported to \'(?P<to>.+)\'')
+
+    def _export_location(self, export_result):
+        search = self.EXPORTED_PATTERN.search(export_result)
         id = search.group('id')
         dest = search.group('to')
         if self.export_fs_callback and hasattr(self.export_fs_callback, '__call__'):
             self.export_fs_callback(id, dest)
-        return id
+        self.publish(FILESET_EXPORTED, id, destination=dest)
+        return id, dest
 
-    def import_folder(self, path, name=None, root=None, target=None, activation_script=None, requirements_script=None, preflight_script=None, postflight_script=None, preuninstallation_script=None, postuninstallation_script=None, verification_script=None):
-        options = ['--importFolder', path]
-        if name:
-            options.extend(["--name", name])
-        if root:
-            options.extend(["--root", root])
+    def _exported(self, export_result):
+        return self._export_location(export_result)[0]
+
+    # import_batch 'kind' values and the method each one calls
+    IMPORT_METHODS = {
+        'folder': 'import_folder',
+        'package': 'import_package',
+        'fileset': 'import_fileset',
+    }
+
+    @staticmethod
+    def import_kind(path):
+        """The import_batch kind used when a spec doesn't name one."""
+        if os.path.splitext(path)[1] in (".pkg", ".mpkg", ".msi"):
+            return 'package'
+        if path.endswith(".fileset"):
+            return 'fileset'
+        return 'folder'
+
+    def _batch_call(self, spec):
+        """The import method and its arguments for an import_batch spec."""
+        args = dict(spec)
+        kind = args.pop('kind', None) or self.import_kind(args['path'])
+        return getattr(self, self.IMPORT_METHODS[kind]), args
+
+    IMAGE_CREATED_PATTERN = r'new imaging fileset with ID (?P<id>.+) was created'
+
+    @staticmethod
+    def property_options(fileset_id, prop_name, prop_value):
+        return ['--fileset', fileset_id, '--setProperty', '--key', prop_name, '--value', prop_value]
+
+    def _property_set(self, fileset_id, prop_name, prop_value):
+        if self.inventory_cache is not None:
+            self.inventory_cache.update_fileset(self.inventory_key, fileset_id, properties={prop_name: prop_value})
+        self._model_changed()
+
+    def _fileset_removed(self, fileset_id):
+        if self.inventory_cache is not None:
+            self.inventory_cache.remove_fileset(self.inventory_key, fileset_id)
+        self._model_changed()
+        if self.remove_fs_callback and hasattr(self.remove_fs_callback, '__call__'):
+            self.remove_fs_callback(fileset_id)
+        self.publish(FILESET_REMOVED, fileset_id)
+        return fileset_id
+
+    @staticmethod
+    def critical_options(fileset_id, is_critical):
+        return ['--fileset', fileset_id, '--setCriticalFlag',  '--value', "1" if is_critical else "0"]
+
+    def _critical_set(self, fileset_id, is_critical):
+        if self.inventory_cache is not None:
+            self.inventory_cache.update_fileset(self.inventory_key, fileset_id, isCritical=bool(is_critical))
+        self._model_changed()
+
+    def _fileset_created(self, fileset_id, name, target, fs_type='fileset'):
+        if self.inventory_cache is not None:
+            if target and not str(target).isdigit():
+                # imported into a group given by name, whose ID the admin
+                # tool doesn't report: list the server again next time
+                self.inventory_cache.invalidate(self.inventory_key)
+            else:
+                self.inventory_cache.add_fileset(self.inventory_key, {
+                    'id': fileset_id,
+                    'name': name,
+                    'type': fs_type,
+                    'size': 0,
+                    'parent_id': int(target) if target else 0,
+                    'custom_properties': {}
+                })
+        self._model_changed()
+        if self.create_fs_callback and hasattr(self.create_fs_callback, '__call__'):
+            self.create_fs_callback(fileset_id)
+        self.publish(FILESET_CREATED, fileset_id, name=name, target=target, type=fs_type)
+
+    @staticmethod
+    def empty_fileset_options(name, target=None):
+        options = ['--createFileset', str(name)]
         if target:
             options.extend(["--filesetgroup", str(target)])
-        if activation_script:
-            options.extend(["--addActivationScript", str(activation_script)])
-        if requirements_script:
-            options.extend(["--addRequirementsScript", str(requirements_script)])
-        if preflight_script:
-            options.extend(["--addPreflightScript", str(preflight_script)])
-        if postflight_script:
-            options.extend(["--addPostflightScript", str(postflight_script)])
-        if preuninstallation_script:
-            options.extend(["--addPreuninstallationScript", str(preuninstallation_script)])
-        if postuninstallation_script:
-            options.extend(["--addPostuninstallationScript", str(postuninstallation_script)])
-        if verification_script:
-            options.extend(["--addVerificationScript", str(verification_script)])
+        return options
 
-        import_folder_result = self.run_admin(options)
-        matcher = re.compile(r'new fileset with ID (?P<id>.+) was created')
-        search = matcher.search(import_folder_result)
+    def _empty_fileset_created(self, create_empty_fileset_result, target):
+        print(create_empty_fileset_result)
+        matcher = re.compile(r'new fileset (?P<id>.+) created with name (?P<name>.+)')
+        search = matcher.search(create_empty_fileset_result)
         id = search.group('id')
-        if self.create_fs_callback and hasattr(self.create_fs_callback, '__call__'):
-            self.create_fs_callback(id)
+        self._fileset_created(id, search.group('name'), target)
         return id
 
+
+class FWAdminClient(FWAdminCommands):
+    """Runs the admin tool for each command, blocking until it is done."""
+
+    def __init__(self,
+                 admin_name = 'fwadmin',
+                 admin_pwd = 'filewave',
+                 server_host = 'localhost',
+                 server_port = "20016",
+                 create_fs_callback=None,
+                 remove_fs_callback=None,
+                 export_fs_callback=None,
+                 print_output=False,
+                 command_cache=None,
+                 inventory_cache=None,
+                 instrumentation=None,
+                 progress_callback=None,
+                 max_output_lines=200,
+                 retry_policy=None,
+                 limiter=None,
+                 model_updates=None,
+                 events=None):
+        super(FWAdminClient, self).__init__(admin_name=admin_name,
+                                            admin_pwd=admin_pwd,
+                                            server_host=server_host,
+                                            server_port=server_port,
+                                            create_fs_callback=create_fs_callback,
+                                            remove_fs_callback=remove_fs_callback,
+                                            export_fs_callback=export_fs_callback,
+                                            print_output=print_output,
+                                            inventory_cache=inventory_cache,
+                                            instrumentation=instrumentation,
+                                            retry_policy=retry_policy,
+                                            events=events)
+        self.command_cache = command_cache
+        self.progress_callback = progress_callback
+        self.max_output_lines = max_output_lines
+        self.limiter = limiter
+        self.model_updates = model_updates
+
+    def use_command_cache(self, max_workers=2):
+        """Routes all admin commands through the shared command cache for this connection."""
+        self.command_cache = get_command_cache(self.connection_key, max_workers=max_workers)
+        return self.command_cache
+
+    def coalesce_model_updates(self, debounce=None):
+        """Has changes made through this client trigger the shared, coalesced model update."""
+        self.model_updates = get_model_update_coalescer(self, debounce=debounce)
+        return self.model_updates
+
+    def use_adaptive_limiter(self, max_limit=8, latency_target=None):
+        """Lets the shared AIMD limiter for this connection decide how many commands run at once."""
+        self.limiter = get_adaptive_limiter(self.connection_key, max_limit=max_limit,
+                                            latency_target=latency_target)
+        return self.limiter
+
+    # result lines a streamed command always keeps, however long its output
+    RESULT_RE = re.compile(r"fileset with ID|new fileset .+ created with name")
+
+    def _run_streaming(self, process_options, progress_callback=None):
+        """Runs the command reading its output line by line, like subprocess.check_output.
+
+        Qt noise is dropped as it arrives, every other line goes to the
+        progress callback.  Only the result lines and the last max_output_lines
+        lines are kept; they are returned (as bytes) in their original order.
+        """
+        def run():
+            process = subprocess.Popen(process_options, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            tail = collections.deque(maxlen=self.max_output_lines)
+            results = []
+            try:
+                for number, raw_line in enumerate(iter(lambda: process.stdout.readline(65536), b'')):
+                    line = raw_line.decode('utf-8', 'replace').rstrip('\r\n')
+                    if self.NOISE_RE.search(line):
+                        continue
+                    if self.RESULT_RE.search(line):
+                        results.append((number, line))
+                    else:
+                        tail.append((number, line))
+                    if progress_callback is not None:
+                        progress_callback(line)
+            finally:
+                process.stdout.close()
+                returncode = process.wait()
+            output = "\n".join(line for _, line in sorted(results + list(tail))).encode('utf-8')
+            if returncode != 0:
+                raise CalledProcessError(returncode, process_options, output=output)
+            return output
+
+        if self.command_cache is not None:
+            return self.command_cache.launch(run)
+        return run()
+
+    def _execute(self, process_options, stream=False, progress_callback=None):
+        """One attempt at running the command, returning its raw output like subprocess.check_output."""
+        token = self.limiter.acquire() if self.limiter is not None else None
+        started = time.time()
+        overloaded = False
+        try:
+            if stream:
+                return self._run_streaming(process_options, progress_callback or self.progress_callback)
+            if self.command_cache is not None:
+                return self.command_cache.check_output(process_options)
+            return subprocess.check_output(process_options, stderr=subprocess.STDOUT)
+        except CalledProcessError as e:
+            overloaded = self.is_transient(e.returncode)
+            raise
+        finally:
+            if self.limiter is not None:
+                self.limiter.release(token, time.time() - started, overloaded)
+
+    def run_admin(self, options, include_connection_options=True, error_expected=False, print_output=None,
+                  stream=False, progress_callback=None):
+        """Runs the admin tool and returns its output without the Qt noise.
+
+        With stream=True the output is read line by line, forwarded to the
+        progress callback (the given one or the client's) and only its result
+        lines and last max_output_lines lines are kept.  Don't use it for
+        listings, their output has to be complete.
+
+        Transient failures are retried as the client's retry_policy allows and
+        every attempt waits for a slot of its limiter, if it has one.
+        """
+        print_output = print_output or self.print_output
+        process_options = self._process_options(options, include_connection_options)
+
+        got_error = False
+
+        # keep the result local, several threads may share this client
+        result = None
+        verb = admin_verb(process_options)
+        started = time.time()
+        retries = 0
+        try:
+            if print_output:
+                print(process_options)
+
+            while True:
+                try:
+                    output = self._execute(process_options, stream, progress_callback)
+                    break
+                except CalledProcessError as e:
+                    delay = None
+                    if self.retry_policy is not None and not error_expected:
+                        delay = self.retry_policy.delay(retries, e.returncode, verb)
+                    if delay is None:
+                        raise
+                    retries += 1
+                    if print_output:
+                        print("Command failed, error code: ", e.returncode, "- retrying in %.1fs" % delay)
+                    time.sleep(delay)
+            self.instrumentation.record(verb, started, 0, len(output), retries)
+            result = self.clean_output(output)
+
+        except CalledProcessError as e:
+            got_error = True
+            self.instrumentation.record(verb, started, e.returncode, len(e.output or b''), retries)
+            if print_output:
+                print("Command failed, error code: ", e.returncode)
+                print("Ouput: ", e.output)
+            if not error_expected:
+                raise e
+            else:
+                result = e.output, e.returncode
+
+        if error_expected and not got_error:
+            raise Exception("Expected an error, but command was successful")
+
+        self.run_result_ret = result
+        return result
+
+    def get_version(self):
+        version = self.run_admin("-v")
+        return version
+
+    def run_admin_stream(self, options, chunk_size=65536, print_output=None):
+        """Runs the admin tool and yields the nodes of its JSON tree output while it is read.
+
+        Raises CalledProcessError (output being the tail of stderr) like run_admin
+        when the tool exits with an error.  Closing the generator early stops the tool.
+
+        Like run_admin every attempt waits for a slot of the client's limiter,
+        and a transient failure is retried as its retry_policy allows, but only
+        while no node has been yielded yet.
+        """
+        print_output = print_output or self.print_output
+        process_options = self._process_options(options)
+        if print_output:
+            print(process_options)
+
+        verb = admin_verb(process_options)
+        started = time.time()
+        retries = 0
+        # [bytes read, nodes yielded, exit status] of the current attempt
+        progress = [0, 0, None]
+        try:
+            while True:
+                progress[:] = [0, 0, None]
+                nodes = self._stream_attempt(process_options, chunk_size, progress)
+                try:
+                    for node in nodes:
+                        progress[1] += 1
+                        yield node
+                    break
+                except CalledProcessError as e:
+                    delay = None
+                    if self.retry_policy is not None and not progress[1]:
+                        delay = self.retry_policy.delay(retries, e.returncode, verb)
+                    if delay is None:
+                        raise
+                    retries += 1
+                    if print_output:
+                        print("Command failed, error code: ", e.returncode, "- retrying in %.1fs" % delay)
+                    time.sleep(delay)
+                finally:
+                    nodes.close()
+        finally:
+            # -1 marks a listing abandoned by the caller
+            self.instrumentation.record(verb, started, progress[2] if progress[2] is not None else -1,
+                                        progress[0], retries)
+
+    def _stream_attempt(self, process_options, chunk_size, progress):
+        """One attempt of run_admin_stream, holding a limiter slot until the tool has exited."""
+        token = self.limiter.acquire() if self.limiter is not None else None
+        started = time.time()
+        overloaded = False
+        try:
+            process = subprocess.Popen(process_options, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stderr_tail = collections.deque(maxlen=64)
+            stderr_reader = threading.Thread(target=lambda: stderr_tail.extend(process.stderr))
+            stderr_reader.daemon = True
+            stderr_reader.start()
+
+            parser = JsonTreeStream()
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            finished = False
+            try:
+                while True:
+                    chunk = process.stdout.read(chunk_size)
+                    if not chunk:
+                        break
+                    progress[0] += len(chunk)
+                    for node in parser.feed(decoder.decode(chunk)):
+                        yield node
+                returncode = progress[2] = process.wait()
+                stderr_reader.join()
+                if returncode != 0:
+                    overloaded = self.is_transient(returncode)
+                    raise CalledProcessError(returncode, process_options, output=b''.join(stderr_tail))
+                for node in parser.feed(decoder.decode(b'', final=True), final=True):
+                    yield node
+                finished = True
+            finally:
+                if not finished and process.poll() is None:
+                    process.kill()
+                    process.wait()
+                process.stdout.close()
+        finally:
+            if self.limiter is not None:
+                self.limiter.release(token, time.time() - started, overloaded)
+
+    def get_clients(self, stream=False):
+        if stream:
+            for record in self.run_admin_stream("--listClients"):
+                yield Client(**record)
+            return
+
+        for record in flatten_tree(json.loads(self.run_admin("--listClients"))):
+            yield Client(**record)
+
+    def get_filesets(self, use_cache=True, stream=False):
+        for record in self._fileset_records(use_cache, stream):
+            yield Fileset(**record)
+
+    def get_fileset_table(self, use_cache=True, stream=True):
+        """Loads the fileset inventory into a FilesetTable without building Fileset objects."""
+        table = FilesetTable()
+        for record in self._fileset_records(use_cache, stream):
+            table.append(record)
+        return table
+
+    def get_client_table(self, stream=True):
+        """Loads the client inventory into a ClientTable without building Client objects."""
+        table = ClientTable()
+        if stream:
+            records = self.run_admin_stream("--listClients")
+        else:
+            records = flatten_tree(json.loads(self.run_admin("--listClients")))
+        for record in records:
+            table.append(record)
+        return table
+
+    def get_association_table(self):
+        table = AssociationTable()
+        for record in json.loads(self.run_admin(['--listAssociations'])):
+            table.append(record)
+        return table
+
+    def get_deployment_resolver(self, stream=True):
+        """A DeploymentResolver over the current client tree and associations."""
+        return DeploymentResolver(self.get_client_table(stream=stream), self.get_association_table())
+
+    def _fileset_records(self, use_cache, stream):
+        if self.inventory_cache is not None and use_cache:
+            records = self.inventory_cache.get(self.inventory_key)
+            if records is None and not stream:
+                records = list(self._list_fileset_records())
+                self.inventory_cache.put(self.inventory_key, records)
+            if records is not None:
+                return records
+
+        if stream:
+            return self.run_admin_stream("--listFilesets")
+        return self._list_fileset_records()
+
+    def can_list_filesets(self):
+        """Checks that the fileset listing works without reading all of it.
+
+        A fresh inventory cache answers straight away; otherwise the listing is
+        streamed and stopped after its first fileset.  Raises CalledProcessError
+        like get_filesets when the admin tool fails.
+        """
+        if self.inventory_cache is not None and self.inventory_cache.get(self.inventory_key) is not None:
+            return True
+        filesets = self.get_filesets(use_cache=False, stream=True)
+        try:
+            next(filesets, None)
+        finally:
+            filesets.close()
+        return True
+
+    def get_version_index(self, use_cache=True):
+        """Builds a FilesetVersionIndex over the current fileset inventory."""
+        return FilesetVersionIndex(self.get_filesets(use_cache=use_cache))
+
+    def _list_fileset_records(self):
+        return flatten_tree(json.loads(self.run_admin("--listFilesets")))
+
+    def get_associations(self):
+        associations = json.loads(self.run_admin(['--listAssociations']))
+
+        for assoc in associations:
+            yield Association(**assoc)
+
+    def create_association(self, client_id, fileset_id, kiosk=False, sw_update=False, error_expected=False ):
+        args = self.association_options(client_id, fileset_id, kiosk, sw_update)
+        result = self.run_admin(args, error_expected=error_expected)
+        if not error_expected:
+            self._model_changed()
+        return result
+
+    def remove_association(self, assoc_id):
+        self.run_admin(['--deleteAssociation', str(assoc_id)])
+        self._model_changed()
+
+    def reconcile_associations(self, desired, scope=None, max_workers=4, dry_run=False):
+        """Makes the associations of the filesets in scope exactly the desired ones.
+
+        desired is an iterable of (client_id, fileset_id[, kiosk[, sw_update]])
+        tuples or of dicts with those keys.  scope is the set of fileset ids whose
+        associations are managed; it defaults to the filesets named in desired,
+        add the old fileset id to swap a version.  The existing associations are
+        listed once; only the missing ones are created and only the surplus ones
+        removed, using up to max_workers admin calls at once.  Every removal
+        finishes before the first association is created, so changing the
+        flags of an association can't delete the new one.
+        """
+        result, to_remove, to_add = self._reconcile_plan(desired, scope, self.get_associations())
+        if dry_run or not (to_remove or to_add):
+            return result
+
+        def run(action, item):
+            try:
+                if action == 'add':
+                    self.create_association(*item)
+                else:
+                    self.remove_association(item.id)
+            except Exception as e:
+                result.errors.append((action, item, e))
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            for _ in executor.map(lambda assoc: run('remove', assoc), to_remove):
+                pass
+            for _ in executor.map(lambda key: run('add', key), self._blocked_adds(result, to_add)):
+                pass
+        self._batch_done()
+        return result
+
+    def prune_filesets(self, keep=3, bundle_ids=None, max_workers=4, dry_run=False, use_cache=False):
+        """Removes superseded autopkg filesets, keeping the newest keep versions of each bundle.
+
+        Filesets are grouped by their autopkg_app_bundle_id (all bundles, or
+        just bundle_ids) and ordered by autopkg_app_version.  Older filesets
+        that still have associations are skipped.  The rest are removed with
+        up to max_workers admin calls at once; a failed removal is recorded in
+        the result and doesn't stop the others.  The fileset listing is not
+        taken from the inventory cache unless use_cache is set.
+        """
+        index = self.get_version_index(use_cache=use_cache)
+        associated = set(assoc.fileset_id for assoc in self.get_associations())
+
+        result, doomed = self._prune_plan(index, associated, keep, bundle_ids)
+        if dry_run or not doomed:
+            return result
+
+        def run(fileset):
+            try:
+                self.remove_fileset(fileset.id)
+            except Exception as e:
+                result.errors.append((fileset, e))
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(doomed)))) as executor:
+            for _ in executor.map(run, doomed):
+                pass
+        self._batch_done()
+        return result
+
+    def get_help(self):
+        return self.run_admin("-h")
+
+    def import_fileset(self, path, name=None, root=None, target=None, activation_script=None, requirements_script=None, preflight_script=None, postflight_script=None, preuninstallation_script=None, postuninstallation_script=None, verification_script=None):
+        options = self.import_options('--importFileset', path, name, root, target, activation_script, requirements_script, preflight_script, postflight_script, preuninstallation_script, postuninstallation_script, verification_script)
+        return self._imported(self.run_admin(options, stream=True), path, name, target)
+
+    def export_fileset(self, destination, fs_name, fileset_id=None):
+        return self._exported(self.run_admin(self.export_options(destination, fs_name, fileset_id), stream=True))
+
+    def export_fileset_to(self, destination, fs_name, fileset_id=None):
+        """Like export_fileset but returns (fileset ID, path of the export)."""
+        return self._export_location(self.run_admin(self.export_options(destination, fs_name, fileset_id), stream=True))
+
+    def import_folder(self, path, name=None, root=None, target=None, activation_script=None, requirements_script=None, preflight_script=None, postflight_script=None, preuninstallation_script=None, postuninstallation_script=None, verification_script=None):
+        options = self.import_options('--importFolder', path, name, root, target, activation_script, requirements_script, preflight_script, postflight_script, preuninstallation_script, postuninstallation_script, verification_script)
+        return self._imported(self.run_admin(options, stream=True), path, name, target)
+
+    def import_batch(self, specs, max_workers=4):
+        """Imports many filesets with at most max_workers admin imports running at once.
+
+        Each spec is a dict of import_folder/import_package/import_fileset
+        arguments plus an optional 'kind' ('folder', 'package' or 'fileset').
+        Returns one ImportResult per spec, in order; a failed import records its
+        error and the rest of the batch carries on.  With coalesced model
+        updates the whole batch is followed by a single one.
+        """
+        specs = list(specs)
+
+        def run(spec):
+            try:
+                method, args = self._batch_call(spec)
+                return ImportResult(spec, fileset_id=method(**args))
+            except Exception as e:
+                return ImportResult(spec, error=e)
+
+        if not specs:
+            return []
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(specs)))) as executor:
+            results = list(executor.map(run, specs))
+        self._batch_done()
+        return results
+
     def import_image(self, path, error_expected=False):
         options = ['--importImage', path]
-        import_image_result = self.run_admin( options, error_expected=error_expected )
-        matcher = re.compile( r'new imaging fileset with ID (?P<id>.+) was created')
-        search = matcher.search(import_image_result)
-        id = search.group('id')
-        if self.create_fs_callback and hasattr(self.create_fs_callback, '__call__'):
-            self.create_fs_callback(id)
-        return id
+        import_image_result = self.run_admin( options, error_expected=error_expected, stream=True )
+        return self._imported(import_image_result, path, None, None,
+                              pattern=self.IMAGE_CREATED_PATTERN, fs_type='imaging')
 
     def import_package(self, path, name=None, root=None, target=None):
-        options = ['--importPackage', path]
-        if name:
-            options.extend(["--name", name])
-        if root:
-            options.extend(["--root", root])
-        if target:
-            options.extend(["--filesetgroup", str(target)])
-
-        import_package_result = self.run_admin(options)
-        matcher = re.compile(r'new fileset with ID (?P<id>.+) was created')
-        search = matcher.search(import_package_result)
-        id = search.group('id')
-        if self.create_fs_callback and hasattr(self.create_fs_callback, '__call__'):
-            self.create_fs_callback(id)
-        return id
+        options = self.import_options('--importPackage', path, name, root, target)
+        return self._imported(self.run_admin(options, stream=True), path, name, target)
 
     def set_property(self, fileset_id, prop_name, prop_value):
-        options = ['--fileset', fileset_id, '--setProperty', '--key', prop_name, '--value', prop_value]
-        self.run_admin(options)
+        self.run_admin(self.property_options(fileset_id, prop_name, prop_value))
+        self._property_set(fileset_id, prop_name, prop_value)
 
     def remove_fileset(self, fileset_id):
         self.run_admin(['--deleteFileset', str(fileset_id)])
-        if self.remove_fs_callback and hasattr(self.remove_fs_callback, '__call__'):
-            self.remove_fs_callback(fileset_id)
-        return fileset_id
+        return self._fileset_removed(fileset_id)
 
     def set_fileset_critical(self, fileset_id, is_critical):
-        options = ['--fileset', fileset_id, '--setCriticalFlag',  '--value', "1" if is_critical else "0"]
-        self.run_admin(options)
+        self.run_admin(self.critical_options(fileset_id, is_critical))
+        self._critical_set(fileset_id, is_critical)
 
     def model_update(self):
         self.run_admin(['--updateModel'])
 
     def create_empty_fileset(self, name, target=None):
-        options = ['--createFileset', str(name)]
-        if target:
-            options.extend(["--filesetgroup", str(target)])
-        create_empty_fileset_result = self.run_admin(options)
-        print(create_empty_fileset_result)
-        matcher = re.compile(r'new fileset (?P<id>.+) created with name (?P<name>.+)')
-        search = matcher.search(create_empty_fileset_result)
-        id = search.group('id')
-        if self.create_fs_callback and hasattr(self.create_fs_callback, '__call__'):
-            self.create_fs_callback(id)
-        return id
+        return self._empty_fileset_created(self.run_admin(self.empty_fileset_options(name, target), stream=True), target)
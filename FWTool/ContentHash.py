@@ -0,0 +1,177 @@
+from __future__ import absolute_import, print_function
+
+import hashlib
+import json
+import os
+import os.path
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from CommandLine import default_cache_dir
+
+CONTENT_DIGEST_PROPERTY = "autopkg_content_digest"
+DEFAULT_HASH_CACHE_MAX_ENTRIES = 100000
+
+
+class ContentHasher(object):
+    """Computes a stable SHA-256 digest of an import source (file, bundle or folder tree).
+
+    File contents are hashed on max_workers threads.  Per-file digests are
+    remembered by path, size and mtime in a JSON cache so unchanged payloads
+    are not read again on the next run.  Paths below a folder registered with
+    alias() (a dmg mount point, which changes with every mount) are remembered
+    by the alias instead.  The cache keeps the max_entries most recently used
+    entries.  A tree digest covers each entry's relative path, type,
+    executable bit and content (or link target).
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    # last-use stamps are kept in days, so a run that only hits the cache
+    # rewrites it at most once a day
+    STAMP_SECONDS = 24 * 60 * 60
+
+    def __init__(self, cache_path=None, max_workers=4, max_entries=DEFAULT_HASH_CACHE_MAX_ENTRIES):
+        self.cache_path = cache_path or os.path.join(default_cache_dir(), "content-hashes.json")
+        self.max_workers = max_workers
+        self.max_entries = max_entries
+        self.files_hashed = 0
+        self.files_cached = 0
+        self._aliases = []
+        self._cache = None
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._today = int(time.time() // self.STAMP_SECONDS)
+
+    def alias(self, folder, key):
+        """Caches the files below folder as key/<relative path> rather than by their absolute path."""
+        self._aliases.append((os.path.abspath(folder).rstrip(os.sep), key))
+
+    def _cache_key(self, path):
+        path = os.path.abspath(path)
+        for folder, key in self._aliases:
+            if path.startswith(folder + os.sep):
+                return key + "/" + path[len(folder) + 1:].replace(os.sep, '/')
+        return path
+
+    def _load_cache(self):
+        if self._cache is None:
+            try:
+                with open(self.cache_path) as f:
+                    self._cache = json.load(f)
+            except (IOError, OSError, ValueError):
+                self._cache = {}
+        return self._cache
+
+    def save(self):
+        if not self._dirty:
+            return
+        with self._lock:
+            if len(self._cache) > self.max_entries:
+                # least recently used first; entries of older versions have no stamp
+                keep = sorted(self._cache, key=lambda key: self._cache[key][3:4] or [0])[-self.max_entries:]
+                self._cache = dict((key, self._cache[key]) for key in keep)
+        try:
+            cache_dir = os.path.dirname(self.cache_path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = "%s.%d.tmp" % (self.cache_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(self._cache, f)
+            getattr(os, 'replace', os.rename)(tmp_path, self.cache_path)
+            self._dirty = False
+        except (IOError, OSError):
+            pass
+
+    def _file_digest(self, path, st):
+        key = self._cache_key(path)
+        signature = [st.st_size, getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9))]
+        with self._lock:
+            cached = self._load_cache().get(key)
+            if cached is not None and cached[:2] == signature:
+                self.files_cached += 1
+                if cached[3:4] != [self._today]:
+                    self._cache[key] = cached[:3] + [self._today]
+                    self._dirty = True
+                return cached[2]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+
+        with self._lock:
+            self._cache[key] = signature + [digest, self._today]
+            self._dirty = True
+            self.files_hashed += 1
+        return digest
+
+    def _entries(self, root):
+        """(relative path, kind, mode, absolute path, stat) for everything below root, sorted."""
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for name in dirnames + sorted(filenames):
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                rel_path = os.path.relpath(path, root).replace(os.sep, '/')
+                if stat.S_ISLNK(st.st_mode):
+                    kind = 'link'
+                elif stat.S_ISDIR(st.st_mode):
+                    kind = 'dir'
+                else:
+                    kind = 'file'
+                entries.append((rel_path, kind, 'x' if st.st_mode & stat.S_IXUSR else '-', path, st))
+        entries.sort(key=lambda e: e[0])
+        return entries
+
+    def tree_manifest(self, root):
+        """Maps every relative path below root to (kind, mode, content digest or link target)."""
+        entries = self._entries(root)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = dict((rel_path, executor.submit(self._file_digest, path, st))
+                           for rel_path, kind, _, path, st in entries if kind == 'file')
+        manifest = {}
+        for rel_path, kind, mode, path, _ in entries:
+            if kind == 'file':
+                value = futures[rel_path].result()
+            elif kind == 'link':
+                value = os.readlink(path)
+            else:
+                value = ''
+            manifest[rel_path] = (kind, mode, value)
+        return manifest
+
+    @staticmethod
+    def manifest_digest(manifest):
+        """The tree digest ('sha256:<hex>') of a tree_manifest result."""
+        sha = hashlib.sha256()
+        for rel_path in sorted(manifest):
+            kind, mode, value = manifest[rel_path]
+            sha.update(("%s\t%s\t%s\t%s\n" % (kind, mode, rel_path, value)).encode('utf-8'))
+        return "sha256:%s" % sha.hexdigest()
+
+    def digest(self, path):
+        """Returns 'sha256:<hex>' for the file or directory tree at path."""
+        if os.path.isdir(path):
+            digest = self.manifest_digest(self.tree_manifest(path))
+        else:
+            digest = "sha256:%s" % self._file_digest(path, os.stat(path))
+        self.save()
+        return digest
+
+
+def settings_digest(content_digest, settings):
+    """Combines a content digest with the settings the content is imported with.
+
+    Settings left empty don't count, so without any the content digest is
+    returned unchanged.
+    """
+    settings = dict((name, value) for name, value in settings.items() if value)
+    if not settings:
+        return content_digest
+    sha = hashlib.sha256(content_digest.encode('utf-8'))
+    sha.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    return "sha256:%s" % sha.hexdigest()
@@ -0,0 +1,182 @@
+from __future__ import absolute_import, print_function
+
+import atexit
+import collections
+import glob
+import os
+import os.path
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ContentHash import ContentHasher
+
+DEFAULT_DMG_CACHE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+
+class _Mount(object):
+    __slots__ = ('key', 'pathname', 'mountpoint', 'mounter', 'size', 'refs', 'found')
+
+    def __init__(self, key, pathname, mountpoint, mounter, size):
+        self.key = key
+        self.pathname = pathname
+        self.mountpoint = mountpoint
+        self.mounter = mounter
+        self.size = size
+        self.refs = 0
+        self.found = {}
+
+
+class DmgMountCache(object):
+    """Keeps disk images mounted between the processors of a batch run.
+
+    Mounts are keyed by the SHA-256 of the dmg, so re-runs and chained recipes
+    working on the same image share one mount whatever its path.  acquire()
+    and release() count the users of a mount; once nobody uses it, it stays
+    mounted until the images that aren't in use need more than max_bytes (the
+    least recently used ones are detached first) or the process exits.
+
+    The mounting itself is left to the autopkg DmgMounter passed to acquire(),
+    which is also used to detach the image again.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_DMG_CACHE_MAX_BYTES, hasher=None, max_workers=4):
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers
+        self.hasher = hasher or ContentHasher()
+        self.mounts_reused = 0
+        self._mounts = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def key_for(self, pathname):
+        return self.hasher.digest(pathname)
+
+    def acquire(self, pathname, mounter):
+        """Returns (key, mountpoint) for the dmg at pathname, mounting it with mounter if needed."""
+        key = self.key_for(pathname)
+        with self._lock:
+            mount = self._mounts.get(key)
+            if mount is not None and not os.path.isdir(mount.mountpoint):
+                # detached behind our back
+                del self._mounts[key]
+                mount = None
+            if mount is None:
+                for stale in [m for m in self._mounts.values() if m.pathname == pathname and m.refs == 0]:
+                    # an older image at the same path, the mounter can't hold both
+                    self._detach(stale)
+                mount = _Mount(key, pathname, mounter.mount(pathname), mounter, os.path.getsize(pathname))
+                self._mounts[key] = mount
+            else:
+                self.mounts_reused += 1
+            mount.refs += 1
+            self._mounts[key] = self._mounts.pop(key)
+            return key, mount.mountpoint
+
+    def release(self, key):
+        """Gives up one use of the mount, detaching idle mounts over the size limit."""
+        with self._lock:
+            mount = self._mounts.get(key)
+            if mount is None:
+                return
+            mount.refs = max(0, mount.refs - 1)
+            # most recently used last, so eviction starts with the oldest
+            self._mounts[key] = self._mounts.pop(key)
+            self._evict()
+
+    def _evict(self):
+        idle = [mount for mount in self._mounts.values() if mount.refs == 0]
+        idle_bytes = sum(mount.size for mount in idle)
+        for mount in idle:
+            if idle_bytes <= self.max_bytes:
+                break
+            self._detach(mount)
+            idle_bytes -= mount.size
+
+    def _detach(self, mount):
+        self._mounts.pop(mount.key, None)
+        try:
+            mount.mounter.unmount(mount.pathname)
+        except Exception:
+            # already gone or busy, either way it is not ours anymore
+            pass
+
+    def clear(self):
+        """Detaches every mount that isn't in use."""
+        with self._lock:
+            for mount in [mount for mount in self._mounts.values() if mount.refs == 0]:
+                self._detach(mount)
+
+    def close(self):
+        """Detaches every mount."""
+        with self._lock:
+            for mount in list(self._mounts.values()):
+                self._detach(mount)
+
+    def find(self, key, extension=None, name=None, max_depth=2):
+        """Path of the first item called name, or with the extension, in the mounted image.
+
+        The top level is looked at first; only when nothing matches there are
+        the folders below it searched, max_depth levels deep and in parallel.
+        Results are remembered with the mount.
+        """
+        with self._lock:
+            mount = self._mounts[key]
+            cache_key = (extension, name, max_depth)
+            if cache_key in mount.found:
+                return mount.found[cache_key]
+        pattern = name if name else "*.%s" % extension.lstrip(".")
+
+        found = sorted(glob.glob(os.path.join(glob.escape(mount.mountpoint), pattern)))
+        if not found and max_depth > 1:
+            folders = sorted(path for path in glob.glob(os.path.join(glob.escape(mount.mountpoint), "*"))
+                             if os.path.isdir(path) and not os.path.islink(path)
+                             and not os.path.splitext(path)[1])
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = executor.map(lambda folder: _search(folder, pattern, max_depth - 1), folders)
+                found = [path for path in results if path is not None]
+
+        result = found[0] if found else None
+        with self._lock:
+            mount.found[cache_key] = result
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'mounts': len(self._mounts),
+                'in_use': sum(1 for mount in self._mounts.values() if mount.refs),
+                'bytes': sum(mount.size for mount in self._mounts.values()),
+                'reused': self.mounts_reused,
+            }
+
+
+def _search(folder, pattern, depth):
+    """Breadth first search for pattern below folder, depth levels deep."""
+    level = [folder]
+    while level and depth > 0:
+        next_level = []
+        for path in level:
+            found = sorted(glob.glob(os.path.join(glob.escape(path), pattern)))
+            if found:
+                return found[0]
+            next_level.extend(sorted(child for child in glob.glob(os.path.join(glob.escape(path), "*"))
+                                     if os.path.isdir(child) and not os.path.islink(child)
+                                     and not os.path.splitext(child)[1]))
+        level = next_level
+        depth -= 1
+    return None
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_mount_cache(max_bytes=DEFAULT_DMG_CACHE_MAX_BYTES):
+    """The mount cache shared by all processors of this autopkg run, detached at exit."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = DmgMountCache(max_bytes=max_bytes)
+            atexit.register(_cache.close)
+        else:
+            _cache.max_bytes = max_bytes
+        return _cache
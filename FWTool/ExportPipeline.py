@@ -0,0 +1,162 @@
+from __future__ import absolute_import, print_function
+
+import atexit
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ContentHash import ContentHasher
+
+# shutil.make_archive formats an export can be compressed to
+COMPRESSION_FORMATS = ('zip', 'gztar', 'bztar', 'xztar')
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+class ExportResult(object):
+    """Outcome of one export; path is the archive when the export was compressed."""
+
+    __slots__ = ('fileset_id', 'name', 'path', 'manifest_path', 'digest', 'error')
+
+    def __init__(self, fileset_id, name, path=None, manifest_path=None, digest=None, error=None):
+        self.fileset_id = fileset_id
+        self.name = name
+        self.path = path
+        self.manifest_path = manifest_path
+        self.digest = digest
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return "ExportResult(%s -> %s)" % (self.fileset_id, self.path)
+        return "ExportResult(%s failed: %s)" % (self.fileset_id, self.error)
+
+
+def _sha256(path, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ExportPipeline(object):
+    """Exports filesets by ID on a few background workers.
+
+    submit() returns a future right away; each job exports the fileset,
+    optionally compresses the export (any COMPRESSION_FORMATS value, the
+    uncompressed copy is removed) and writes a checksum manifest next to it as
+    <export>.manifest.json.  Failures end up in the ExportResult instead of
+    being raised.
+    """
+
+    def __init__(self, client, max_workers=2, compression=None):
+        if compression and compression not in COMPRESSION_FORMATS:
+            raise ValueError("Unknown export compression %s, use one of %s" %
+                             (compression, ", ".join(COMPRESSION_FORMATS)))
+        self.client = client
+        self.max_workers = max_workers
+        self.compression = compression or None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def submit(self, fileset_id, name, destination):
+        future = self._executor.submit(self._export, fileset_id, name, destination)
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def _export(self, fileset_id, name, destination):
+        try:
+            if not os.path.isdir(destination):
+                os.makedirs(destination)
+            _, path = self.client.export_fileset_to(destination, name, fileset_id)
+            if self.compression:
+                path = self._compress(path)
+            manifest_path, digest = self.write_manifest(fileset_id, name, path)
+            return ExportResult(fileset_id, name, path, manifest_path, digest)
+        except Exception as e:
+            return ExportResult(fileset_id, name, error=e)
+
+    def _compress(self, path):
+        path = path.rstrip(os.sep)
+        archive = shutil.make_archive(path, self.compression,
+                                      root_dir=os.path.dirname(path), base_dir=os.path.basename(path))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        return archive
+
+    def write_manifest(self, fileset_id, name, path):
+        """Writes <path>.manifest.json with the digest of every exported file; returns (its path, digest)."""
+        if os.path.isdir(path):
+            hasher = ContentHasher()
+            tree = hasher.tree_manifest(path)
+            hasher.save()
+            digest = hasher.manifest_digest(tree)
+            files = dict((rel_path, value) for rel_path, (kind, _, value) in tree.items() if kind == 'file')
+        else:
+            digest = "sha256:%s" % _sha256(path)
+            files = {os.path.basename(path): digest.split(':', 1)[1]}
+
+        manifest_path = path.rstrip(os.sep) + MANIFEST_SUFFIX
+        with open(manifest_path, 'w') as f:
+            json.dump({'fileset_id': fileset_id,
+                       'name': name,
+                       'path': os.path.basename(path.rstrip(os.sep)),
+                       'digest': digest,
+                       'files': files}, f, indent=2, sort_keys=True)
+        return manifest_path, digest
+
+    @property
+    def pending(self):
+        with self._lock:
+            return sum(1 for future in self._futures if not future.done())
+
+    def wait(self):
+        """Blocks until every submitted export finished and returns their results in submission order."""
+        with self._lock:
+            futures = list(self._futures)
+        return [future.result() for future in futures]
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+_pipelines = {}
+_pipelines_lock = threading.Lock()
+
+
+def get_export_pipeline(client, max_workers=2, compression=None):
+    """The pipeline shared by every processor exporting from the same server with the same settings.
+
+    Exports still running when autopkg exits are waited for, failures are
+    reported on stderr.
+    """
+    key = (client.inventory_key, max_workers, compression or None)
+    with _pipelines_lock:
+        if key not in _pipelines:
+            if not _pipelines:
+                atexit.register(_finish_exports)
+            _pipelines[key] = ExportPipeline(client, max_workers=max_workers, compression=compression)
+        return _pipelines[key]
+
+
+def _finish_exports():
+    with _pipelines_lock:
+        pipelines = list(_pipelines.values())
+    for pipeline in pipelines:
+        for result in pipeline.wait():
+            if not result.ok:
+                sys.stderr.write("Export of fileset %s failed: %s\n" % (result.fileset_id, result.error))
+        pipeline.close()
@@ -28,13 +28,19 @@ from autopkglib import DmgMounter, Processor, ProcessorError
 # this Processor was imported via autopkg explicitly, the directory is not in
 # the search path.
 sys.path.append(os.path.dirname(__file__))
-from CommandLine import FWAdminClient
+from CommandLine import (AdminEventBus, AdminInstrumentation, FilesetInventoryCache, FWAdminClient,
+                         JsonLinesEventSink, JsonLinesSink, PrometheusTextfileSink, RetryPolicy,
+                         SocketEventSink, ValidationCache)
 
 FWTOOL_SUMMARY_RESULT = 'fwtool_summary_result'
 DEFAULT_FW_SERVER_HOST = "localhost"
 DEFAULT_FW_SERVER_PORT = "20016"
 DEFAULT_FW_ADMIN_USERNAME = "fwadmin"
 DEFAULT_FW_ADMIN_PASSWORD = "filewave"
+DEFAULT_FW_INVENTORY_CACHE_TTL = 300
+DEFAULT_FW_VALIDATION_CACHE_TTL = 600
+DEFAULT_FW_EVENTS_QUEUE_SIZE = 1000
+DEFAULT_FW_ADMIN_RETRIES = 3
 
 COMMON_FILEWAVE_VARIABLES = {
         "FW_SERVER_HOST": {
@@ -61,10 +67,92 @@ COMMON_FILEWAVE_VARIABLES = {
                             % DEFAULT_FW_ADMIN_PASSWORD),
             "required": False,
         },
+        "FW_SERVER_TARGETS": {
+            "default": [],
+            "description": ("Servers the FileWave importer imports into, all at once, instead of "
+                            "FW_SERVER_HOST: a list of 'host[:port]' strings or of dicts with host, port, "
+                            "user, password and name keys (missing values come from the FW_ settings)"),
+            "required": False,
+        },
         "FW_RELAX_VERSION": {
             "default": False,
             "description": "Relax the version check and continue on regardless",
             "required": False
+        },
+        "FW_ADMIN_COMMAND_CACHE": {
+            "default": 0,
+            "description": ("Caches the output of version queries and shares concurrent identical listings "
+                            "between all FileWave processors in this autopkg run, with at most this many admin "
+                            "commands running at once.  Every other command still starts its own admin process.  "
+                            "0 (the default) turns the cache off"),
+            "required": False
+        },
+        "FW_INVENTORY_CACHE_TTL": {
+            "default": DEFAULT_FW_INVENTORY_CACHE_TTL,
+            "description": ("Number of seconds a fileset listing is reused (in-process and on disk) before "
+                            "the server is asked again.  0 disables the cache.  Defaults to %s"
+                            % DEFAULT_FW_INVENTORY_CACHE_TTL),
+            "required": False
+        },
+        "FW_VALIDATION_CACHE_TTL": {
+            "default": DEFAULT_FW_VALIDATION_CACHE_TTL,
+            "description": ("Number of seconds a successful validation of the admin tool and server "
+                            "is reused by later processors and runs.  0 disables the cache.  Defaults to %s"
+                            % DEFAULT_FW_VALIDATION_CACHE_TTL),
+            "required": False
+        },
+        "FW_ADMIN_RETRIES": {
+            "default": DEFAULT_FW_ADMIN_RETRIES,
+            "description": ("How often an admin command failing with a transient server error (database, "
+                            "login or model update error) is retried, with a randomized growing delay.  "
+                            "0 disables retries.  Defaults to %s" % DEFAULT_FW_ADMIN_RETRIES),
+            "required": False
+        },
+        "FW_ADMIN_ADAPTIVE_CONCURRENCY": {
+            "default": 0,
+            "description": ("If set, the most admin commands this autopkg run may have running at once; the "
+                            "actual number is lowered when the server reports transient errors and raised "
+                            "again while it keeps up.  0 (the default) doesn't limit it"),
+            "required": False
+        },
+        "FW_MODEL_UPDATE": {
+            "default": "",
+            "description": ("Update the FileWave model after changes: 'end' runs one model update when "
+                            "autopkg exits (and one after each batch operation), a number of seconds also "
+                            "runs one at most that long after the first change.  Empty (the default) "
+                            "leaves model updates to the administrator"),
+            "required": False
+        },
+        "FW_METRICS_JSONL": {
+            "default": "",
+            "description": "If set, every admin call (verb, wall time, exit code, output size, retries) "
+                           "is appended to this file as a JSON line",
+            "required": False
+        },
+        "FW_EVENTS_JSONL": {
+            "default": "",
+            "description": "If set, every fileset created, removed or exported is appended to this file "
+                           "as a JSON line, in the background",
+            "required": False
+        },
+        "FW_EVENTS_SOCKET": {
+            "default": "",
+            "description": "If set, every fileset created, removed or exported is sent as a JSON line to "
+                           "this Unix socket path (or 'host:port'), in the background",
+            "required": False
+        },
+        "FW_EVENTS_QUEUE_SIZE": {
+            "default": DEFAULT_FW_EVENTS_QUEUE_SIZE,
+            "description": ("Number of events waiting for slow event sinks beyond which the oldest "
+                            "are dropped rather than slowing down the imports.  Defaults to %d"
+                            % DEFAULT_FW_EVENTS_QUEUE_SIZE),
+            "required": False
+        },
+        "FW_METRICS_TEXTFILE": {
+            "default": "",
+            "description": "If set, per verb admin call totals are written to this Prometheus "
+                           "(node_exporter textfile collector) file",
+            "required": False
         }
 }
 
@@ -83,42 +171,148 @@ class FWTool(DmgMounter):
 
     client = None
 
-    def validate_tools(self, print_path=False):
+    def make_instrumentation(self):
+        instrumentation = AdminInstrumentation()
+        if self.env.get('FW_METRICS_JSONL'):
+            instrumentation.add_hook(JsonLinesSink(self.env['FW_METRICS_JSONL']))
+        if self.env.get('FW_METRICS_TEXTFILE'):
+            instrumentation.add_hook(PrometheusTextfileSink(self.env['FW_METRICS_TEXTFILE']))
+        return instrumentation
 
-        self.relaxed_version_check = self.env.get('FW_RELAX_VERSION', False)
+    events = None
+
+    def make_event_bus(self):
+        """The event bus shared by the clients of this processor, with the configured sinks subscribed."""
+        if self.events is None:
+            self.events = AdminEventBus(
+                max_queue=int(self.env.get('FW_EVENTS_QUEUE_SIZE', DEFAULT_FW_EVENTS_QUEUE_SIZE)))
+            if self.env.get('FW_EVENTS_JSONL'):
+                self.events.subscribe(JsonLinesEventSink(self.env['FW_EVENTS_JSONL']))
+            address = self.env.get('FW_EVENTS_SOCKET')
+            if address:
+                host, _, port = address.rpartition(':')
+                if host and port.isdigit() and os.sep not in address:
+                    address = (host, int(port))
+                self.events.subscribe(SocketEventSink(address))
+        return self.events
 
-        self.client = FWAdminClient(
-            admin_name=self.env['FW_ADMIN_USER'],
-            admin_pwd=self.env['FW_ADMIN_PASSWORD'],
-            server_host=self.env['FW_SERVER_HOST'],
-            server_port=self.env['FW_SERVER_PORT'],
-            print_output=False
+    def make_client(self, server_host, server_port, admin_name, admin_pwd, use_command_cache=None):
+        """An FWAdminClient for the server, set up as configured for this run."""
+        client = FWAdminClient(
+            admin_name=admin_name,
+            admin_pwd=admin_pwd,
+            server_host=server_host,
+            server_port=server_port,
+            print_output=False,
+            inventory_cache=FilesetInventoryCache(
+                ttl=int(self.env.get('FW_INVENTORY_CACHE_TTL', DEFAULT_FW_INVENTORY_CACHE_TTL))),
+            instrumentation=self.make_instrumentation(),
+            events=self.make_event_bus(),
+            progress_callback=lambda line: self.output(line, verbose_level=2)
         )
 
-        if print_path:
-            print("Path to Admin Tool:", FWAdminClient.get_admin_tool_path())
+        if use_command_cache is None:
+            use_command_cache = int(self.env.get('FW_ADMIN_COMMAND_CACHE', 0) or 0)
+        if use_command_cache:
+            # True selects the default number of slots, a number sets it
+            workers = 2 if use_command_cache is True else int(use_command_cache)
+            client.use_command_cache(max_workers=workers)
 
-        self.version = self.client.get_version()
-        self.major, self.minor, self.patch = self.version.split('.')
-        if int(self.major) < 10:
+        retries = int(self.env.get('FW_ADMIN_RETRIES', DEFAULT_FW_ADMIN_RETRIES) or 0)
+        if retries > 0:
+            client.retry_policy = RetryPolicy(max_attempts=retries + 1)
+        adaptive_concurrency = int(self.env.get('FW_ADMIN_ADAPTIVE_CONCURRENCY', 0) or 0)
+        if adaptive_concurrency > 0:
+            client.use_adaptive_limiter(max_limit=adaptive_concurrency)
+
+        model_update = str(self.env.get('FW_MODEL_UPDATE', '') or '').strip()
+        if model_update:
+            client.coalesce_model_updates(debounce=None if model_update == 'end' else float(model_update))
+        return client
+
+    def check_client(self, client):
+        """Checks the admin tool version and the fileset listing of the client's server.
+
+        Returns (version, can list filesets "Yes"/"No", status message,
+        exception or None); successful checks are reused for
+        FW_VALIDATION_CACHE_TTL seconds.  Raises ProcessorError for a FileWave
+        version before 10 unless FW_RELAX_VERSION is set.
+        """
+        validation_cache = ValidationCache(
+            ttl=int(self.env.get('FW_VALIDATION_CACHE_TTL', DEFAULT_FW_VALIDATION_CACHE_TTL)))
+        validation_key = ValidationCache.key_for(*client.connection_key, password=client.connection_password)
+        validation = validation_cache.get(validation_key)
+
+        version = validation['version'] if validation else client.get_version()
+        if int(version.split('.')[0]) < 10:
             if self.relaxed_version_check:
-                self.output("FileWave Version 10.0 must be installed - you have version %s" % (self.version))
+                self.output("FileWave Version 10.0 must be installed - you have version %s" % (version))
             else:
-                raise ProcessorError("FileWave Version 10.0 must be installed - you have version %s" % (self.version))
+                raise ProcessorError("FileWave Version 10.0 must be installed - you have version %s" % (version))
 
-        self.can_list_filesets = "No"
-        self.exit_status_message = "VALIDATION OK"
-        self.exception = None
+        if validation:
+            return version, validation['can_list_filesets'], "VALIDATION OK", None
 
+        can_list_filesets = "No"
+        exit_status_message = "VALIDATION OK"
+        exception = None
         try:
-            the_filesets = self.client.get_filesets()
-            count_filesets = sum(1 for i in the_filesets)
-            self.can_list_filesets = "Yes" if count_filesets >= 0 else "No"
+            can_list_filesets = "Yes" if client.can_list_filesets() else "No"
         except CalledProcessError as e:
-            self.exception = e
-            self.exit_status_message = FWAdminClient.ExitStatusDescription[e.returncode][1]
+            exception = e
+            exit_status_message = FWAdminClient.describe_exit_status(e.returncode)[1]
         except Exception as e:
-            self.exception = e
+            exception = e
+
+        if exception is None:
+            validation_cache.put(validation_key, {'version': version,
+                                                  'can_list_filesets': can_list_filesets})
+        return version, can_list_filesets, exit_status_message, exception
+
+    def server_targets(self):
+        """The servers listed in FW_SERVER_TARGETS as dicts of name, host, port, user and password.
+
+        Entries are 'host[:port]' strings (a comma separated string works too)
+        or dicts with any of those keys; what is left out comes from the
+        FW_SERVER_PORT, FW_ADMIN_USER and FW_ADMIN_PASSWORD settings.  Empty
+        when FW_SERVER_TARGETS isn't set.
+        """
+        entries = self.env.get('FW_SERVER_TARGETS') or []
+        if not isinstance(entries, (list, tuple)):
+            entries = [entry for entry in str(entries).split(',') if entry.strip()]
+        targets = []
+        for entry in entries:
+            if not isinstance(entry, dict):
+                host, _, port = entry.strip().partition(':')
+                entry = {'host': host, 'port': port}
+            if not entry.get('host'):
+                raise ProcessorError("FW_SERVER_TARGETS entry without a host: %s" % (entry,))
+            target = {
+                'host': entry['host'],
+                'port': str(entry.get('port') or self.env['FW_SERVER_PORT']),
+                'user': entry.get('user') or self.env['FW_ADMIN_USER'],
+                'password': entry.get('password') or self.env['FW_ADMIN_PASSWORD'],
+            }
+            target['name'] = entry.get('name') or "%s:%s" % (target['host'], target['port'])
+            targets.append(target)
+        return targets
+
+    def validate_tools(self, print_path=False, use_command_cache=None):
+
+        self.relaxed_version_check = self.env.get('FW_RELAX_VERSION', False)
+
+        self.client = self.make_client(self.env['FW_SERVER_HOST'],
+                                       self.env['FW_SERVER_PORT'],
+                                       self.env['FW_ADMIN_USER'],
+                                       self.env['FW_ADMIN_PASSWORD'],
+                                       use_command_cache=use_command_cache)
+
+        if print_path:
+            print("Path to Admin Tool:", FWAdminClient.get_admin_tool_path())
+
+        self.version, self.can_list_filesets, self.exit_status_message, self.exception = \
+            self.check_client(self.client)
+        self.major, self.minor, self.patch = self.version.split('.')
 
         if self.env['FW_ADMIN_USER'] == 'fwadmin':
             self.output("WARNING: You are using the FileWave super-user account (fwadmin)")
@@ -136,7 +330,8 @@ class FWTool(DmgMounter):
                               'fw_server_host',
                               'fw_server_port',
                               'fw_can_list_filesets',
-                              'fw_message'
+                              'fw_message',
+                              'fw_admin_timing'
                               ],
             'data': {
                 'fw_admin_console_version': self.version,
@@ -144,7 +339,8 @@ class FWTool(DmgMounter):
                 'fw_server_host': self.env['FW_SERVER_HOST'],
                 'fw_server_port': self.env['FW_SERVER_PORT'],
                 'fw_can_list_filesets': self.can_list_filesets,
-                'fw_message': self.exit_status_message
+                'fw_message': self.exit_status_message,
+                'fw_admin_timing': self.client.instrumentation.breakdown()
             }}
 
         if self.exception is not None:
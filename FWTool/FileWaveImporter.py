@@ -16,11 +16,12 @@
 """See docstring for FileWaveImporter class"""
 from __future__ import absolute_import, print_function
 
+import collections
 import glob
 import os
 import os.path
 import sys
-from distutils.version import LooseVersion
+from concurrent.futures import ThreadPoolExecutor
 
 from autopkglib import Processor, ProcessorError
 
@@ -28,7 +29,11 @@ from autopkglib import Processor, ProcessorError
 # this Processor was imported via autopkg explicitly, the directory is not in
 # the search path.
 sys.path.append(os.path.dirname(__file__))
-from CommandLine import FWAdminClient
+from CommandLine import FWAdminClient, get_group_resolver
+from ContentHash import CONTENT_DIGEST_PROPERTY, ContentHasher, settings_digest
+from DmgMountCache import DEFAULT_DMG_CACHE_MAX_BYTES, get_mount_cache
+from ExportPipeline import COMPRESSION_FORMATS, get_export_pipeline
+from ImportJournal import CREATED, DONE, PROPERTIES, STARTED, get_import_journal, reached
 from FWTool import COMMON_FILEWAVE_VARIABLES, FWTool
 
 
@@ -46,13 +51,43 @@ class FileWaveImporter(FWTool):
             "required": True,
             "description": "The file/folder that will be imported into the FileWave fileset, can be dmg, pkg or folder.",
         },
+        "fw_dmg_content_type": {
+            "default": None,
+            "required": False,
+            "description": "When fw_import_source is a dmg, the extension of the item inside it to import \
+            (e.g. 'app' or 'pkg').  The first match is imported straight from the mounted image, \
+            so no copy of it has to be made beforehand.",
+        },
+        "fw_dmg_content_name": {
+            "default": None,
+            "required": False,
+            "description": "When fw_import_source is a dmg, the name of the item inside it to import \
+            (e.g. 'Google Chrome.app').  Takes precedence over fw_dmg_content_type.",
+        },
+        "FW_DMG_CACHE_MAX_MB": {
+            "default": DEFAULT_DMG_CACHE_MAX_BYTES // (1024 * 1024),
+            "required": False,
+            "description": "Disk images are kept mounted (keyed by their checksum) for later recipes \
+            of the same autopkg run until the ones no longer in use add up to more than this many \
+            megabytes.  0 detaches every image as soon as its import is done.  Defaults to %d" \
+            % (DEFAULT_DMG_CACHE_MAX_BYTES // (1024 * 1024)),
+        },
         "fw_fileset_name": {
             "required": True,
             "description": "The name of the fileset to be created (will be made unique if it isnt already).",
         },
         "fw_fileset_group": {
             "required": False,
-            "description": "The name of the fileset group to import into - can be left blank, will be created if it does not exist.",
+            "description": "The name of the fileset group to import into - can be left blank, will be created if it does not exist. \
+            With fw_fileset_group_paths, nested groups are given as a path, e.g. 'Apps/Browsers'.",
+        },
+        "fw_fileset_group_paths": {
+            "default": False,
+            "required": False,
+            "description": "Treat a fw_fileset_group containing '/' as a path of nested groups that \
+            must already exist.  The import fails when the path doesn't exist, or when the name of its \
+            last group is shared by another group, as the admin tool only takes a group name.  Off \
+            by default, the group name is then passed to the admin tool unchanged.",
         },
         "fw_destination_root": {
             "default": FW_FILESET_DESTINATION,
@@ -62,7 +97,34 @@ class FileWaveImporter(FWTool):
         },
         "fw_export_fileset": {
             "required": False,
-            "description": "Should the fileset be exported to specified path",
+            "description": "Should the fileset be exported to specified path.  Exports run in the \
+            background (by fileset ID, with a checksum manifest written next to each export) and \
+            are finished before autopkg exits; nothing is exported when the import failed.",
+        },
+        "fw_export_compression": {
+            "default": "",
+            "required": False,
+            "description": "Compress the export into an archive of this format (%s).  Empty (the \
+            default) leaves the export as the admin tool wrote it." % ", ".join(COMPRESSION_FORMATS),
+        },
+        "fw_export_wait": {
+            "default": False,
+            "required": False,
+            "description": "Wait for the export to finish before the processor returns, so that \
+            fw_export_path is set.",
+        },
+        "FW_IMPORT_JOURNAL": {
+            "default": True,
+            "required": False,
+            "description": "Record every step of each import (started, fileset created, properties \
+            set, exported) in a SQLite journal, so that a rerun after a crash finishes the imports \
+            that were cut short with the filesets they already created.  True keeps the journal \
+            with the other caches, a path puts it there, false turns it off.",
+        },
+        "FW_EXPORT_WORKERS": {
+            "default": 2,
+            "required": False,
+            "description": "Number of exports that may run at the same time.  Defaults to 2",
         },
         "fw_app_bundle_id": {
             "default": None,
@@ -78,6 +140,14 @@ class FileWaveImporter(FWTool):
             "description": "This should be the CFBundleShortVersionString value \
                            from the apps Info.plist."
         },
+        "fw_skip_identical_content": {
+            "default": True,
+            "required": False,
+            "description": "Skip the import when a fileset with exactly the same content \
+            (by SHA-256 digest of the import source) already exists with the same destination \
+            root, fileset group and scripts.  The digest, covering those settings when they \
+            aren't the defaults, is stored on every imported fileset as the %s property." % CONTENT_DIGEST_PROPERTY
+        },
         "fw_fileset_activation_script": {
             "default": None,
             "required": False,
@@ -121,6 +191,18 @@ class FileWaveImporter(FWTool):
         "fw_fileset_id": {
             "description": "The resulting FileWave fileset ID for the newly created fileset."
         },
+        "fw_content_digest": {
+            "description": "The SHA-256 digest of the imported content (and of the destination \
+            root, fileset group and scripts when they aren't the defaults)."
+        },
+        "fw_server_results": {
+            "description": "With several FW_SERVER_TARGETS, one dict per server with its fw_server name, \
+            fw_status ('imported', 'satisfied', 'duplicate' or 'failed'), fw_fileset_id and \
+            fw_error.  Set on every run, even when no server needed an import."
+        },
+        "fw_export_path": {
+            "description": "Where the fileset was exported to (only set when fw_export_wait is true)."
+        },
         FILEWAVE_SUMMARY_RESULT: {
             "description": "Summary of what was imported into FileWave."
         }}
@@ -135,107 +217,362 @@ class FileWaveImporter(FWTool):
         return apps[0]
 
 
+    def find_in_dmg(self, mount_key, content_type=None, content_name=None):
+        """The item to import from a mounted dmg, by name or else by extension."""
+        path = self.mount_cache.find(mount_key, extension=content_type, name=content_name)
+        if path is None:
+            raise ProcessorError("No %s found in dmg" % (content_name or content_type))
+        return path
+
+    version_indexes = None
+    mount_cache = None
+
+    def get_version_index(self, client=None):
+        """The fileset index of the client's server for this run, built on first use."""
+        client = client or self.client
+        if self.version_indexes is None:
+            self.version_indexes = {}
+        if client.inventory_key not in self.version_indexes:
+            self.version_indexes[client.inventory_key] = client.get_version_index()
+        return self.version_indexes[client.inventory_key]
+
+    def export(self, fileset_id, fileset_name, destination, client=None, on_exported=None):
+        """Queues the export of the fileset, waiting for it when fw_export_wait is set.
+
+        on_exported is called once the export succeeded, wherever it ran.
+        """
+        pipeline = get_export_pipeline(client or self.client,
+                                       max_workers=int(self.env.get('FW_EXPORT_WORKERS', 2)),
+                                       compression=self.env.get('fw_export_compression', None))
+        future = pipeline.submit(fileset_id, fileset_name, destination)
+        if on_exported is not None:
+            future.add_done_callback(lambda done: done.result().ok and on_exported())
+        if not self.env.get('fw_export_wait', False):
+            self.output("Exporting fileset %s to %s in the background" % (fileset_id, destination))
+            return
+        result = future.result()
+        if not result.ok:
+            raise ProcessorError("Error exporting the fileset %s to %s.  Reason: %s" %
+                                 (fileset_id, destination, result.error))
+        self.env['fw_export_path'] = result.path
+        self.output("Exported fileset %s to %s" % (fileset_id, result.path))
+
+    def resolve_group(self, fileset_group, client=None):
+        """What to pass to the admin tool as the fileset group to import into.
+
+        A group name is passed on unchanged, the admin tool creates it when
+        it is missing.  Only with fw_fileset_group_paths set is a path of
+        nested groups checked against the existing groups and turned into
+        the name of its last group, which has to be unique.
+        """
+        if not fileset_group:
+            return None
+        if not self.env.get('fw_fileset_group_paths', False):
+            return fileset_group
+        resolver = get_group_resolver(client or self.client)
+        parts = resolver.split(fileset_group)
+        if len(parts) < 2:
+            return fileset_group
+        if resolver.lookup(fileset_group) is None:
+            raise ProcessorError("The fileset group '%s' does not exist, create it in FileWave Admin first" %
+                                 fileset_group)
+        if resolver.name_count(parts[-1]) > 1:
+            raise ProcessorError("The fileset group '%s' can't be imported into, another group is also "
+                                 "called '%s'" % (fileset_group, parts[-1]))
+        return parts[-1]
+
+    def import_settings(self, file_extension):
+        """The settings besides the content that make up an import, by variable name.
+
+        The destination root is left out when it is the default and for
+        packages, which aren't given one.
+        """
+        settings = {'fw_fileset_group': self.env.get('fw_fileset_group', None)}
+        if file_extension not in [ ".pkg", ".mpkg", ".msi" ]:
+            destination_root = self.env.get('fw_destination_root', FW_FILESET_DESTINATION)
+            if destination_root != FW_FILESET_DESTINATION:
+                settings['fw_destination_root'] = destination_root
+            for name in ('fw_fileset_activation_script', 'fw_fileset_requirements_script',
+                         'fw_fileset_preflight_script', 'fw_fileset_postflight_script',
+                         'fw_fileset_preuninstallation_script', 'fw_fileset_postuninstallation_script',
+                         'fw_fileset_verification_script'):
+                settings[name] = self.env.get(name, None)
+        return settings
+
+    def import_clients(self):
+        """(server name, client) pairs to import into: FW_SERVER_TARGETS, or the FW_SERVER_HOST client."""
+        targets = self.server_targets()
+        if not targets:
+            return [("%s:%s" % (self.env['FW_SERVER_HOST'], self.env['FW_SERVER_PORT']), self.client)]
+        return [(target['name'], self.make_client(target['host'], target['port'],
+                                                  target['user'], target['password']))
+                for target in targets]
+
+    journal = None
+    journal_job = None
+
+    def open_journal(self, import_source):
+        """Opens the import journal unless FW_IMPORT_JOURNAL is off, keyed on what this run imports.
+
+        The key covers the fileset name, app and version and the import
+        source with its modification time, so a new download is a new job.
+        """
+        setting = self.env.get('FW_IMPORT_JOURNAL', True)
+        if not setting or str(setting).lower() in ('0', 'false', 'no', 'off'):
+            return
+        self.journal = get_import_journal(None if str(setting).lower() in ('1', 'true', 'yes', 'on') else setting)
+        self.journal_job = self.journal.job_key(
+            self.env['fw_fileset_name'], self.env.get('fw_app_bundle_id', None),
+            self.env.get('fw_app_version', None), os.path.abspath(import_source),
+            int(os.path.getmtime(import_source)) if os.path.exists(import_source) else None)
+
+    def journal_record(self, client, step, fileset_id=None):
+        if self.journal is not None:
+            self.journal.record(client.inventory_key, self.journal_job, step, fileset_id)
+
+    def unfinished_import(self, client):
+        """(step, fileset ID) of an import into the client's server that a previous run didn't finish.
+
+        (None, None) when there is none, or its fileset has been removed since.
+        """
+        if self.journal is None:
+            return None, None
+        step, fileset_id = self.journal.unfinished(client.inventory_key, self.journal_job)
+        if fileset_id is not None and not any(fileset.id == fileset_id for fileset in client.get_filesets()):
+            self.journal.forget(client.inventory_key, self.journal_job)
+            return None, None
+        return step, fileset_id
+
+    def satisfying_fileset(self, client):
+        """The fileset already satisfying fw_app_bundle_id/fw_app_version on the client's server, or None."""
+        if self.unfinished_import(client)[1] is not None:
+            # its properties may already be set, the import still has to be finished
+            return None
+        bundle_id = self.env.get('fw_app_bundle_id', None)
+        version = self.env.get('fw_app_version', None)
+        if bundle_id is None or version is None:
+            return None
+        return self.get_version_index(client).is_satisfied(bundle_id, version)
+
+    def import_into(self, client, import_source, file_extension, content_digest):
+        """Imports the prepared payload into the client's server.
+
+        Returns (status, fileset ID) with status 'duplicate' or 'imported'; raises when nothing was imported.  Each step is recorded in
+        the journal, and the steps an earlier run already recorded are skipped.
+        """
+        fw_app_bundle_id = self.env.get('fw_app_bundle_id', None)
+        fw_app_version = self.env.get('fw_app_version', None)
+        check_version = fw_app_bundle_id is not None and fw_app_version is not None
+        fileset_name = self.env['fw_fileset_name']
+        destination_root = self.env.get('fw_destination_root',
+                                        FW_FILESET_DESTINATION)
+
+        step, fileset_id = self.unfinished_import(client)
+        if fileset_id is not None:
+            self.output("Resuming the import into fileset %s, left at step '%s' by an earlier run" %
+                        (fileset_id, step))
+
+        if fileset_id is None and self.env.get('fw_skip_identical_content', True):
+            fileset = self.get_version_index(client).with_digest(content_digest)
+            if fileset is not None:
+                print("This content is already imported as the fileset %s called '%s' (%s)" %\
+                      (fileset.id, fileset.name, content_digest))
+                return 'duplicate', fileset.id
+
+        if fileset_id is None:
+            self.journal_record(client, STARTED)
+            fileset_id = self.create_fileset(client, import_source, file_extension)
+            self.journal_record(client, CREATED, fileset_id)
+
+        if not reached(step, PROPERTIES):
+            if check_version:
+                # re-write the props back into the fileset
+                client.set_property(fileset_id, "autopkg_app_bundle_id", fw_app_bundle_id)
+                client.set_property(fileset_id, "autopkg_app_version", fw_app_version)
+
+            if content_digest is not None:
+                client.set_property(fileset_id, CONTENT_DIGEST_PROPERTY, content_digest)
+            self.journal_record(client, PROPERTIES)
+
+        export_fileset = self.env.get('fw_export_fileset', None)
+        if export_fileset:
+            self.export(fileset_id, fileset_name, export_fileset, client,
+                        on_exported=lambda: self.journal_record(client, DONE))
+        else:
+            self.journal_record(client, DONE)
+
+        return 'imported', fileset_id
+
+    def create_fileset(self, client, import_source, file_extension):
+        """Imports the payload as a new fileset and returns its ID; raises when nothing was imported."""
+        fileset_name = self.env['fw_fileset_name']
+        destination_root = self.env.get('fw_destination_root',
+                                        FW_FILESET_DESTINATION)
+        target_group = self.resolve_group(self.env.get('fw_fileset_group', None), client)
+
+        fileset_id = None
+        if file_extension in [ ".pkg", ".mpkg", ".msi" ]:
+            fileset_id = client.import_package(path=import_source,
+                                               name=fileset_name,
+                                               target=target_group)
+        elif os.path.isdir(import_source):
+            fileset_id = client.import_folder(path=import_source,
+                                              name=fileset_name,
+                                              root=destination_root,
+                                              target=target_group,
+                                              activation_script=self.env.get('fw_fileset_activation_script', None),
+                                              requirements_script=self.env.get('fw_fileset_requirements_script', None),
+                                              preflight_script=self.env.get('fw_fileset_preflight_script', None),
+                                              postflight_script=self.env.get('fw_fileset_postflight_script', None),
+                                              preuninstallation_script=self.env.get('fw_fileset_preuninstallation_script', None),
+                                              postuninstallation_script=self.env.get('fw_fileset_postuninstallation_script', None),
+                                              verification_script=self.env.get('fw_fileset_verification_script', None))
+
+        if fileset_id is None:
+            raise Exception("No fileset imported (error calling FileWave Admin Command Line Console)")
+        return fileset_id
+
     def main(self):
         self.validate_tools(print_path=False)
 
         fw_app_bundle_id = self.env.get('fw_app_bundle_id', None)
         fw_app_version = self.env.get('fw_app_version', None)
-        check_version = fw_app_bundle_id is not None and fw_app_version is not None
+        clients = self.import_clients()
+        fan_out = len(clients) > 1
+        self.open_journal(self.env['fw_import_source'])
+        results = collections.OrderedDict((name, {'fw_server': name}) for name, _ in clients)
+
+        def check(name, client):
+            # the FW_SERVER_HOST client was validated by validate_tools already
+            if client is not self.client:
+                exception = self.check_client(client)[3]
+                if exception is not None:
+                    raise exception
+            # perform version check against the existing filesets?
+            return self.satisfying_fileset(client)
 
-        # perform version check by scanning existing filesets?
-        if check_version:
-            filesets = self.client.get_filesets()
-            for fileset in filesets:
-                app_bundle_id = fileset.custom_properties.get("autopkg_app_bundle_id", None)
-                app_version = fileset.custom_properties.get("autopkg_app_version", None)
+        def run_check(target):
+            try:
+                return check(*target), None
+            except Exception as e:
+                return None, e
 
-                if app_bundle_id is not None and app_version is not None and \
-                                app_bundle_id == fw_app_bundle_id and \
-                                LooseVersion(app_version) >= LooseVersion(fw_app_version):
-                    print("This app version is already satisfied by the fileset %s called '%s' (%s, %s)" %\
-                          (fileset.id, fileset.name, fw_app_bundle_id, fw_app_version ))
-                    return
+        pending = []
+        with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+            for (name, client), (fileset, error) in zip(clients, executor.map(run_check, clients)):
+                if error is not None:
+                    if not fan_out:
+                        raise ProcessorError("%s: validation failed: %s" % (name, error))
+                    results[name].update(fw_status='failed', fw_error="validation failed: %s" % (error,))
+                elif fileset is None:
+                    pending.append((name, client))
+                else:
+                    print("%sThis app version is already satisfied by the fileset %s called '%s' (%s, %s)" %\
+                          ("%s: " % name if fan_out else "", fileset.id, fileset.name, fw_app_bundle_id, fw_app_version ))
+                    results[name].update(fw_status='satisfied', fw_fileset_id=fileset.id)
+        if not pending and not fan_out:
+            return
 
+        import_source = self.env['fw_import_source']
+        fileset_name = self.env['fw_fileset_name']
+        fileset_group = self.env.get('fw_fileset_group', None)
+        if pending:
+            import_source = self.import_pending(pending, results)
+
+        if FILEWAVE_SUMMARY_RESULT in self.env:
+            del self.env[FILEWAVE_SUMMARY_RESULT]
+
+        if fan_out:
+            self.env['fw_server_results'] = list(results.values())
+
+        failed = [result for result in results.values() if result['fw_status'] == 'failed']
+        done = [result for result in results.values() if result['fw_status'] == 'imported']
+        if done:
+            self.env['fw_fileset_id'] = done[0]['fw_fileset_id']
+        if done or fan_out:
+            data = {
+                'fw_fileset_id': done[0]['fw_fileset_id'] if done else '',
+                'fw_fileset_group': fileset_group if fileset_group is not None else "Root",
+                'fw_fileset_name': fileset_name,
+                'fw_admin_timing': clients[0][1].instrumentation.breakdown()
+            }
+            report_fields = ['fw_fileset_id', 'fw_fileset_group', 'fw_fileset_name', 'fw_admin_timing']
+            if fan_out:
+                data['fw_fileset_id'] = ", ".join("%s: %s" % (result['fw_server'], result.get('fw_fileset_id') or '-')
+                                                  for result in results.values())
+                data['fw_server_status'] = ", ".join("%s: %s" % (result['fw_server'], result['fw_status'])
+                                                     for result in results.values())
+                data['fw_admin_timing'] = "; ".join("%s: %s" % (name, client.instrumentation.breakdown())
+                                                    for name, client in clients)
+                report_fields.insert(1, 'fw_server_status')
+            self.env[FILEWAVE_SUMMARY_RESULT] = {
+                'summary_text': ('The following fileset was imported:' if done
+                                 else 'No fileset needed importing, per server:'),
+                'report_fields': report_fields,
+                'data': data
+            }
+
+        if failed:
+            raise ProcessorError("Error importing the folder '%s' into FileWave as a fileset called '%s'.  Reason: %s" %
+                                 (import_source, fileset_name,
+                                  "; ".join("%s%s" % ("%s: " % result['fw_server'] if fan_out else "", result['fw_error'])
+                                            for result in failed)))
+
+    def import_pending(self, pending, results):
+        """Prepares the payload once and imports it into the pending (name, client) pairs in parallel.
+
+        Records each server's outcome in results and returns the path that
+        was imported, which is inside the mounted dmg for dmg content.
+        """
         import_source = self.env['fw_import_source']
         if not os.path.exists(import_source):
             raise ProcessorError("Import source %s does not exist" %
                                  (import_source))
 
-        fileset_name = self.env['fw_fileset_name']
-        fileset_group = self.env.get('fw_fileset_group', None)
-        destination_root = self.env.get('fw_destination_root',
-                                        FW_FILESET_DESTINATION)
         find_type_in_dmg = self.env.get('fw_dmg_content_type', None)
-        fileset_activation_script = self.env.get('fw_fileset_activation_script', None)
-        fileset_requirements_script = self.env.get('fw_fileset_requirements_script', None)
-        fileset_preflight_script = self.env.get('fw_fileset_preflight_script', None)
-        fileset_postflight_script = self.env.get('fw_fileset_postflight_script', None)
-        fileset_preuninstallation_script = self.env.get('fw_fileset_preuninstallation_script', None)
-        fileset_postuninstallation_script = self.env.get('fw_fileset_postuninstallation_script', None)
-        fileset_verification_script = self.env.get('fw_fileset_verification_script', None)
+        find_name_in_dmg = self.env.get('fw_dmg_content_name', None)
+        skip_identical_content = self.env.get('fw_skip_identical_content', True)
 
-        fileset_id = None
-        dmg_mountpoint = None
+        mount_key = None
+        content_digest = None
         filename, file_extension = os.path.splitext(import_source)
 
         try:
-            if file_extension in [ ".dmg" ] and find_type_in_dmg is not None:
-                dmg_mountpoint = self.mount(import_source)
-                import_source = self.find_first_in_path(dmg_mountpoint, find_type_in_dmg)
-                file_extension = find_type_in_dmg
+            # the payload is prepared once, whatever the number of servers
+            if file_extension in [ ".dmg" ] and (find_type_in_dmg or find_name_in_dmg):
+                # the admin tool copies the content itself, so it is imported
+                # straight from the read-only mount instead of a copy of it
+                self.mount_cache = get_mount_cache(
+                    int(self.env.get('FW_DMG_CACHE_MAX_MB', DEFAULT_DMG_CACHE_MAX_BYTES // (1024 * 1024))) * 1024 * 1024)
+                mount_key, mountpoint = self.mount_cache.acquire(import_source, self)
+                import_source = self.find_in_dmg(mount_key, find_type_in_dmg, find_name_in_dmg)
+                file_extension = os.path.splitext(import_source)[1]
 
-            try:
-                if file_extension in [ ".pkg", ".mpkg", ".msi" ]:
-                    fileset_id = self.client.import_package(path=import_source,
-                                                       name=fileset_name,
-                                                       target=fileset_group)
-                elif os.path.isdir(import_source):
-                    fileset_id = self.client.import_folder(path=import_source,
-                                                      name=fileset_name,
-                                                      root=destination_root,
-                                                      target=fileset_group,
-                                                      activation_script=fileset_activation_script,
-                                                      requirements_script=fileset_requirements_script,
-                                                      preflight_script=fileset_preflight_script,
-                                                      postflight_script=fileset_postflight_script,
-                                                      preuninstallation_script=fileset_preuninstallation_script,
-                                                      postuninstallation_script=fileset_postuninstallation_script,
-                                                      verification_script=fileset_verification_script)
-
-                if FILEWAVE_SUMMARY_RESULT in self.env:
-                    del self.env[FILEWAVE_SUMMARY_RESULT]
-
-                if fileset_id is not None:
-                    self.env[FILEWAVE_SUMMARY_RESULT] = {
-                        'summary_text': 'The following fileset was imported:',
-                        'report_fields': ['fw_fileset_id', 'fw_fileset_group', 'fw_fileset_name'],
-                        'data': {
-                            'fw_fileset_id': fileset_id,
-                            'fw_fileset_group': fileset_group if fileset_group is not None else "Root",
-                            'fw_fileset_name': fileset_name
-                        }}
-
-                    self.env['fw_fileset_id'] = fileset_id
-                else:
-                    raise Exception("No fileset imported (error calling FileWave Admin Command Line Console)")
+            hasher = ContentHasher()
+            if mount_key is not None:
+                # the mount point changes with every mount, the dmg doesn't
+                hasher.alias(mountpoint, mount_key)
+            if skip_identical_content:
+                content_digest = hasher.digest(import_source)
+            if content_digest is not None:
+                content_digest = settings_digest(content_digest, self.import_settings(file_extension))
+                self.env['fw_content_digest'] = content_digest
 
-                if fileset_id is not None and check_version:
-                    # re-write the props back into the fileset
-                    self.client.set_property(fileset_id, "autopkg_app_bundle_id", fw_app_bundle_id)
-                    self.client.set_property(fileset_id, "autopkg_app_version", fw_app_version)
+            def run(name, client):
+                try:
+                    status, fileset_id = self.import_into(client, import_source, file_extension, content_digest)
+                    results[name].update(fw_status=status, fw_fileset_id=fileset_id)
+                except Exception as e:
+                    results[name].update(fw_status='failed', fw_error=str(e))
 
-            except Exception as e:
-                raise ProcessorError("Error importing the folder '%s' into FileWave as a fileset called '%s'.  Reason: %s" %
-                                     (import_source, fileset_name, e))
+            with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                for _ in executor.map(lambda target: run(*target), pending):
+                    pass
 
         finally:
-            if dmg_mountpoint is not None:
-                self.unmount(dmg_mountpoint)
-
-            export_fileset = self.env.get('fw_export_fileset', None)
-            if export_fileset is not None:
-                if export_fileset != "":
-                    self.client.export_fileset(export_fileset, fileset_name)
+            if mount_key is not None:
+                self.mount_cache.release(mount_key)
+        return import_source
 
 if __name__ == '__main__':
     PROCESSOR = FileWaveImporter()
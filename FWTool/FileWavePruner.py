@@ -0,0 +1,108 @@
+#!/usr/local/autopkg/python
+#
+# Copyright 2015 FileWave (Europe) GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""See docstring for FileWavePruner class"""
+from __future__ import absolute_import, print_function
+
+import os
+import os.path
+import sys
+
+from autopkglib import ProcessorError
+
+# Ensure that the FWAdminClient can be imported from CommandLine module, since
+# this Processor was imported via autopkg explicitly, the directory is not in
+# the search path.
+sys.path.append(os.path.dirname(__file__))
+from FWTool import COMMON_FILEWAVE_VARIABLES, FWTool
+
+FILEWAVE_PRUNE_SUMMARY_RESULT = 'filewave_prune_summary_result'
+DEFAULT_FW_PRUNE_KEEP = 3
+
+
+class FileWavePruner(FWTool):
+    """Removes superseded filesets imported by autopkg, keeping the newest versions of each app."""
+
+    description = __doc__
+
+    pruner_variables = {
+        "fw_app_bundle_id": {
+            "default": None,
+            "required": False,
+            "description": "Only prune the filesets of this app (the autopkg_app_bundle_id property). \
+            Defaults to every app imported by autopkg.",
+        },
+        "fw_prune_keep": {
+            "default": DEFAULT_FW_PRUNE_KEEP,
+            "required": False,
+            "description": "Number of the newest versions of each app to keep.  Older filesets that \
+            are still associated are kept as well.  Defaults to %d" % DEFAULT_FW_PRUNE_KEEP,
+        },
+        "fw_prune_dry_run": {
+            "default": False,
+            "required": False,
+            "description": "Only report which filesets would be removed.",
+        },
+        "fw_prune_workers": {
+            "default": 4,
+            "required": False,
+            "description": "Number of filesets removed at the same time.  Defaults to 4",
+        },
+    }
+
+    input_variables = dict(COMMON_FILEWAVE_VARIABLES, **pruner_variables)
+
+    output_variables = {
+        FILEWAVE_PRUNE_SUMMARY_RESULT: {
+            "description": "Summary of the filesets that were (or would be) removed."
+        }}
+
+    def main(self):
+        self.validate_tools(print_path=False)
+
+        bundle_id = self.env.get('fw_app_bundle_id', None)
+        setting = self.env.get('fw_prune_dry_run', False)
+        dry_run = bool(setting) and str(setting).lower() not in ('0', 'false', 'no', 'off')
+        result = self.client.prune_filesets(keep=int(self.env.get('fw_prune_keep', DEFAULT_FW_PRUNE_KEEP)),
+                                            bundle_ids=[bundle_id] if bundle_id else None,
+                                            max_workers=int(self.env.get('fw_prune_workers', 4)),
+                                            dry_run=dry_run)
+
+        failed = set(fileset.id for fileset, _ in result.errors)
+        removed = [fileset for _, filesets in sorted(result.removed.items())
+                   for fileset in filesets if fileset.id not in failed]
+        for fileset, error in result.errors:
+            self.output("Could not remove fileset %s (%s): %s" % (fileset.id, fileset.name, error))
+        self.output("Pruning %s: %s" % ("planned" if dry_run else "done", result))
+
+        if FILEWAVE_PRUNE_SUMMARY_RESULT in self.env:
+            del self.env[FILEWAVE_PRUNE_SUMMARY_RESULT]
+
+        if removed:
+            self.env[FILEWAVE_PRUNE_SUMMARY_RESULT] = {
+                'summary_text': 'The following filesets %s:' % ('would be removed' if dry_run else 'were removed'),
+                'report_fields': ['fw_fileset_ids', 'fw_fileset_names', 'fw_admin_timing'],
+                'data': {
+                    'fw_fileset_ids': ", ".join(fileset.id for fileset in removed),
+                    'fw_fileset_names': ", ".join(fileset.name for fileset in removed),
+                    'fw_admin_timing': self.client.instrumentation.breakdown()
+                }}
+
+        if result.errors and not removed:
+            raise ProcessorError("None of the %d superseded filesets could be removed" % len(result.errors))
+
+if __name__ == '__main__':
+    PROCESSOR = FileWavePruner()
+    PROCESSOR.execute_shell()
@@ -0,0 +1,123 @@
+from __future__ import absolute_import, print_function
+
+import atexit
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+from CommandLine import default_cache_dir
+
+# the steps of an import, in order; a job is finished once it is DONE
+STARTED = 'started'
+CREATED = 'created'
+PROPERTIES = 'properties'
+DONE = 'done'
+STEPS = (STARTED, CREATED, PROPERTIES, DONE)
+
+DEFAULT_JOURNAL_MAX_AGE = 30 * 24 * 60 * 60
+
+
+class ImportJournal(object):
+    """Durable record of how far each import got, so that a rerun can finish it.
+
+    A job is one import of one payload into one server (the server's
+    inventory key).  Every step is committed to a SQLite database before the
+    next one starts, so after a crash the journal knows the ID of a fileset
+    that was created but never got its properties, and a rerun picks it up
+    from there instead of importing again.  Entries older than max_age
+    seconds are dropped when the journal is opened.
+    """
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS jobs ("
+              " server TEXT NOT NULL,"
+              " job TEXT NOT NULL,"
+              " step TEXT NOT NULL,"
+              " fileset_id TEXT,"
+              " updated REAL NOT NULL,"
+              " PRIMARY KEY (server, job))")
+
+    def __init__(self, path=None, max_age=DEFAULT_JOURNAL_MAX_AGE):
+        self.path = path or os.path.join(default_cache_dir(), "import-journal.sqlite")
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            # WAL keeps committed steps safe across crashes and lets
+            # concurrent autopkg runs read while one of them writes
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(self.SCHEMA)
+            self._db.execute("DELETE FROM jobs WHERE updated < ?", (time.time() - max_age,))
+
+    @staticmethod
+    def job_key(*parts):
+        return "|".join("" if part is None else str(part) for part in parts)
+
+    def get(self, server, job):
+        """Returns (step, fileset ID) of the job, or (None, None) when it is unknown."""
+        with self._lock:
+            row = self._db.execute("SELECT step, fileset_id FROM jobs WHERE server = ? AND job = ?",
+                                   (server, job)).fetchone()
+        return tuple(row) if row else (None, None)
+
+    def unfinished(self, server, job):
+        """(step, fileset ID) of a job that created its fileset but isn't DONE, or (None, None)."""
+        step, fileset_id = self.get(server, job)
+        if step == DONE or fileset_id is None:
+            return None, None
+        return step, fileset_id
+
+    def record(self, server, job, step, fileset_id=None):
+        """Commits that the job reached step; a missing fileset_id keeps the one recorded before."""
+        if step not in STEPS:
+            raise ValueError("Unknown import step %s" % step)
+        with self._lock, self._db:
+            if step == STARTED:
+                # a new attempt, whatever an earlier one got to
+                self._db.execute("DELETE FROM jobs WHERE server = ? AND job = ?", (server, job))
+            self._db.execute("INSERT OR REPLACE INTO jobs (server, job, step, fileset_id, updated) "
+                             "VALUES (?, ?, ?, COALESCE(?, (SELECT fileset_id FROM jobs "
+                             "WHERE server = ? AND job = ?)), ?)",
+                             (server, job, step, fileset_id, server, job, time.time()))
+
+    def forget(self, server, job):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM jobs WHERE server = ? AND job = ?", (server, job))
+
+    def pending(self):
+        """(server, job, step, fileset ID) of every job that isn't DONE."""
+        with self._lock:
+            return [tuple(row) for row in self._db.execute(
+                "SELECT server, job, step, fileset_id FROM jobs WHERE step != ? ORDER BY updated", (DONE,))]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def reached(step, goal):
+    """Whether a job at step has already done goal."""
+    return step is not None and STEPS.index(step) >= STEPS.index(goal)
+
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def get_import_journal(path=None):
+    """The journal at path shared by all processors of this autopkg run, closed at exit."""
+    with _journals_lock:
+        if path not in _journals:
+            if not _journals:
+                atexit.register(_close_journals)
+            _journals[path] = ImportJournal(path)
+        return _journals[path]
+
+
+def _close_journals():
+    with _journals_lock:
+        for journal in _journals.values():
+            journal.close()
+        _journals.clear()
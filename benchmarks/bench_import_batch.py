@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Import throughput of FWAdminClient.import_batch against the fake admin tool.
+
+    $ python benchmarks/bench_import_batch.py --imports 32 --latency 0.2 --workers 1 4 8
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+sys.path.insert(0, HERE)
+
+import fake_admin
+from CommandLine import FWAdminClient
+
+
+def run(imports, workers):
+    client = FWAdminClient()
+    created = []
+    client.create_fs_callback = created.append
+    specs = [{'path': '/tmp/payload-%d' % i, 'name': 'Payload %d' % i, 'root': '/Applications'}
+             for i in range(imports)]
+    start = time.time()
+    results = client.import_batch(specs, max_workers=workers)
+    elapsed = time.time() - start
+    failed = [r for r in results if not r.ok]
+    if failed or len(created) != imports:
+        raise Exception("%d imports failed, %d callbacks fired" % (len(failed), len(created)))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--imports', type=int, default=32)
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help="seconds the fake admin tool spends on each import")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="fwbench")
+    try:
+        os.environ["FILEWAVE_ADMIN_PATH"] = fake_admin.install(work_dir)
+        os.environ["FAKE_ADMIN_STATE"] = work_dir
+        os.environ["FAKE_ADMIN_LATENCY"] = str(args.latency)
+
+        print("%-8s %10s %12s" % ("workers", "seconds", "imports/s"))
+        for workers in args.workers:
+            elapsed = run(args.imports, workers)
+            print("%-8d %10.2f %12.1f" % (workers, elapsed, args.imports / elapsed))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
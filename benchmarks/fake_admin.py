@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""Stand-in for the FileWave Admin command line, used by the benchmarks.
+
+It understands the verbs FWAdminClient sends and answers them without a
+server.  Its behaviour is driven by environment variables:
+
+    FAKE_ADMIN_LATENCY       seconds every call that changes the server takes (0)
+    FAKE_ADMIN_LIST_LATENCY  seconds every listing takes on top of printing it (0)
+    FAKE_ADMIN_FILESETS      number of filesets --listFilesets reports (0)
+    FAKE_ADMIN_CLIENTS       number of clients --listClients reports (0)
+    FAKE_ADMIN_ASSOCIATIONS  number of associations --listAssociations reports (0)
+    FAKE_ADMIN_DEPTH         depth of the nested group chain of both trees (1)
+    FAKE_ADMIN_BUNDLES       number of distinct autopkg bundle ids (10)
+    FAKE_ADMIN_UNVERSIONED   every Nth fileset has no autopkg_app_version (none)
+    FAKE_ADMIN_ERROR_RATE    fraction of calls failing with kExitDBError (0)
+    FAKE_ADMIN_CAPACITY      calls running at once beyond which calls fail with
+                             kExitDBError, like an overloaded server (unlimited)
+    FAKE_ADMIN_DOWN_HOSTS    comma separated server hosts (-H) whose calls all fail
+                             with kExitLoginError (none)
+    FAKE_ADMIN_STATE         directory for the id counter and generated listings
+
+install() lays out an admin 'installation' that FILEWAVE_ADMIN_PATH can
+point at.
+"""
+from __future__ import absolute_import, print_function
+
+import json
+import os
+import os.path
+import platform
+import random
+import shutil
+import stat
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+VERSION = "13.1.0"
+
+EXIT_DB_ERROR = 105
+EXIT_LOGIN_ERROR = 108
+
+# verbs that only read from the server
+READ_VERBS = ('-v', '-h', '--listFilesets', '--listClients', '--listAssociations')
+
+
+def install(directory):
+    """Creates the platform specific admin executable below directory and returns directory."""
+    system_name = platform.system()
+    if 'Darwin' == system_name:
+        executable = os.path.join(directory, "FileWave Admin.app", "Contents", "MacOS", "FileWave Admin")
+    elif 'Windows' == system_name:
+        raise Exception("The fake admin tool is not supported on Windows")
+    else:
+        executable = os.path.join(directory, "FileWaveAdmin")
+
+    if not os.path.isdir(os.path.dirname(executable)):
+        os.makedirs(os.path.dirname(executable))
+    with open(executable, 'w') as f:
+        f.write("#!/bin/sh\nexec '%s' '%s' \"$@\"\n" % (sys.executable, os.path.abspath(__file__)))
+    os.chmod(executable, os.stat(executable).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return directory
+
+
+def next_id(state_dir):
+    """Hands out increasing fileset ids, safe across concurrent fake admin processes."""
+    import fcntl
+    path = os.path.join(state_dir, "next_id")
+    with open(path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        value = int(f.read() or 1000)
+        f.seek(0)
+        f.truncate()
+        f.write(str(value + 1))
+    return value
+
+
+def env_int(name, default=0):
+    return int(os.environ.get(name, default))
+
+
+def write_tree(f, count, depth, make_node, group_type):
+    """Writes count leaves spread over a chain of depth nested groups as a JSON tree.
+
+    The JSON is written piece by piece so any depth works.
+    """
+    depth = max(1, depth)
+    per_level = count // depth
+    leaf_id = depth + 1
+    f.write('[')
+    for level in range(depth):
+        group_id = level + 1
+        group = {'id': group_id, 'name': 'Group %d' % group_id, 'type': group_type,
+                 'parent_id': level, 'size': 0, 'custom_properties': {}}
+        f.write(json.dumps(group)[:-1] + ', "children": [')
+        leaves = per_level if level < depth - 1 else count - per_level * (depth - 1)
+        for i in range(leaves):
+            if i:
+                f.write(', ')
+            f.write(json.dumps(make_node(leaf_id, group_id)))
+            leaf_id += 1
+        if level < depth - 1 and leaves:
+            f.write(', ')
+    f.write(']}' * depth + ']\n')
+
+
+def fileset_node(bundles, unversioned=0):
+    def make_node(fileset_id, parent_id):
+        bundle = fileset_id % bundles
+        properties = {'autopkg_app_bundle_id': 'com.example.app%d' % bundle,
+                      'autopkg_app_version': '1.%d' % (fileset_id // bundles)}
+        if unversioned and fileset_id % unversioned == 0:
+            del properties['autopkg_app_version']
+        return {'id': fileset_id, 'name': 'App %d - %d' % (bundle, fileset_id), 'type': 'fileset',
+                'size': 1024 * fileset_id, 'parent_id': parent_id, 'isCritical': False,
+                'custom_properties': properties}
+    return make_node
+
+
+def client_node(client_id, parent_id):
+    return {'id': client_id, 'name': 'client-%d' % client_id, 'type': 'client', 'parent_id': parent_id}
+
+
+def write_listing(verb, f):
+    depth = env_int("FAKE_ADMIN_DEPTH", 1)
+    if verb == '--listFilesets':
+        write_tree(f, env_int("FAKE_ADMIN_FILESETS"), depth,
+                   fileset_node(max(1, env_int("FAKE_ADMIN_BUNDLES", 10)), env_int("FAKE_ADMIN_UNVERSIONED")),
+                   'group')
+    elif verb == '--listClients':
+        write_tree(f, env_int("FAKE_ADMIN_CLIENTS"), depth, client_node, 'group')
+    else:
+        # leaf ids start after the group chain, see write_tree
+        count = env_int("FAKE_ADMIN_ASSOCIATIONS")
+        clients = max(1, env_int("FAKE_ADMIN_CLIENTS", 1))
+        filesets = max(1, env_int("FAKE_ADMIN_FILESETS", 1))
+        f.write('[')
+        for i in range(count):
+            if i:
+                f.write(', ')
+            f.write(json.dumps({'assoc_id': i + 1, 'client_id': (i * 7) % clients + depth + 1,
+                                'fileset_id': (i * 13) % filesets + depth + 1,
+                                'kiosk': i % 5 == 0, 'sw_update': False}))
+        f.write(']\n')
+
+
+def print_listing(verb, state_dir):
+    """Prints the synthetic listing, generating it once per parameter set."""
+    parameters = "-".join(os.environ.get(name, '') for name in (
+        "FAKE_ADMIN_FILESETS", "FAKE_ADMIN_CLIENTS", "FAKE_ADMIN_ASSOCIATIONS",
+        "FAKE_ADMIN_DEPTH", "FAKE_ADMIN_BUNDLES", "FAKE_ADMIN_UNVERSIONED"))
+    path = os.path.join(state_dir, "listing%s-%s.json" % (verb, parameters))
+    if not os.path.exists(path):
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            write_listing(verb, f)
+        os.rename(tmp_path, path)
+    sys.stdout.flush()
+    with open(path, 'rb') as f:
+        shutil.copyfileobj(f, getattr(sys.stdout, 'buffer', sys.stdout))
+    time.sleep(float(os.environ.get("FAKE_ADMIN_LIST_LATENCY", "0")))
+
+
+def split_arguments(argv):
+    """Drops the connection options and returns (verb, remaining arguments)."""
+    arguments = []
+    it = iter(argv)
+    for arg in it:
+        if arg in ('-u', '-p', '-H', '-P'):
+            next(it, None)
+        else:
+            arguments.append(arg)
+    if not arguments:
+        return None, []
+    return arguments[0], arguments[1:]
+
+
+def option_value(arguments, option, default=None):
+    if option in arguments:
+        return arguments[arguments.index(option) + 1]
+    return default
+
+
+def overloaded(state_dir):
+    """Registers this call as running and tells whether more than FAKE_ADMIN_CAPACITY are."""
+    capacity = env_int("FAKE_ADMIN_CAPACITY")
+    if not capacity:
+        return False
+    running_dir = os.path.join(state_dir, "running")
+    os.makedirs(running_dir, exist_ok=True)
+    marker = os.path.join(running_dir, str(os.getpid()))
+    open(marker, 'w').close()
+    # slow enough calls overlap, so the ones around right now are the load
+    time.sleep(0.01)
+    return len(os.listdir(running_dir)) > capacity
+
+
+def main(argv):
+    verb, arguments = split_arguments(argv)
+    state_dir = os.environ.get("FAKE_ADMIN_STATE", HERE)
+    if option_value(argv, '-H') in os.environ.get("FAKE_ADMIN_DOWN_HOSTS", "").split(','):
+        sys.stderr.write("Login Error or Version Mismatch\n")
+        return EXIT_LOGIN_ERROR
+    try:
+        return run(verb, arguments, state_dir)
+    finally:
+        marker = os.path.join(state_dir, "running", str(os.getpid()))
+        if os.path.exists(marker):
+            os.remove(marker)
+
+
+def run(verb, arguments, state_dir):
+    if overloaded(state_dir) or random.random() < float(os.environ.get("FAKE_ADMIN_ERROR_RATE", "0")):
+        time.sleep(float(os.environ.get("FAKE_ADMIN_LATENCY", "0")) / 2)
+        sys.stderr.write("Database internal error\n")
+        return EXIT_DB_ERROR
+
+    if verb not in READ_VERBS:
+        time.sleep(float(os.environ.get("FAKE_ADMIN_LATENCY", "0")))
+
+    if verb == '-v':
+        print(VERSION)
+    elif verb == '-h':
+        print("FileWave Admin (fake) %s" % VERSION)
+    elif verb in ('--listFilesets', '--listClients', '--listAssociations'):
+        print_listing(verb, state_dir)
+    elif verb in ('--importFolder', '--importPackage', '--importFileset'):
+        print("new fileset with ID %d was created" % next_id(state_dir))
+    elif verb == '--importImage':
+        print("new imaging fileset with ID %d was created" % next_id(state_dir))
+    elif verb == '--createFileset':
+        print("new fileset %d created with name %s" % (next_id(state_dir), arguments[0]))
+    elif verb == '--exportFileset':
+        fileset = option_value(arguments, '--fileset')
+        exported = os.path.join(arguments[0], "%s.fileset" % (option_value(arguments, '--name') or fileset))
+        if os.path.isdir(arguments[0]):
+            if not os.path.isdir(exported):
+                os.makedirs(exported)
+            with open(os.path.join(exported, "fileset.plist"), 'w') as f:
+                f.write("fileset %s\n" % fileset)
+        print("the fileset with ID %s was exported to '%s'" % (fileset, exported))
+    elif verb in ('--fileset', '--createAssociation', '--deleteAssociation', '--deleteFileset',
+                  '--updateModel'):
+        pass
+    else:
+        sys.stderr.write("Unknown option %s\n" % verb)
+        return 111
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""Benchmarks CommandLine.py and the FileWave processors against the fake admin tool.
+
+Every run is appended to benchmarks/results.jsonl together with the current
+git revision; each benchmark is compared with the best earlier run of the
+same size and reported as a regression when it is slower by more than
+--threshold.
+
+    $ python benchmarks/run_benchmarks.py --filesets 20000 --depth 50
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+sys.path.insert(0, HERE)
+
+import bench_import_batch
+import fake_admin
+from CommandLine import FilesetInventoryCache, FWAdminClient
+
+RESULTS_PATH = os.path.join(HERE, "results.jsonl")
+
+
+def timed(function, repeat):
+    """Best wall time of repeat calls of function."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_get_filesets():
+    client = FWAdminClient()
+    return sum(1 for _ in client.get_filesets())
+
+
+def bench_get_filesets_stream():
+    client = FWAdminClient()
+    return sum(1 for _ in client.get_filesets(stream=True))
+
+
+def bench_get_fileset_table():
+    return len(FWAdminClient().get_fileset_table())
+
+
+def bench_get_clients_stream():
+    return sum(1 for _ in FWAdminClient().get_clients(stream=True))
+
+
+def bench_version_check():
+    index = FWAdminClient().get_version_index()
+    for bundle in range(100):
+        index.is_satisfied('com.example.app%d' % bundle, '1.5')
+
+
+def bench_version_check_cached(cache):
+    def run():
+        client = FWAdminClient(inventory_cache=cache)
+        index = client.get_version_index()
+        for bundle in range(100):
+            index.is_satisfied('com.example.app%d' % bundle, '1.5')
+    return run
+
+
+def bench_validate_tools():
+    """FWTool.validate_tools as a processor runs it, None when autopkglib is missing."""
+    try:
+        from FWTool import COMMON_FILEWAVE_VARIABLES, FWTool
+    except ImportError:
+        return None
+    env = dict((name, spec['default']) for name, spec in COMMON_FILEWAVE_VARIABLES.items())
+
+    def run():
+        processor = FWTool(env=dict(env))
+        processor.validate_tools()
+    return run
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(size_key):
+    history = []
+    if os.path.exists(RESULTS_PATH):
+        with open(RESULTS_PATH) as f:
+            for line in f:
+                run = json.loads(line)
+                if run.get('size') == size_key:
+                    history.append(run)
+    return history
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--filesets', type=int, default=10000)
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--associations', type=int, default=10000)
+    parser.add_argument('--depth', type=int, default=10)
+    parser.add_argument('--bundles', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="seconds the fake admin tool spends on each change")
+    parser.add_argument('--imports', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="relative slowdown reported as a regression")
+    parser.add_argument('--no-save', action='store_true', help="don't append to results.jsonl")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="fwbench")
+    try:
+        os.environ.update({
+            "FILEWAVE_ADMIN_PATH": fake_admin.install(work_dir),
+            "FILEWAVE_CACHE_DIR": os.path.join(work_dir, "cache"),
+            "FAKE_ADMIN_STATE": work_dir,
+            "FAKE_ADMIN_LATENCY": str(args.latency),
+            "FAKE_ADMIN_FILESETS": str(args.filesets),
+            "FAKE_ADMIN_CLIENTS": str(args.clients),
+            "FAKE_ADMIN_ASSOCIATIONS": str(args.associations),
+            "FAKE_ADMIN_DEPTH": str(args.depth),
+            "FAKE_ADMIN_BUNDLES": str(args.bundles),
+        })
+
+        benchmarks = [
+            ('get_filesets', bench_get_filesets),
+            ('get_filesets_stream', bench_get_filesets_stream),
+            ('get_fileset_table', bench_get_fileset_table),
+            ('get_clients_stream', bench_get_clients_stream),
+            ('version_check', bench_version_check),
+            ('version_check_cached', bench_version_check_cached(FilesetInventoryCache(ttl=3600))),
+            ('validate_tools', bench_validate_tools()),
+            ('import_batch', lambda: bench_import_batch.run(args.imports, args.workers)),
+        ]
+
+        # the first listing generates the synthetic inventory, keep it out of the timings
+        bench_get_filesets()
+        bench_get_clients_stream()
+
+        size_key = "f%d-c%d-a%d-d%d-b%d-l%s-i%d-w%d" % (
+            args.filesets, args.clients, args.associations, args.depth, args.bundles,
+            args.latency, args.imports, args.workers)
+        history = load_history(size_key)
+
+        results = {}
+        print("%-24s %10s %10s  %s" % ("benchmark", "seconds", "best", ""))
+        for name, function in benchmarks:
+            if function is None:
+                print("%-24s %10s" % (name, "skipped"))
+                continue
+            seconds = timed(function, args.repeat)
+            results[name] = seconds
+            previous = [run['results'][name] for run in history if name in run['results']]
+            best = min(previous) if previous else None
+            flag = ""
+            if best is not None and seconds > best * (1 + args.threshold):
+                flag = "REGRESSION (+%d%%)" % ((seconds / best - 1) * 100)
+            print("%-24s %10.3f %10s  %s" % (name, seconds, "%.3f" % best if best is not None else "-", flag))
+
+        if not args.no_save:
+            with open(RESULTS_PATH, 'a') as f:
+                f.write(json.dumps({'time': time.time(), 'revision': git_revision(),
+                                    'size': size_key, 'results': results}, sort_keys=True) + "\n")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""AdaptiveLimiter and RetryPolicy, alone and around the fake admin tool.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from subprocess import CalledProcessError
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+sys.path.insert(0, os.path.join(HERE, "..", "benchmarks"))
+
+import fake_admin
+from CommandLine import AdaptiveLimiter, FWAdminClient, RetryPolicy
+
+DB_ERROR, MODEL_UPDATE_ERROR, LOGIN_ERROR, FILESET_NOT_EXISTS = 105, 107, 108, 101
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+
+    def test_initial_limit(self):
+        self.assertEqual(AdaptiveLimiter(max_limit=8).stats()['limit'], 4)
+        self.assertEqual(AdaptiveLimiter(max_limit=8, initial_limit=20).stats()['limit'], 8)
+        self.assertEqual(AdaptiveLimiter(min_limit=3, max_limit=8, initial_limit=1).stats()['limit'], 3)
+
+    def test_grows_about_one_slot_per_round(self):
+        limiter = AdaptiveLimiter(max_limit=8, initial_limit=2)
+        for _ in range(2):
+            limiter.release(limiter.acquire(), 0.01)
+        self.assertEqual(limiter.stats()['limit'], 2)
+        for _ in range(2):
+            limiter.release(limiter.acquire(), 0.01)
+        self.assertEqual(limiter.stats()['limit'], 3)
+        for _ in range(100):
+            limiter.release(limiter.acquire(), 0.01)
+        self.assertEqual(limiter.stats()['limit'], 8)
+
+    def test_overload_backs_off_once_per_round(self):
+        limiter = AdaptiveLimiter(max_limit=8, initial_limit=8)
+        tokens = [limiter.acquire() for _ in range(8)]
+        for token in tokens:
+            limiter.release(token, 0.01, overloaded=True)
+        self.assertEqual(limiter.stats(), {'limit': 4, 'calls': 8, 'overloads': 8, 'decreases': 1})
+        limiter.release(limiter.acquire(), 0.01, overloaded=True)
+        self.assertEqual(limiter.stats()['limit'], 2)
+
+    def test_never_below_min_limit(self):
+        limiter = AdaptiveLimiter(min_limit=2, max_limit=8)
+        for _ in range(10):
+            limiter.release(limiter.acquire(), 0.01, overloaded=True)
+        self.assertEqual(limiter.stats()['limit'], 2)
+
+    def test_slow_calls_count_as_overloaded(self):
+        limiter = AdaptiveLimiter(max_limit=8, initial_limit=4, latency_target=0.5)
+        limiter.release(limiter.acquire(), 0.1)
+        self.assertEqual(limiter.stats()['overloads'], 0)
+        limiter.release(limiter.acquire(), 2.0)
+        self.assertEqual(limiter.stats()['overloads'], 1)
+        self.assertEqual(limiter.stats()['limit'], 2)
+
+    def test_limits_concurrent_calls(self):
+        limiter = AdaptiveLimiter(max_limit=3, initial_limit=3)
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def call():
+            token = limiter.acquire()
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            limiter.release(token, 0.01)
+
+        threads = [threading.Thread(target=call) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(running[1], 3)
+        self.assertEqual(limiter.in_flight, 0)
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_idempotent_verbs_retry_on_transient_errors(self):
+        policy = RetryPolicy()
+        for returncode in (DB_ERROR, MODEL_UPDATE_ERROR, LOGIN_ERROR):
+            self.assertIsNotNone(policy.delay(0, returncode, '--listFilesets'))
+            self.assertIsNotNone(policy.delay(0, returncode, '--setProperty'))
+
+    def test_changes_only_retry_on_login_errors(self):
+        policy = RetryPolicy()
+        for verb in ('--importFolder', '--importPackage', '--createFileset', '--createAssociation',
+                     '--deleteFileset'):
+            self.assertIsNone(policy.delay(0, DB_ERROR, verb))
+            self.assertIsNone(policy.delay(0, MODEL_UPDATE_ERROR, verb))
+            self.assertIsNotNone(policy.delay(0, LOGIN_ERROR, verb))
+
+    def test_other_errors_are_not_retried(self):
+        self.assertIsNone(RetryPolicy().delay(0, FILESET_NOT_EXISTS, '--listFilesets'))
+
+    def test_attempts_and_delays(self):
+        policy = RetryPolicy(max_attempts=3, base_delay=1.0, max_delay=1.5)
+        for _ in range(50):
+            self.assertTrue(0 <= policy.delay(0, DB_ERROR, '-v') <= 1.0)
+            self.assertTrue(0 <= policy.delay(1, DB_ERROR, '-v') <= 1.5)
+        self.assertIsNone(policy.delay(2, DB_ERROR, '-v'))
+
+
+class FakeAdminTest(unittest.TestCase):
+    """Limiter slots and retries of real admin calls, against benchmarks/fake_admin.py."""
+
+    ENVIRONMENT = ('FILEWAVE_ADMIN_PATH', 'FAKE_ADMIN_STATE', 'FAKE_ADMIN_FILESETS', 'FAKE_ADMIN_ERROR_RATE')
+
+    def setUp(self):
+        self.saved = dict((name, os.environ.get(name)) for name in self.ENVIRONMENT)
+        self.dir = tempfile.mkdtemp()
+        os.environ['FILEWAVE_ADMIN_PATH'] = fake_admin.install(self.dir)
+        os.environ['FAKE_ADMIN_STATE'] = self.dir
+        os.environ['FAKE_ADMIN_FILESETS'] = '50'
+        self.client = FWAdminClient(retry_policy=RetryPolicy(max_attempts=3, base_delay=0.01))
+        self.client.limiter = AdaptiveLimiter(max_limit=4)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        shutil.rmtree(self.dir)
+
+    def test_streamed_listing(self):
+        os.environ['FAKE_ADMIN_ERROR_RATE'] = '0'
+        self.assertEqual(len(self.client.get_fileset_table(use_cache=False)), 51)
+        self.assertTrue(self.client.can_list_filesets())
+        self.assertEqual(self.client.limiter.in_flight, 0)
+        self.assertEqual(self.client.limiter.calls, 2)
+
+    def test_streamed_listing_is_retried(self):
+        os.environ['FAKE_ADMIN_ERROR_RATE'] = '1'
+        with self.assertRaises(CalledProcessError):
+            self.client.get_fileset_table(use_cache=False)
+        record = self.client.instrumentation.records[-1]
+        self.assertEqual((record.verb, record.exit_code, record.retries), ('--listFilesets', DB_ERROR, 2))
+        self.assertEqual(self.client.limiter.in_flight, 0)
+        self.assertEqual(self.client.limiter.overloads, 3)
+
+    def test_import_is_not_retried_after_a_database_error(self):
+        os.environ['FAKE_ADMIN_ERROR_RATE'] = '1'
+        with self.assertRaises(CalledProcessError):
+            self.client.import_folder(self.dir, name='Test', root='/Applications')
+        record = self.client.instrumentation.records[-1]
+        self.assertEqual((record.verb, record.retries), ('--importFolder', 0))
+        self.assertEqual(self.client.limiter.in_flight, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+"""AdminCommandCache: cached version queries, shared listings and bounded launches, alone and around the fake admin tool.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from subprocess import CalledProcessError
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+sys.path.insert(0, os.path.join(HERE, "..", "benchmarks"))
+
+import CommandLine as command_line
+import fake_admin
+from CommandLine import AdminCommandCache, FWAdminClient, get_command_cache
+
+ADMIN = ['/Applications/FileWave/FileWave Admin.app/Contents/MacOS/FileWave Admin', '-u', 'fwadmin',
+         '-p', 'filewave', '-H', 'localhost', '-P', '20016']
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class FakeLaunches(object):
+    """Stands in for AdminCommandCache._launch, optionally holding every launch until released."""
+
+    def __init__(self, block=False, error=None):
+        self.commands = []
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+        self.error = error
+
+    def __call__(self, process_options):
+        self.commands.append(process_options)
+        self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return ("output %d" % len(self.commands)).encode('utf-8')
+
+
+class AdminCommandCacheTest(unittest.TestCase):
+
+    def cache(self, launches, max_workers=2):
+        cache = AdminCommandCache(max_workers=max_workers)
+        cache._launch = launches
+        return cache
+
+    def in_threads(self, call, count, results=None):
+        results = [] if results is None else results
+        threads = [threading.Thread(target=lambda: results.append(call())) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_version_queries_run_once_per_command_line(self):
+        launches = FakeLaunches()
+        cache = self.cache(launches)
+        self.assertEqual(cache.check_output(ADMIN + ['-v']), b'output 1')
+        self.assertEqual(cache.check_output(ADMIN + ['-v']), b'output 1')
+        self.assertEqual(cache.check_output(ADMIN[:-1] + ['20017', '-v']), b'output 2')
+        self.assertEqual((len(launches.commands), cache.memo_hits), (2, 1))
+
+    def test_other_commands_always_run(self):
+        launches = FakeLaunches()
+        cache = self.cache(launches)
+        for command in (['--listFilesets'], ['--listFilesets'], ['--createFileset', 'Test'],
+                        ['--createFileset', 'Test']):
+            cache.check_output(ADMIN + command)
+        self.assertEqual(len(launches.commands), 4)
+        self.assertEqual((cache.memo_hits, cache.shared_hits), (0, 0))
+
+    def test_concurrent_identical_listings_share_one_launch(self):
+        launches = FakeLaunches(block=True)
+        cache = self.cache(launches)
+        threads, results = self.in_threads(lambda: cache.check_output(ADMIN + ['--listFilesets']), 1)
+        self.assertTrue(wait_until(lambda: launches.commands))
+        more_threads, _ = self.in_threads(lambda: cache.check_output(ADMIN + ['--listFilesets']), 2, results)
+        self.assertTrue(wait_until(lambda: cache.shared_hits == 2))
+        launches.release.set()
+        for thread in threads + more_threads:
+            thread.join()
+        self.assertEqual(results, [b'output 1'] * 3)
+        self.assertEqual(len(launches.commands), 1)
+
+    def test_waiting_callers_get_the_error(self):
+        launches = FakeLaunches(block=True, error=CalledProcessError(105, ADMIN, output=b'Database error'))
+        cache = self.cache(launches)
+        errors = []
+
+        def list_filesets():
+            try:
+                cache.check_output(ADMIN + ['--listFilesets'])
+            except CalledProcessError as e:
+                errors.append(e.returncode)
+        threads, _ = self.in_threads(list_filesets, 1)
+        self.assertTrue(wait_until(lambda: launches.commands))
+        more_threads, _ = self.in_threads(list_filesets, 1)
+        self.assertTrue(wait_until(lambda: cache.shared_hits == 1))
+        launches.release.set()
+        for thread in threads + more_threads:
+            thread.join()
+        self.assertEqual(errors, [105, 105])
+        # failures are not kept
+        launches.error = None
+        self.assertEqual(cache.check_output(ADMIN + ['--listFilesets']), b'output 2')
+
+    def test_launches_are_bounded(self):
+        cache = AdminCommandCache(max_workers=2)
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def run():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+        threads, _ = self.in_threads(lambda: cache.launch(run), 6)
+        for thread in threads:
+            thread.join()
+        self.assertEqual((running[1], cache.launches), (2, 6))
+
+
+class CommandCacheClientTest(unittest.TestCase):
+
+    ENVIRONMENT = ('FILEWAVE_ADMIN_PATH', 'FAKE_ADMIN_STATE', 'FAKE_ADMIN_ERROR_RATE')
+
+    def setUp(self):
+        self.saved = dict((name, os.environ.get(name)) for name in self.ENVIRONMENT)
+        self.dir = tempfile.mkdtemp()
+        os.environ['FILEWAVE_ADMIN_PATH'] = fake_admin.install(os.path.join(self.dir, "admin"))
+        os.environ['FAKE_ADMIN_STATE'] = os.path.join(self.dir, "admin")
+        os.environ['FAKE_ADMIN_ERROR_RATE'] = '0'
+        self.saved_caches = dict(command_line._command_caches)
+        command_line._command_caches.clear()
+
+    def tearDown(self):
+        command_line._command_caches.clear()
+        command_line._command_caches.update(self.saved_caches)
+        for name, value in self.saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        shutil.rmtree(self.dir)
+
+    def test_clients_of_one_connection_share_the_cache(self):
+        first, second, other_user = FWAdminClient(), FWAdminClient(), FWAdminClient(admin_name='autopkg')
+        cache = first.use_command_cache()
+        self.assertIs(second.use_command_cache(), cache)
+        self.assertIs(get_command_cache(first.connection_key), cache)
+        self.assertIsNot(other_user.use_command_cache(), cache)
+        self.assertEqual(first.get_version(), second.get_version())
+        self.assertEqual((cache.launches, cache.memo_hits), (1, 1))
+
+    def test_every_other_command_starts_the_admin_tool(self):
+        client = FWAdminClient()
+        cache = client.use_command_cache()
+        client.run_admin(['--createFileset', 'First'])
+        client.run_admin(['--createFileset', 'Second'])
+        client.run_admin(['--listFilesets'])
+        client.run_admin(['--listFilesets'])
+        self.assertEqual(cache.launches, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
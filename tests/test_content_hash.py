@@ -0,0 +1,183 @@
+"""ContentHasher and how FileWaveImporter skips content that is already imported.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+
+from CommandLine import Fileset, FilesetVersionIndex
+from ContentHash import CONTENT_DIGEST_PROPERTY, ContentHasher, settings_digest
+
+try:
+    from FileWaveImporter import FileWaveImporter
+except ImportError:
+    # autopkglib only exists inside autopkg
+    FileWaveImporter = None
+
+
+def write(path, content, executable=False):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+    os.chmod(path, 0o755 if executable else 0o644)
+
+
+class ContentHasherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.app = os.path.join(self.dir, "Test.app")
+        write(os.path.join(self.app, "Contents", "Info.plist"), "<plist/>")
+        write(os.path.join(self.app, "Contents", "MacOS", "Test"), "binary", executable=True)
+        self.cache_path = os.path.join(self.dir, "cache", "content-hashes.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def digest(self, path=None):
+        return ContentHasher(cache_path=self.cache_path).digest(path or self.app)
+
+    def test_same_tree_same_digest(self):
+        digest = self.digest()
+        self.assertTrue(digest.startswith('sha256:'))
+        copy = os.path.join(self.dir, "Copy.app")
+        shutil.copytree(self.app, copy)
+        self.assertEqual(self.digest(copy), digest)
+
+    def test_digest_covers_content_modes_names_and_links(self):
+        digest = self.digest()
+        changes = [
+            lambda: write(os.path.join(self.app, "Contents", "Info.plist"), "<plist></plist>"),
+            lambda: os.chmod(os.path.join(self.app, "Contents", "Info.plist"), 0o755),
+            lambda: os.rename(os.path.join(self.app, "Contents", "Info.plist"),
+                              os.path.join(self.app, "Contents", "Other.plist")),
+            lambda: os.symlink("MacOS/Test", os.path.join(self.app, "Contents", "link")),
+            lambda: os.makedirs(os.path.join(self.app, "Contents", "Resources")),
+        ]
+        seen = set([digest])
+        for change in changes:
+            change()
+            digest = self.digest()
+            self.assertNotIn(digest, seen)
+            seen.add(digest)
+
+    def test_single_file(self):
+        path = os.path.join(self.dir, "Test.pkg")
+        write(path, "payload")
+        self.assertEqual(self.digest(path),
+                         'sha256:239f59ed55e737c77147cf55ad0c1b030b6d7ee748a7426952f9b852d5a935e5')
+
+    def test_unchanged_files_are_not_read_again(self):
+        first = ContentHasher(cache_path=self.cache_path)
+        digest = first.digest(self.app)
+        self.assertEqual((first.files_hashed, first.files_cached), (2, 0))
+        second = ContentHasher(cache_path=self.cache_path)
+        self.assertEqual(second.digest(self.app), digest)
+        self.assertEqual((second.files_hashed, second.files_cached), (0, 2))
+
+    def test_aliased_folders_share_cache_entries(self):
+        hasher = ContentHasher(cache_path=self.cache_path)
+        hasher.alias(self.app, 'dmg-1')
+        expected = hasher.digest(self.app)
+        # the same dmg mounted somewhere else
+        moved = os.path.join(self.dir, "mount-2", "Test.app")
+        shutil.copytree(self.app, moved)
+        for root, dirs, files in os.walk(self.app):
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                os.utime(os.path.join(moved, os.path.relpath(path, self.app)), ns=(st.st_atime_ns, st.st_mtime_ns))
+        hasher = ContentHasher(cache_path=self.cache_path)
+        hasher.alias(moved, 'dmg-1')
+        self.assertEqual(hasher.digest(moved), expected)
+        self.assertEqual(hasher.files_hashed, 0)
+
+    def test_oldest_cache_entries_are_dropped(self):
+        for i in range(5):
+            write(os.path.join(self.dir, "files", "%d" % i), "%d" % i)
+        hasher = ContentHasher(cache_path=self.cache_path, max_entries=3)
+        hasher.digest(os.path.join(self.dir, "files"))
+        self.assertEqual(len(ContentHasher(cache_path=self.cache_path)._load_cache()), 3)
+
+    def test_settings_digest(self):
+        digest = 'sha256:abc'
+        self.assertEqual(settings_digest(digest, {'fw_fileset_group': None, 'fw_destination_root': ''}), digest)
+        grouped = settings_digest(digest, {'fw_fileset_group': 'Browsers'})
+        self.assertNotEqual(grouped, digest)
+        self.assertEqual(settings_digest(digest, {'fw_fileset_group': 'Browsers', 'other': None}), grouped)
+        self.assertNotEqual(settings_digest(digest, {'fw_fileset_group': 'Editors'}), grouped)
+
+
+class RecordingClient(object):
+    """Just enough of FWAdminClient for FileWaveImporter.import_into."""
+
+    inventory_key = 'server'
+
+    def __init__(self, filesets=()):
+        self.filesets = list(filesets)
+        self.properties = []
+
+    def get_filesets(self, use_cache=True, stream=False):
+        return iter(self.filesets)
+
+    def get_version_index(self, use_cache=True):
+        return FilesetVersionIndex(self.filesets)
+
+    def set_property(self, fileset_id, name, value):
+        self.properties.append((fileset_id, name, value))
+
+
+@unittest.skipIf(FileWaveImporter is None, "autopkglib is not installed")
+class SkipIdenticalContentTest(unittest.TestCase):
+
+    DIGEST = 'sha256:abc'
+
+    def importer(self, **env):
+        defaults = dict((name, spec.get('default')) for name, spec in FileWaveImporter.input_variables.items())
+        defaults.update(fw_import_source='/tmp/Test.app', fw_fileset_name='Test', fw_export_fileset=None,
+                        FW_IMPORT_JOURNAL=False)
+        defaults.update(env)
+        importer = FileWaveImporter(defaults)
+        self.created = []
+
+        def create_fileset(client, import_source, file_extension):
+            self.created.append(import_source)
+            return '1001'
+        importer.create_fileset = create_fileset
+        return importer
+
+    def client(self):
+        return RecordingClient([Fileset(id='7', name='Test', type='fileset', size=0, parent_id=None,
+                                        custom_properties={CONTENT_DIGEST_PROPERTY: self.DIGEST})])
+
+    def test_on_by_default(self):
+        self.assertIs(FileWaveImporter.input_variables['fw_skip_identical_content']['default'], True)
+
+    def test_identical_content_is_not_imported_again(self):
+        self.assertEqual(self.importer().import_into(self.client(), '/tmp/Test.app', '.app', self.DIGEST),
+                         ('duplicate', '7'))
+        self.assertEqual(self.created, [])
+
+    def test_new_content_is_imported_and_tagged(self):
+        client = self.client()
+        self.assertEqual(self.importer().import_into(client, '/tmp/Test.app', '.app', 'sha256:def'),
+                         ('imported', '1001'))
+        self.assertEqual(client.properties, [('1001', CONTENT_DIGEST_PROPERTY, 'sha256:def')])
+
+    def test_turned_off(self):
+        importer = self.importer(fw_skip_identical_content=False)
+        self.assertEqual(importer.import_into(self.client(), '/tmp/Test.app', '.app', self.DIGEST),
+                         ('imported', '1001'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+"""DeploymentResolver: which clients get which filesets, by hand and against benchmarks/fake_admin.py.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+sys.path.insert(0, os.path.join(HERE, "..", "benchmarks"))
+
+from CommandLine import Association, Client, DeploymentResolver
+from test_inventory_cache import FakeAdminTestCase
+
+
+def group(id, parent_id=None):
+    return Client(id, 'Group %s' % id, 'group', parent_id)
+
+
+def device(id, parent_id=None):
+    return Client(id, 'client-%s' % id, 'client', parent_id)
+
+
+class DeploymentResolverTest(unittest.TestCase):
+    """All (1) holds Lab (2) with devices 3 and 4, device 5 and the empty group 6; device 7 has no group."""
+
+    def setUp(self):
+        self.resolver = DeploymentResolver(
+            [group(1), group(2, 1), device(3, 2), device(4, 2), device(5, 1), group(6, 1), device(7)],
+            [Association(10, 2, 100), Association(11, 5, 100), Association(12, 1, 200, kiosk=True),
+             Association(13, 3, 300, sw_update=True)])
+
+    def test_ancestors(self):
+        self.assertEqual(self.resolver.ancestors(3), ['3', '2', '1'])
+        self.assertEqual(self.resolver.ancestors('7'), ['7'])
+
+    def test_what_a_device_gets(self):
+        self.assertEqual(self.resolver.filesets_for(3), set(['100', '200', '300']))
+        self.assertEqual(self.resolver.filesets_for(5), set(['100', '200']))
+        self.assertEqual(self.resolver.filesets_for(7), set())
+        self.assertEqual(sorted((assoc.id, assoc.client_id, assoc.kiosk, assoc.sw_update)
+                                for assoc in self.resolver.deployments_for(3)),
+                         [('10', '2', False, False), ('12', '1', True, False), ('13', '3', False, True)])
+        self.assertTrue(self.resolver.receives(4, 100))
+        self.assertFalse(self.resolver.receives(4, 300))
+        self.assertFalse(self.resolver.receives(7, 100))
+
+    def test_who_gets_a_fileset(self):
+        # groups themselves never receive anything, overlapping targets count once
+        self.assertEqual(self.resolver.clients_for(100), ['3', '4', '5'])
+        self.assertEqual(self.resolver.clients_for(200), ['3', '4', '5'])
+        self.assertEqual(self.resolver.clients_for(300), ['3'])
+        self.assertEqual(self.resolver.clients_for(404), [])
+        self.assertEqual(self.resolver.count_clients_for(100), 3)
+        self.assertFalse(self.resolver.is_device(6))
+
+    def test_associations_change_in_place(self):
+        self.resolver.add_association(Association(14, 7, 300))
+        self.resolver.remove_association(13)
+        self.assertEqual(self.resolver.clients_for(300), ['7'])
+        self.assertEqual(self.resolver.filesets_for(3), set(['100', '200']))
+        # re-adding an ID replaces the association
+        self.resolver.add_association(Association(14, 6, 300))
+        self.assertEqual(self.resolver.clients_for(300), [])
+        self.resolver.remove_association(404)
+
+    def test_clients_change(self):
+        self.assertEqual(self.resolver.clients_for(200), ['3', '4', '5'])
+        self.resolver.add_client(device(8, 6))
+        self.resolver.add_client(device(4))
+        self.assertEqual(self.resolver.clients_for(200), ['3', '5', '8'])
+        self.assertEqual(self.resolver.ancestors(4), ['4'])
+        self.resolver.remove_client(2)
+        self.assertEqual(self.resolver.filesets_for(3), set(['300']))
+        self.assertEqual(self.resolver.clients_for(100), ['5'])
+        self.resolver.remove_client(404)
+
+
+class ResolverMatchesListingsTest(FakeAdminTestCase):
+    """The resolver answers what walking the listings client by client would."""
+
+    ENVIRONMENT = FakeAdminTestCase.ENVIRONMENT + ('FAKE_ADMIN_CLIENTS', 'FAKE_ADMIN_ASSOCIATIONS',
+                                                   'FAKE_ADMIN_DEPTH')
+
+    def setUp(self):
+        super(ResolverMatchesListingsTest, self).setUp()
+        os.environ['FAKE_ADMIN_CLIENTS'] = '60'
+        os.environ['FAKE_ADMIN_ASSOCIATIONS'] = '40'
+        os.environ['FAKE_ADMIN_DEPTH'] = '4'
+
+    def test_against_a_scan(self):
+        resolver = self.client.get_deployment_resolver()
+        clients = list(self.client.get_clients())
+        associations = list(self.client.get_associations())
+        # the fake admin only targets devices, some groups get filesets too
+        for assoc in (Association(1001, 2, 5), Association(1002, 4, 6)):
+            resolver.add_association(assoc)
+            associations.append(assoc)
+        self.assertEqual(len(resolver.parents), 64)
+
+        parents = dict((client.id, client.parent_id) for client in clients)
+        groups = set(client.id for client in clients if client.type == 'group')
+
+        def chain(client_id):
+            while client_id in parents:
+                yield client_id
+                client_id = parents[client_id]
+
+        for fileset_id in set(assoc.fileset_id for assoc in associations):
+            targets = set(assoc.client_id for assoc in associations if assoc.fileset_id == fileset_id)
+            expected = [client.id for client in clients if client.id not in groups
+                        and targets.intersection(chain(client.id))]
+            self.assertEqual(sorted(resolver.clients_for(fileset_id)), sorted(expected), fileset_id)
+            self.assertEqual(resolver.count_clients_for(fileset_id), len(expected))
+        for client in clients:
+            expected = set(assoc.fileset_id for assoc in associations if assoc.client_id in set(chain(client.id)))
+            self.assertEqual(resolver.filesets_for(client.id), expected, client.id)
+
+    def test_tables_and_records_agree(self):
+        from_tables = self.client.get_deployment_resolver()
+        from_records = DeploymentResolver(list(self.client.get_clients()), list(self.client.get_associations()))
+        self.assertEqual(from_tables.parents, from_records.parents)
+        for fileset_id in range(5, 25):
+            self.assertEqual(from_tables.clients_for(fileset_id), from_records.clients_for(fileset_id))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+"""DmgMountCache: sharing, keeping and detaching disk image mounts, with a stand-in for DmgMounter.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+
+import DmgMountCache as dmg_mount_cache
+from ContentHash import ContentHasher
+from DmgMountCache import DEFAULT_DMG_CACHE_MAX_BYTES, DmgMountCache, get_mount_cache
+
+
+class FakeMounter(object):
+    """Mounts a 'dmg' by creating a folder with the content listed in the file."""
+
+    def __init__(self, root):
+        self.root = root
+        self.mounted = {}
+        self.mounts = 0
+        self.unmounts = []
+
+    def mount(self, pathname):
+        if pathname in self.mounted:
+            raise Exception("%s is already mounted" % pathname)
+        self.mounts += 1
+        mountpoint = os.path.join(self.root, "mount-%d" % self.mounts)
+        with open(pathname) as f:
+            for rel_path in f.read().split():
+                path = os.path.join(mountpoint, rel_path)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+        self.mounted[pathname] = mountpoint
+        return mountpoint
+
+    def unmount(self, pathname):
+        shutil.rmtree(self.mounted.pop(pathname))
+        self.unmounts.append(pathname)
+
+
+class DmgMountCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.mounter = FakeMounter(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def cache(self, max_bytes=DEFAULT_DMG_CACHE_MAX_BYTES):
+        hasher = ContentHasher(cache_path=os.path.join(self.dir, "hashes.json"))
+        return DmgMountCache(max_bytes=max_bytes, hasher=hasher)
+
+    def dmg(self, name, *content):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write("\n".join(content or ("Test.app",)))
+        return path
+
+    def test_default_keeps_4_gigabytes(self):
+        self.assertEqual(DEFAULT_DMG_CACHE_MAX_BYTES, 4096 * 1024 * 1024)
+
+    def test_released_images_stay_mounted(self):
+        cache = self.cache()
+        dmg = self.dmg("Test.dmg")
+        key, mountpoint = cache.acquire(dmg, self.mounter)
+        cache.release(key)
+        self.assertTrue(os.path.isdir(mountpoint))
+        self.assertEqual(cache.acquire(dmg, self.mounter), (key, mountpoint))
+        self.assertEqual((self.mounter.mounts, cache.stats()['reused']), (1, 1))
+
+    def test_same_image_at_another_path_shares_the_mount(self):
+        cache = self.cache()
+        first = cache.acquire(self.dmg("Test.dmg"), self.mounter)
+        second = cache.acquire(self.dmg("Copy of Test.dmg"), self.mounter)
+        self.assertEqual(first, second)
+        self.assertEqual(cache.stats()['in_use'], 1)
+
+    def test_idle_images_over_the_limit_are_detached_oldest_first(self):
+        first, second, third = (self.dmg("%d.dmg" % i, "App%d.app" % i) for i in range(3))
+        size = os.path.getsize(first)
+        cache = self.cache(max_bytes=2 * size)
+        keys = [cache.acquire(dmg, self.mounter)[0] for dmg in (first, second, third)]
+        for key in keys:
+            cache.release(key)
+        self.assertEqual(self.mounter.unmounts, [first])
+        self.assertEqual(cache.stats()['mounts'], 2)
+
+    def test_images_in_use_are_never_detached(self):
+        cache = self.cache(max_bytes=0)
+        dmg = self.dmg("Test.dmg")
+        key, mountpoint = cache.acquire(dmg, self.mounter)
+        cache.acquire(dmg, self.mounter)
+        cache.release(key)
+        self.assertTrue(os.path.isdir(mountpoint))
+        cache.release(key)
+        self.assertFalse(os.path.isdir(mountpoint))
+        self.assertEqual(self.mounter.unmounts, [dmg])
+
+    def test_image_detached_behind_the_cache_is_mounted_again(self):
+        cache = self.cache()
+        dmg = self.dmg("Test.dmg")
+        key, mountpoint = cache.acquire(dmg, self.mounter)
+        cache.release(key)
+        self.mounter.unmount(dmg)
+        self.assertNotEqual(cache.acquire(dmg, self.mounter)[1], mountpoint)
+        self.assertEqual(self.mounter.mounts, 2)
+
+    def test_new_image_at_the_same_path_replaces_the_old_mount(self):
+        cache = self.cache()
+        dmg = self.dmg("Test.dmg", "Old.app")
+        key = cache.acquire(dmg, self.mounter)[0]
+        cache.release(key)
+        self.dmg("Test.dmg", "New.app")
+        new_key, mountpoint = cache.acquire(dmg, self.mounter)
+        self.assertNotEqual(new_key, key)
+        self.assertTrue(os.path.isdir(os.path.join(mountpoint, "New.app")))
+        self.assertEqual(cache.stats()['mounts'], 1)
+
+    def test_clear_and_close(self):
+        cache = self.cache()
+        idle = cache.acquire(self.dmg("Idle.dmg", "Idle.app"), self.mounter)[0]
+        cache.release(idle)
+        cache.acquire(self.dmg("Busy.dmg", "Busy.app"), self.mounter)
+        cache.clear()
+        self.assertEqual(cache.stats()['mounts'], 1)
+        cache.close()
+        self.assertEqual(cache.stats()['mounts'], 0)
+        self.assertEqual(self.mounter.mounted, {})
+
+    def test_find(self):
+        cache = self.cache()
+        key, mountpoint = cache.acquire(self.dmg("Test.dmg", "App.app", "Payload/Deep.pkg", "Payload/More/Deeper.pkg",
+                                     "Extras.app/Contents/Hidden.pkg"), self.mounter)
+        self.assertTrue(cache.find(key, extension="app").endswith("/App.app"))
+        self.assertTrue(cache.find(key, extension=".pkg").endswith("/Payload/Deep.pkg"))
+        self.assertTrue(cache.find(key, name="Deeper.pkg", max_depth=3).endswith("/Payload/More/Deeper.pkg"))
+        self.assertIsNone(cache.find(key, name="Deeper.pkg"))
+        # bundles aren't searched
+        self.assertIsNone(cache.find(key, name="Hidden.pkg", max_depth=3))
+        # remembered with the mount
+        shutil.rmtree(os.path.join(mountpoint, "Payload"))
+        self.assertTrue(cache.find(key, extension=".pkg").endswith("/Payload/Deep.pkg"))
+
+
+class SharedMountCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved, dmg_mount_cache._cache = dmg_mount_cache._cache, None
+
+    def tearDown(self):
+        dmg_mount_cache._cache = self.saved
+
+    def test_one_cache_per_run(self):
+        cache = get_mount_cache()
+        self.assertEqual(cache.max_bytes, DEFAULT_DMG_CACHE_MAX_BYTES)
+        self.assertIs(get_mount_cache(1024), cache)
+        self.assertEqual(cache.max_bytes, 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
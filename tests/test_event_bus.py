@@ -0,0 +1,342 @@
+"""AdminEventBus, its sinks, and the fs callbacks running next to it.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+sys.path.insert(0, os.path.join(HERE, "..", "benchmarks"))
+
+import fake_admin
+from CommandLine import (FILESET_CREATED, FILESET_REMOVED, AdminEventBus, FWAdminClient, JsonLinesEventSink,
+                         SocketEventSink)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.005)
+
+
+class Recorder(object):
+    """Subscriber keeping the batches it got, optionally blocking until released."""
+
+    def __init__(self, blocked=False):
+        self.batches = []
+        self.released = threading.Event()
+        if not blocked:
+            self.released.set()
+
+    def __call__(self, events):
+        self.released.wait()
+        self.batches.append(events)
+
+    @property
+    def fileset_ids(self):
+        return [event.fileset_id for batch in self.batches for event in batch]
+
+
+class AdminEventBusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.buses = []
+
+    def tearDown(self):
+        for bus in self.buses:
+            bus.close(timeout=1.0)
+
+    def bus(self, **kwargs):
+        bus = AdminEventBus(**kwargs)
+        self.buses.append(bus)
+        return bus
+
+    def test_nothing_is_queued_without_subscribers(self):
+        bus = self.bus()
+        self.assertIsNone(bus.publish(FILESET_CREATED, 'server', '1'))
+        self.assertEqual(bus.stats()['published'], 0)
+
+    def test_events_arrive_in_order_and_in_batches(self):
+        bus = self.bus(batch_size=10, flush_interval=5.0)
+        recorder = Recorder()
+        bus.subscribe(recorder)
+        for i in range(25):
+            bus.publish(FILESET_CREATED, 'server', str(i), name='Fileset %d' % i)
+        self.assertTrue(bus.flush(timeout=5.0))
+        self.assertEqual(recorder.fileset_ids, [str(i) for i in range(25)])
+        self.assertEqual([len(batch) for batch in recorder.batches], [10, 10, 5])
+        event = recorder.batches[0][0]
+        self.assertEqual((event.kind, event.server, event.data), (FILESET_CREATED, 'server', {'name': 'Fileset 0'}))
+
+    def test_unbatched_subscriber(self):
+        bus = self.bus()
+        events = []
+        bus.subscribe(events.append, batched=False)
+        bus.publish(FILESET_REMOVED, 'server', '1')
+        bus.flush(timeout=5.0)
+        self.assertEqual([(event.kind, event.fileset_id) for event in events], [(FILESET_REMOVED, '1')])
+
+    def test_full_queue_drops_the_oldest_events(self):
+        bus = self.bus(max_queue=3, batch_size=1, flush_interval=0)
+        recorder = Recorder(blocked=True)
+        bus.subscribe(recorder)
+        bus.publish(FILESET_CREATED, 'server', '0')
+        # the first event is being delivered, the rest has to queue up
+        wait_for(lambda: bus.stats()['queued'] == 1 and not bus._queue)
+        for i in range(1, 8):
+            bus.publish(FILESET_CREATED, 'server', str(i))
+        stats = bus.stats()
+        self.assertEqual((stats['dropped'], stats['queued'], stats['max_queued']), (4, 4, 3))
+
+        recorder.released.set()
+        self.assertTrue(bus.flush(timeout=5.0))
+        self.assertEqual(recorder.fileset_ids, ['0', '5', '6', '7'])
+        self.assertEqual(bus.stats()['delivered'], 4)
+
+    def test_publishing_never_waits_for_subscribers(self):
+        bus = self.bus(max_queue=10)
+        recorder = Recorder(blocked=True)
+        bus.subscribe(recorder)
+        started = time.time()
+        for i in range(1000):
+            bus.publish(FILESET_CREATED, 'server', str(i))
+        self.assertLess(time.time() - started, 2.0)
+        self.assertFalse(bus.flush(timeout=0.05))
+        recorder.released.set()
+
+    def test_failing_subscriber_doesnt_affect_the_others(self):
+        bus = self.bus()
+
+        def failing(events):
+            raise Exception("sink is down")
+        recorder = Recorder()
+        bus.subscribe(failing)
+        bus.subscribe(recorder)
+        bus.publish(FILESET_CREATED, 'server', '1')
+        bus.flush(timeout=5.0)
+        self.assertEqual(recorder.fileset_ids, ['1'])
+        self.assertEqual(bus.stats()['errors'], 1)
+
+    def test_unsubscribe(self):
+        bus = self.bus()
+        recorder = Recorder()
+        bus.subscribe(recorder)
+        bus.unsubscribe(bus.subscribe(Recorder()))
+        self.assertEqual(bus.stats()['subscribers'], 1)
+
+    def test_close_delivers_what_is_queued(self):
+        bus = self.bus(flush_interval=5.0)
+        recorder = Recorder()
+        bus.subscribe(recorder)
+        bus.publish(FILESET_CREATED, 'server', '1')
+        bus.close()
+        self.assertEqual(recorder.fileset_ids, ['1'])
+        bus.publish(FILESET_CREATED, 'server', '2')
+        self.assertEqual(bus.stats()['dropped'], 1)
+
+
+class JsonLinesEventSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "events.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_appends_one_line_per_event(self):
+        bus = AdminEventBus()
+        bus.subscribe(JsonLinesEventSink(self.path))
+        bus.publish(FILESET_CREATED, 'fw:20016', '1', name='Firefox')
+        bus.publish(FILESET_REMOVED, 'fw:20016', '2')
+        bus.close()
+        bus = AdminEventBus()
+        bus.subscribe(JsonLinesEventSink(self.path))
+        bus.publish(FILESET_REMOVED, 'fw:20016', '3')
+        bus.close()
+
+        with open(self.path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual([(event['kind'], event['fileset_id']) for event in events],
+                         [(FILESET_CREATED, '1'), (FILESET_REMOVED, '2'), (FILESET_REMOVED, '3')])
+        self.assertEqual(events[0]['name'], 'Firefox')
+        self.assertEqual(events[0]['server'], 'fw:20016')
+        self.assertIsInstance(events[0]['time'], float)
+
+
+class LineServer(object):
+    """A Unix socket server collecting the lines sent to it.
+
+    Each connection is read once reading is set; close_first closes the
+    first connection without reading from it.
+    """
+
+    def __init__(self, path, close_first=False):
+        self.path = path
+        self.lines = []
+        self.connections = 0
+        self.reading = threading.Event()
+        self.reading.set()
+        self.close_first = close_first
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(5)
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                connection, _ = self._server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            if self.close_first and self.connections == 1:
+                connection.close()
+                continue
+            self.reading.wait()
+            data = b''
+            while True:
+                chunk = connection.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            connection.close()
+            self.lines.extend(json.loads(line) for line in data.decode('utf-8').splitlines())
+
+    def close(self):
+        self._server.close()
+
+
+class SocketEventSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "events.sock")
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.close()
+        shutil.rmtree(self.dir)
+
+    def test_sends_json_lines(self):
+        self.server = LineServer(self.path)
+        sink = SocketEventSink(self.path)
+        bus = AdminEventBus()
+        bus.subscribe(sink)
+        for i in range(3):
+            bus.publish(FILESET_CREATED, 'fw:20016', str(i))
+        bus.close()
+        sink.close()
+        wait_for(lambda: len(self.server.lines) == 3)
+        self.assertEqual([line['fileset_id'] for line in self.server.lines], ['0', '1', '2'])
+        self.assertEqual(self.server.connections, 1)
+
+    def test_unreachable_socket(self):
+        sink = SocketEventSink(self.path)
+        recorder = Recorder()
+        bus = AdminEventBus()
+        bus.subscribe(sink)
+        bus.subscribe(recorder)
+        bus.publish(FILESET_CREATED, 'fw:20016', '1')
+        bus.close()
+        self.assertEqual(bus.stats()['errors'], 1)
+        self.assertEqual(recorder.fileset_ids, ['1'])
+
+    def test_reconnects_after_an_error(self):
+        self.server = LineServer(self.path, close_first=True)
+        sink = SocketEventSink(self.path)
+        bus = AdminEventBus(batch_size=1, flush_interval=0)
+        bus.subscribe(sink)
+        bus.publish(FILESET_CREATED, 'fw:20016', '1')
+        bus.flush(timeout=5.0)
+        # the first connection is gone, sending on it fails and loses the batch
+        wait_for(lambda: self.server.connections == 1)
+        time.sleep(0.05)
+        bus.publish(FILESET_CREATED, 'fw:20016', '2')
+        bus.flush(timeout=5.0)
+        bus.publish(FILESET_CREATED, 'fw:20016', '3')
+        bus.close()
+        sink.close()
+        wait_for(lambda: self.server.lines)
+        self.assertEqual(bus.stats()['errors'], 1)
+        self.assertEqual(self.server.lines[-1]['fileset_id'], '3')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_slow_consumer_drops_the_oldest_events(self):
+        self.server = LineServer(self.path)
+        self.server.reading.clear()
+        sink = SocketEventSink(self.path, timeout=10.0)
+        bus = AdminEventBus(max_queue=4, batch_size=1, flush_interval=0)
+        bus.subscribe(sink)
+        # more than the socket buffers hold, so sending blocks until the server reads
+        bus.publish(FILESET_CREATED, 'fw:20016', '0', blob='x' * (4 << 20))
+        wait_for(lambda: bus.stats()['queued'] == 1 and not bus._queue)
+        for i in range(1, 11):
+            bus.publish(FILESET_CREATED, 'fw:20016', str(i))
+        self.assertEqual(bus.stats()['dropped'], 6)
+
+        self.server.reading.set()
+        bus.close()
+        sink.close()
+        wait_for(lambda: len(self.server.lines) == 5)
+        self.assertEqual([line['fileset_id'] for line in self.server.lines], ['0', '7', '8', '9', '10'])
+        self.assertEqual(bus.stats()['errors'], 0)
+
+
+class CallbackTest(unittest.TestCase):
+    """The fs callbacks are called in the admin call, whatever the event bus does."""
+
+    ENVIRONMENT = ('FILEWAVE_ADMIN_PATH', 'FAKE_ADMIN_STATE', 'FAKE_ADMIN_ERROR_RATE')
+
+    def setUp(self):
+        self.saved = dict((name, os.environ.get(name)) for name in self.ENVIRONMENT)
+        self.dir = tempfile.mkdtemp()
+        os.environ['FILEWAVE_ADMIN_PATH'] = fake_admin.install(self.dir)
+        os.environ['FAKE_ADMIN_STATE'] = self.dir
+        os.environ['FAKE_ADMIN_ERROR_RATE'] = '0'
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        shutil.rmtree(self.dir)
+
+    def test_callbacks_run_before_the_call_returns(self):
+        recorder = Recorder(blocked=True)
+        events = AdminEventBus(max_queue=1, batch_size=1, flush_interval=0)
+        events.subscribe(recorder)
+        created, removed = [], []
+        client = FWAdminClient(events=events,
+                               create_fs_callback=lambda fileset_id: created.append(
+                                   (fileset_id, threading.current_thread())),
+                               remove_fs_callback=removed.append)
+
+        fileset_ids = [client.import_folder(self.dir, name='Test %d' % i) for i in range(4)]
+        self.assertEqual(created, [(fileset_id, threading.current_thread()) for fileset_id in fileset_ids])
+        client.remove_fileset(fileset_ids[0])
+        self.assertEqual(removed, [fileset_ids[0]])
+        # meanwhile the stuck subscriber made the bus drop events
+        self.assertGreater(events.stats()['dropped'], 0)
+        recorder.released.set()
+        events.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
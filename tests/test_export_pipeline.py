@@ -0,0 +1,143 @@
+"""ExportPipeline and the background exports of FileWaveImporter, against benchmarks/fake_admin.py.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import json
+import os
+import sys
+import unittest
+import zipfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+sys.path.insert(0, os.path.join(HERE, "..", "benchmarks"))
+
+import ExportPipeline as export_pipeline
+from ContentHash import ContentHasher
+from ExportPipeline import MANIFEST_SUFFIX, ExportPipeline, get_export_pipeline
+from test_inventory_cache import FakeAdminTestCase
+
+try:
+    from FileWaveImporter import FileWaveImporter
+    from autopkglib import ProcessorError
+except ImportError:
+    # autopkglib only exists inside autopkg
+    FileWaveImporter = None
+
+
+class ExportTestCase(FakeAdminTestCase):
+
+    ENVIRONMENT = FakeAdminTestCase.ENVIRONMENT + ('FILEWAVE_CACHE_DIR', 'FAKE_ADMIN_LATENCY')
+
+    def setUp(self):
+        super(ExportTestCase, self).setUp()
+        os.environ['FILEWAVE_CACHE_DIR'] = self.cache_dir
+        os.environ['FAKE_ADMIN_LATENCY'] = '0'
+        self.destination = os.path.join(self.dir, "exports")
+
+    def manifest(self, result):
+        with open(result.manifest_path) as f:
+            return json.load(f)
+
+
+class ExportPipelineTest(ExportTestCase):
+
+    def test_export_with_manifest(self):
+        pipeline = ExportPipeline(self.client)
+        result = pipeline.submit('7', 'Firefox', self.destination).result()
+        self.assertTrue(result.ok, result)
+        self.assertEqual(result.path, os.path.join(self.destination, "Firefox.fileset"))
+        self.assertEqual(result.manifest_path, result.path + MANIFEST_SUFFIX)
+        self.assertEqual(result.digest, ContentHasher().digest(result.path))
+        manifest = self.manifest(result)
+        self.assertEqual((manifest['fileset_id'], manifest['path'], manifest['digest']),
+                         ('7', 'Firefox.fileset', result.digest))
+        self.assertEqual(sorted(manifest['files']), ['fileset.plist'])
+        pipeline.close()
+
+    def test_compressed_export(self):
+        pipeline = ExportPipeline(self.client, compression='zip')
+        result = pipeline.submit('7', 'Firefox', self.destination).result()
+        self.assertEqual(result.path, os.path.join(self.destination, "Firefox.fileset.zip"))
+        self.assertFalse(os.path.exists(os.path.join(self.destination, "Firefox.fileset")))
+        self.assertEqual(zipfile.ZipFile(result.path).namelist()[-1], "Firefox.fileset/fileset.plist")
+        self.assertEqual(self.manifest(result)['files'],
+                         {"Firefox.fileset.zip": result.digest.split(':', 1)[1]})
+        pipeline.close()
+
+    def test_unknown_compression(self):
+        with self.assertRaises(ValueError):
+            ExportPipeline(self.client, compression='rar')
+
+    def test_exports_run_in_the_background(self):
+        os.environ['FAKE_ADMIN_LATENCY'] = '0.5'
+        pipeline = ExportPipeline(self.client, max_workers=2)
+        futures = [pipeline.submit(str(i), 'Fileset %d' % i, self.destination) for i in range(3)]
+        self.assertFalse(any(future.done() for future in futures))
+        self.assertEqual(pipeline.pending, 3)
+        self.assertEqual([result.fileset_id for result in pipeline.wait()], ['0', '1', '2'])
+        self.assertEqual(pipeline.pending, 0)
+        pipeline.close()
+
+    def test_failures_are_returned(self):
+        blocker = os.path.join(self.dir, "file")
+        open(blocker, 'w').close()
+        pipeline = ExportPipeline(self.client)
+        pipeline.submit('7', 'Firefox', os.path.join(blocker, "exports"))
+        pipeline.submit('8', 'Chrome', self.destination)
+        failed, exported = pipeline.wait()
+        self.assertFalse(failed.ok)
+        self.assertIsNone(failed.path)
+        self.assertTrue(exported.ok)
+        pipeline.close()
+
+
+class SharedPipelineTest(ExportTestCase):
+
+    def setUp(self):
+        super(SharedPipelineTest, self).setUp()
+        self.saved_pipelines = dict(export_pipeline._pipelines)
+        export_pipeline._pipelines.clear()
+
+    def tearDown(self):
+        for pipeline in export_pipeline._pipelines.values():
+            pipeline.close()
+        export_pipeline._pipelines.clear()
+        export_pipeline._pipelines.update(self.saved_pipelines)
+        super(SharedPipelineTest, self).tearDown()
+
+    def test_one_pipeline_per_server_and_settings(self):
+        pipeline = get_export_pipeline(self.client)
+        self.assertIs(get_export_pipeline(self.make_client()), pipeline)
+        self.assertIsNot(get_export_pipeline(self.client, compression='zip'), pipeline)
+        self.assertIsNot(get_export_pipeline(self.client, max_workers=4), pipeline)
+
+    @unittest.skipIf(FileWaveImporter is None, "autopkglib is not installed")
+    def test_importer_exports_in_the_background_by_default(self):
+        os.environ['FAKE_ADMIN_LATENCY'] = '0.5'
+        env = dict((name, spec.get('default')) for name, spec in FileWaveImporter.input_variables.items())
+        self.assertEqual((env['FW_EXPORT_WORKERS'], env['fw_export_wait']), (2, False))
+        importer = FileWaveImporter(env)
+        exported = []
+        importer.export('7', 'Firefox', self.destination, self.client, on_exported=lambda: exported.append('7'))
+        self.assertNotIn('fw_export_path', importer.env)
+        pipeline = get_export_pipeline(self.client)
+        self.assertEqual(pipeline.pending, 1)
+        self.assertTrue(pipeline.wait()[0].ok)
+        self.assertEqual(exported, ['7'])
+
+    @unittest.skipIf(FileWaveImporter is None, "autopkglib is not installed")
+    def test_importer_waiting_for_the_export(self):
+        importer = FileWaveImporter({'fw_export_wait': True})
+        importer.export('7', 'Firefox', self.destination, self.client)
+        self.assertEqual(importer.env['fw_export_path'], os.path.join(self.destination, "Firefox.fileset"))
+        blocker = os.path.join(self.dir, "file")
+        open(blocker, 'w').close()
+        with self.assertRaises(ProcessorError):
+            importer.export('8', 'Chrome', os.path.join(blocker, "exports"), self.client)
+
+
+if __name__ == '__main__':
+    unittest.main()
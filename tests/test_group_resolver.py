@@ -0,0 +1,118 @@
+"""FilesetGroupResolver and how FileWaveImporter turns a group path into a group name.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+
+from CommandLine import Fileset, FilesetGroupResolver
+
+try:
+    from FileWaveImporter import FileWaveImporter
+    from autopkglib import ProcessorError
+except ImportError:
+    # autopkglib only exists inside autopkg
+    FileWaveImporter = None
+
+
+def group(id, name, parent_id=None):
+    return Fileset(id=id, name=name, type='group', size=0, parent_id=parent_id)
+
+
+class ListingClient(object):
+    """Lists a fixed tree of groups and counts the listings."""
+
+    inventory_key = 'server'
+
+    def __init__(self, filesets):
+        self.filesets = filesets
+        self.listings = 0
+
+    def get_filesets(self, use_cache=True, stream=False):
+        self.listings += 1
+        return iter(self.filesets)
+
+
+def sample_client():
+    return ListingClient([
+        group(1, 'Apps'),
+        group(2, 'Browsers', 1),
+        group(3, 'Chrome', 2),
+        group(4, 'Tools'),
+        group(5, 'Chrome', 4),
+        group(6, 'Apps'),
+        Fileset(id=7, name='Firefox', type='fileset', size=10, parent_id=2),
+    ])
+
+
+class FilesetGroupResolverTest(unittest.TestCase):
+
+    def test_lookup(self):
+        resolver = FilesetGroupResolver(sample_client())
+        self.assertEqual(resolver.lookup('Apps/Browsers'), '2')
+        self.assertEqual(resolver.lookup(' Apps / Browsers / Chrome/'), '3')
+        self.assertEqual(resolver.lookup('Tools/Chrome'), '5')
+
+    def test_missing_paths_are_not_created(self):
+        client = sample_client()
+        resolver = FilesetGroupResolver(client)
+        self.assertIsNone(resolver.lookup('Apps/Editors'))
+        self.assertIsNone(resolver.lookup('Apps/Browsers/Firefox'))
+        self.assertEqual(len(client.filesets), 7)
+
+    def test_lowest_id_wins_between_siblings(self):
+        self.assertEqual(FilesetGroupResolver(sample_client()).lookup('Apps'), '1')
+
+    def test_name_count(self):
+        resolver = FilesetGroupResolver(sample_client())
+        self.assertEqual(resolver.name_count('Chrome'), 2)
+        self.assertEqual(resolver.name_count('Browsers'), 1)
+        self.assertEqual(resolver.name_count('Firefox'), 0)
+
+    def test_listed_once_until_invalidated(self):
+        client = sample_client()
+        resolver = FilesetGroupResolver(client)
+        resolver.lookup('Apps')
+        resolver.lookup('Tools/Chrome')
+        resolver.name_count('Chrome')
+        self.assertEqual(client.listings, 1)
+        resolver.invalidate()
+        resolver.lookup('Apps')
+        self.assertEqual(client.listings, 2)
+
+
+@unittest.skipIf(FileWaveImporter is None, "autopkglib is not installed")
+class ResolveGroupTest(unittest.TestCase):
+
+    def importer(self, paths=True):
+        return FileWaveImporter({'fw_fileset_group_paths': paths})
+
+    def resolve(self, fileset_group, paths=True):
+        # a fresh client per test, get_group_resolver shares resolvers by server
+        client = sample_client()
+        client.inventory_key = self.id()
+        return self.importer(paths).resolve_group(fileset_group, client)
+
+    def test_path_becomes_the_group_name(self):
+        self.assertEqual(self.resolve('Apps/Browsers'), 'Browsers')
+
+    def test_missing_path(self):
+        self.assertRaises(ProcessorError, self.resolve, 'Apps/Editors')
+
+    def test_ambiguous_group_name(self):
+        self.assertRaises(ProcessorError, self.resolve, 'Apps/Browsers/Chrome')
+
+    def test_names_are_passed_on(self):
+        self.assertEqual(self.resolve('Editors'), 'Editors')
+        self.assertEqual(self.resolve('Apps/Editors', paths=False), 'Apps/Editors')
+        self.assertIsNone(self.resolve(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+"""The import journal and how FileWaveImporter resumes an import from it.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+
+from CommandLine import Fileset
+from ImportJournal import CREATED, DONE, PROPERTIES, STARTED, ImportJournal, reached
+
+try:
+    from FileWaveImporter import FileWaveImporter
+except ImportError:
+    # autopkglib only exists inside autopkg
+    FileWaveImporter = None
+
+
+class ImportJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "journal.sqlite")
+        self.journal = ImportJournal(self.path)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.dir)
+
+    def test_unknown_job(self):
+        self.assertEqual(self.journal.get('server', 'job'), (None, None))
+        self.assertEqual(self.journal.unfinished('server', 'job'), (None, None))
+
+    def test_steps_keep_the_fileset_id(self):
+        self.journal.record('server', 'job', STARTED)
+        self.assertEqual(self.journal.unfinished('server', 'job'), (None, None))
+        self.journal.record('server', 'job', CREATED, '1001')
+        self.assertEqual(self.journal.unfinished('server', 'job'), (CREATED, '1001'))
+        self.journal.record('server', 'job', PROPERTIES)
+        self.assertEqual(self.journal.unfinished('server', 'job'), (PROPERTIES, '1001'))
+        self.journal.record('server', 'job', DONE)
+        self.assertEqual(self.journal.get('server', 'job'), (DONE, '1001'))
+        self.assertEqual(self.journal.unfinished('server', 'job'), (None, None))
+        self.assertEqual(self.journal.pending(), [])
+
+    def test_started_discards_an_earlier_attempt(self):
+        self.journal.record('server', 'job', CREATED, '1001')
+        self.journal.record('server', 'job', STARTED)
+        self.assertEqual(self.journal.get('server', 'job'), (STARTED, None))
+
+    def test_jobs_are_per_server(self):
+        self.journal.record('eu', 'job', CREATED, '1')
+        self.journal.record('us', 'job', CREATED, '2')
+        self.journal.record('us', 'job', DONE)
+        self.assertEqual(self.journal.unfinished('eu', 'job'), (CREATED, '1'))
+        self.assertEqual(self.journal.unfinished('us', 'job'), (None, None))
+        self.assertEqual(self.journal.pending(), [('eu', 'job', CREATED, '1')])
+
+    def test_forget(self):
+        self.journal.record('server', 'job', CREATED, '1001')
+        self.journal.forget('server', 'job')
+        self.assertEqual(self.journal.get('server', 'job'), (None, None))
+
+    def test_survives_reopening(self):
+        self.journal.record('server', 'job', CREATED, '1001')
+        self.journal.close()
+        self.journal = ImportJournal(self.path)
+        self.assertEqual(self.journal.unfinished('server', 'job'), (CREATED, '1001'))
+
+    def test_old_entries_are_dropped_on_open(self):
+        self.journal.record('server', 'job', CREATED, '1001')
+        self.journal.close()
+        time.sleep(0.05)
+        self.journal = ImportJournal(self.path, max_age=0.01)
+        self.assertEqual(self.journal.get('server', 'job'), (None, None))
+
+    def test_unknown_step(self):
+        self.assertRaises(ValueError, self.journal.record, 'server', 'job', 'uploaded')
+
+    def test_job_key(self):
+        self.assertEqual(ImportJournal.job_key('Adium', None, '1.5.10', 42), 'Adium||1.5.10|42')
+
+    def test_reached(self):
+        self.assertFalse(reached(None, STARTED))
+        self.assertTrue(reached(CREATED, STARTED))
+        self.assertTrue(reached(CREATED, CREATED))
+        self.assertFalse(reached(CREATED, PROPERTIES))
+        self.assertTrue(reached(DONE, PROPERTIES))
+
+
+class Crash(Exception):
+    pass
+
+
+class RecordingClient(object):
+    """Just enough of FWAdminClient for FileWaveImporter.import_into."""
+
+    inventory_key = 'server'
+
+    def __init__(self):
+        self.filesets = []
+        self.properties = []
+        self.crash_on_property = False
+
+    def get_filesets(self, use_cache=True, stream=False):
+        return iter(self.filesets)
+
+    def set_property(self, fileset_id, name, value):
+        if self.crash_on_property:
+            raise Crash(name)
+        self.properties.append((fileset_id, name, value))
+
+
+@unittest.skipIf(FileWaveImporter is None, "autopkglib is not installed")
+class ImporterResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.journal = ImportJournal(os.path.join(self.dir, "journal.sqlite"))
+        self.client = RecordingClient()
+        self.created = []
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.dir)
+
+    def importer(self):
+        env = dict((name, spec.get('default')) for name, spec in FileWaveImporter.input_variables.items())
+        env.update(fw_import_source=self.dir, fw_fileset_name='Test', fw_app_bundle_id='com.example.test',
+                   fw_app_version='1.0', fw_skip_identical_content=False, fw_export_fileset=None)
+        importer = FileWaveImporter(env)
+        importer.journal = self.journal
+        importer.journal_job = ImportJournal.job_key('Test', 'com.example.test', '1.0', self.dir)
+
+        def create_fileset(client, import_source, file_extension):
+            fileset_id = str(1000 + len(self.created))
+            self.created.append(fileset_id)
+            client.filesets.append(Fileset(id=fileset_id, name='Test', type='fileset', size=0, parent_id=None))
+            return fileset_id
+        importer.create_fileset = create_fileset
+        return importer
+
+    def test_resumes_into_the_created_fileset(self):
+        self.client.crash_on_property = True
+        self.assertRaises(Crash, self.importer().import_into, self.client, self.dir, '', None)
+        self.assertEqual(self.created, ['1000'])
+
+        self.client.crash_on_property = False
+        importer = self.importer()
+        self.assertEqual(importer.unfinished_import(self.client), (CREATED, '1000'))
+        self.assertIsNone(importer.satisfying_fileset(self.client))
+        self.assertEqual(importer.import_into(self.client, self.dir, '', None), ('imported', '1000'))
+        self.assertEqual(self.created, ['1000'])
+        self.assertEqual(self.client.properties, [('1000', 'autopkg_app_bundle_id', 'com.example.test'),
+                                                  ('1000', 'autopkg_app_version', '1.0')])
+        self.assertEqual(self.journal.pending(), [])
+
+    def test_removed_fileset_is_imported_again(self):
+        self.client.crash_on_property = True
+        self.assertRaises(Crash, self.importer().import_into, self.client, self.dir, '', None)
+        self.client.filesets = []
+
+        self.client.crash_on_property = False
+        importer = self.importer()
+        self.assertEqual(importer.unfinished_import(self.client), (None, None))
+        self.assertEqual(importer.import_into(self.client, self.dir, '', None), ('imported', '1001'))
+        self.assertEqual(self.created, ['1000', '1001'])
+
+    def test_finished_import_is_not_resumed(self):
+        self.importer().import_into(self.client, self.dir, '', None)
+        self.assertEqual(self.importer().unfinished_import(self.client), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+"""FilesetInventoryCache and how FWAdminClient keeps it up to date, against benchmarks/fake_admin.py.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+sys.path.insert(0, os.path.join(HERE, "..", "benchmarks"))
+
+import fake_admin
+from CommandLine import FilesetInventoryCache, FWAdminClient
+
+try:
+    from FWTool import FWTool
+except ImportError:
+    # autopkglib only exists inside autopkg
+    FWTool = None
+
+
+class FakeAdminTestCase(unittest.TestCase):
+    """Runs each test against a fresh fake admin tool and inventory cache."""
+
+    ENVIRONMENT = ('FILEWAVE_ADMIN_PATH', 'FAKE_ADMIN_STATE', 'FAKE_ADMIN_FILESETS', 'FAKE_ADMIN_ERROR_RATE')
+    FILESETS = 20
+
+    def setUp(self):
+        self.saved = dict((name, os.environ.get(name)) for name in self.ENVIRONMENT)
+        self.dir = tempfile.mkdtemp()
+        os.environ['FILEWAVE_ADMIN_PATH'] = fake_admin.install(os.path.join(self.dir, "admin"))
+        os.environ['FAKE_ADMIN_STATE'] = os.path.join(self.dir, "admin")
+        os.environ['FAKE_ADMIN_FILESETS'] = str(self.FILESETS)
+        os.environ['FAKE_ADMIN_ERROR_RATE'] = '0'
+        # the in-process copies are shared by every cache object
+        FilesetInventoryCache._memory.clear()
+        FilesetInventoryCache._dirty.clear()
+        self.cache_dir = os.path.join(self.dir, "cache")
+        self.client = self.make_client()
+
+    def tearDown(self):
+        FilesetInventoryCache._memory.clear()
+        FilesetInventoryCache._dirty.clear()
+        for name, value in self.saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        shutil.rmtree(self.dir)
+
+    def make_client(self, ttl=300):
+        return FWAdminClient(inventory_cache=FilesetInventoryCache(ttl=ttl, cache_dir=self.cache_dir))
+
+    def listings(self, client=None):
+        return sum(1 for record in (client or self.client).instrumentation.records
+                   if record.verb == '--listFilesets')
+
+
+class InventoryCacheTest(FakeAdminTestCase):
+
+    def test_listing_is_reused_by_later_clients(self):
+        self.assertEqual(len(list(self.client.get_filesets(stream=False))), self.FILESETS + 1)
+        other = self.make_client()
+        self.assertEqual(len(list(other.get_filesets(stream=False))), self.FILESETS + 1)
+        self.assertEqual((self.listings(), self.listings(other)), (1, 0))
+        self.assertEqual(other.inventory_cache.hits, 1)
+
+    def test_kept_on_disk_for_later_runs(self):
+        list(self.client.get_filesets(stream=False))
+        FilesetInventoryCache._memory.clear()
+        other = self.make_client()
+        list(other.get_filesets(stream=False))
+        self.assertEqual(self.listings(other), 0)
+
+    def test_expired_listing_is_listed_again(self):
+        list(self.make_client(ttl=0.05).get_filesets(stream=False))
+        time.sleep(0.1)
+        other = self.make_client(ttl=0.05)
+        list(other.get_filesets(stream=False))
+        self.assertEqual(self.listings(other), 1)
+
+    def test_zero_ttl_turns_it_off(self):
+        client = self.make_client(ttl=0)
+        list(client.get_filesets(stream=False))
+        list(client.get_filesets(stream=False))
+        self.assertEqual(self.listings(client), 2)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_one_inventory_per_server_and_user(self):
+        other = FWAdminClient(admin_name='autopkg',
+                              inventory_cache=FilesetInventoryCache(cache_dir=self.cache_dir))
+        list(self.client.get_filesets(stream=False))
+        list(other.get_filesets(stream=False))
+        self.assertEqual(self.listings(other), 1)
+        self.assertNotEqual(other.inventory_key, self.client.inventory_key)
+
+    def test_use_cache_false_lists_the_server(self):
+        list(self.client.get_filesets(stream=False))
+        list(self.client.get_filesets(use_cache=False))
+        self.assertEqual(self.listings(), 2)
+
+    @unittest.skipIf(FWTool is None, "autopkglib is not installed")
+    def test_on_by_default(self):
+        client = FWTool({}).make_client('localhost', '20016', 'fwadmin', 'filewave')
+        self.assertEqual(client.inventory_cache.ttl, 300)
+
+
+class InventoryPatchTest(FakeAdminTestCase):
+
+    def test_import_into_a_named_group(self):
+        list(self.client.get_filesets())
+        fileset_id = self.client.import_folder(self.dir, name='Firefox', target='Browsers')
+
+        # the group's ID isn't known, so the server is listed again
+        table = self.client.get_fileset_table(stream=False)
+        self.assertEqual(len(table), self.FILESETS + 1)
+        self.assertEqual(self.listings(), 2)
+        FilesetInventoryCache.flush()
+        for record in json.load(open(self.client.inventory_cache._path(self.client.inventory_key)))['filesets'].values():
+            self.assertNotEqual(record.get('parent_id'), 'Browsers')
+        self.assertIsNotNone(fileset_id)
+
+    def test_import_into_a_group_id(self):
+        list(self.client.get_filesets())
+        fileset_id = self.client.import_folder(self.dir, name='Firefox', target='1')
+
+        table = self.client.get_fileset_table(stream=False)
+        self.assertEqual(self.listings(), 1)
+        row = list(table.ids).index(int(fileset_id))
+        self.assertEqual(table.parent_ids[row], 1)
+
+    def test_import_into_the_root(self):
+        list(self.client.get_filesets())
+        fileset_id = self.client.import_folder(self.dir, name='Firefox')
+
+        filesets = dict((fileset.id, fileset) for fileset in self.client.get_filesets())
+        self.assertEqual(self.listings(), 1)
+        self.assertEqual(filesets[fileset_id].name, 'Firefox')
+
+    def test_patches_reach_the_disk_on_flush(self):
+        list(self.client.get_filesets())
+        fileset_id = self.client.import_folder(self.dir, name='Firefox')
+        self.client.set_property(fileset_id, 'autopkg_app_version', '1.0')
+        FilesetInventoryCache.flush()
+
+        FilesetInventoryCache._memory.clear()
+        other = self.make_client()
+        filesets = dict((fileset.id, fileset) for fileset in other.get_filesets())
+        self.assertEqual(self.listings(other), 0)
+        self.assertEqual(filesets[fileset_id].custom_properties, {'autopkg_app_version': '1.0'})
+
+
+if __name__ == '__main__':
+    unittest.main()
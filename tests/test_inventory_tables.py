@@ -0,0 +1,128 @@
+"""The slotted inventory records and the columnar tables, against benchmarks/fake_admin.py.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+sys.path.insert(0, os.path.join(HERE, "..", "benchmarks"))
+
+from CommandLine import Association, AssociationTable, Client, ClientTable, Fileset, FilesetTable
+from test_inventory_cache import FakeAdminTestCase
+
+
+def fileset_state(fileset):
+    # a table has no "not reported" critical flag, it is False then
+    return (fileset.id, fileset.name, fileset.type, fileset.size, fileset.parent_id, fileset.custom_properties,
+            bool(fileset.is_critical))
+
+
+class RecordTest(unittest.TestCase):
+
+    def test_records_have_no_instance_dict(self):
+        for record in (Client(1, 'client-1', 'client', 2),
+                       Fileset(1, 'Firefox', 'fileset', 10, None),
+                       Association(1, 2, 3)):
+            self.assertFalse(hasattr(record, '__dict__'), type(record).__name__)
+
+    def test_ids_are_strings_and_types_interned(self):
+        first = Fileset(1, 'Firefox', ''.join(['file', 'set']), 10, 2)
+        second = Fileset('2', 'Chrome', ''.join(['file', 'set']), 10, None)
+        self.assertEqual((first.id, first.parent_id, second.parent_id), ('1', '2', 'None'))
+        self.assertIs(first.type, second.type)
+
+    def test_unknown_admin_attributes_are_kept(self):
+        fileset = Fileset(1, 'Firefox', 'fileset', 10, None, isCritical=True, revision=4)
+        self.assertEqual((fileset.is_critical, fileset.extra), (True, {'revision': 4}))
+
+
+class FilesetTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = FilesetTable()
+        for record in ({'id': 1, 'name': 'Apps', 'type': 'group', 'parent_id': None},
+                       {'id': 2, 'name': 'Firefox', 'type': 'fileset', 'size': 10, 'parent_id': 1,
+                        'isCritical': True, 'custom_properties': {'autopkg_app_version': '1.0'}},
+                       {'id': 3, 'name': 'Chrome', 'type': 'fileset', 'size': 20, 'parent_id': 1,
+                        'custom_properties': {'autopkg_app_version': '2.0', 'owner': 'it'}},
+                       {'id': 4, 'name': 'Top', 'type': 'fileset', 'parent_id': ''}):
+            self.table.append(record)
+
+    def test_select(self):
+        self.assertEqual(self.table.select(type='fileset'), [1, 2, 3])
+        self.assertEqual(self.table.select(type='fileset', parent_id='1'), [1, 2])
+        self.assertEqual(self.table.select(parent_id=None), [0, 1, 2, 3])
+        self.assertEqual(self.table.select(type='imaging'), [])
+
+    def test_properties(self):
+        self.assertEqual(self.table.select_property('autopkg_app_version'), [1, 2])
+        self.assertEqual(self.table.select_property('autopkg_app_version', '2.0'), [2])
+        self.assertEqual(self.table.select_property('missing'), [])
+        self.assertEqual(self.table.property_value(2, 'owner'), 'it')
+        self.assertIsNone(self.table.property_value(3, 'owner'))
+        # every key is stored once
+        self.assertEqual(sorted(self.table.property_keys), ['autopkg_app_version', 'owner'])
+
+    def test_records(self):
+        self.assertEqual(fileset_state(self.table.record(1)),
+                         ('2', 'Firefox', 'fileset', 10, '1', {'autopkg_app_version': '1.0'}, True))
+        self.assertEqual(self.table.record(0).parent_id, 'None')
+        self.assertEqual(self.table.record(3).parent_id, 'None')
+        self.assertEqual([fileset.id for fileset in self.table], ['1', '2', '3', '4'])
+
+
+class AssociationTableTest(unittest.TestCase):
+
+    def test_select_and_flags(self):
+        table = AssociationTable()
+        table.append({'assoc_id': 1, 'client_id': 10, 'fileset_id': 20, 'kiosk': True})
+        table.append({'assoc_id': 2, 'client_id': 11, 'fileset_id': 20, 'sw_update': True})
+        table.append({'assoc_id': 3, 'client_id': 11, 'fileset_id': 21})
+        self.assertEqual(table.select(fileset_id='20'), [0, 1])
+        self.assertEqual(table.select(client_id=11, fileset_id=21), [2])
+        self.assertEqual([(assoc.kiosk, assoc.sw_update) for assoc in table],
+                         [(True, False), (False, True), (False, False)])
+
+
+class TablesMatchRecordsTest(FakeAdminTestCase):
+    """Each table holds what the record listing of the same server returns."""
+
+    ENVIRONMENT = FakeAdminTestCase.ENVIRONMENT + ('FAKE_ADMIN_CLIENTS', 'FAKE_ADMIN_ASSOCIATIONS',
+                                                   'FAKE_ADMIN_DEPTH')
+
+    def setUp(self):
+        super(TablesMatchRecordsTest, self).setUp()
+        os.environ['FAKE_ADMIN_CLIENTS'] = '30'
+        os.environ['FAKE_ADMIN_ASSOCIATIONS'] = '25'
+        os.environ['FAKE_ADMIN_DEPTH'] = '3'
+
+    def test_filesets(self):
+        table = self.client.get_fileset_table(use_cache=False)
+        filesets = list(self.client.get_filesets(use_cache=False))
+        self.assertEqual(len(table), self.FILESETS + 3)
+        self.assertEqual([fileset_state(fileset) for fileset in table],
+                         [fileset_state(fileset) for fileset in filesets])
+
+    def test_clients(self):
+        table = self.client.get_client_table()
+        self.assertIsInstance(table, ClientTable)
+        self.assertEqual([(client.id, client.name, client.type, client.parent_id) for client in table],
+                         [(client.id, client.name, client.type, client.parent_id)
+                          for client in self.client.get_clients()])
+        self.assertEqual(len(table.select(type='group')), 3)
+
+    def test_associations(self):
+        table = self.client.get_association_table()
+        self.assertEqual([(assoc.id, assoc.client_id, assoc.fileset_id, assoc.kiosk, assoc.sw_update)
+                          for assoc in table],
+                         [(assoc.id, assoc.client_id, assoc.fileset_id, assoc.kiosk, assoc.sw_update)
+                          for assoc in self.client.get_associations()])
+
+
+if __name__ == '__main__':
+    unittest.main()
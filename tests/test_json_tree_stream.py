@@ -0,0 +1,99 @@
+"""JsonTreeStream against json.loads + flatten_tree, whatever the chunking.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import json
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+
+from CommandLine import JsonTreeStream, flatten_tree
+
+
+def canonical(nodes):
+    return sorted(json.dumps(node, sort_keys=True) for node in nodes)
+
+
+def parse(text, chunk_size):
+    parser = JsonTreeStream()
+    nodes = []
+    for start in range(0, len(text), chunk_size):
+        nodes.extend(parser.feed(text[start:start + chunk_size]))
+    nodes.extend(parser.feed('', final=True))
+    return nodes
+
+
+def sample_tree():
+    return [
+        {'id': 1, 'name': 'Root {"group"}', 'type': 'group', 'children': [
+            {'id': 2, 'name': 'Café \\ "quoted" \U0001F600', 'type': 'fileset', 'size': 123456789,
+             'custom_properties': {'autopkg_app_version': '1.5.10', 'nested': {'list': [1, 2.5, -3e-2]}},
+             'isCritical': True, 'parent': None, 'children': []},
+            {'id': 3, 'name': '', 'type': 'group', 'children': [
+                {'id': 4, 'name': 'children', 'type': 'fileset', 'size': 0, 'isCritical': False,
+                 'tags': ['a', '[b]', {'c': None}]},
+            ]},
+        ]},
+        {'id': 5, 'name': 'Second root', 'type': 'fileset', 'size': -1},
+    ]
+
+
+class JsonTreeStreamTest(unittest.TestCase):
+
+    def assertParsesLike(self, tree, chunk_sizes=(1, 2, 3, 7, 64, 1 << 20), indent=None):
+        text = json.dumps(tree, indent=indent, ensure_ascii=False)
+        expected = canonical(flatten_tree(json.loads(text)))
+        for chunk_size in chunk_sizes:
+            self.assertEqual(canonical(parse(text, chunk_size)), expected, "chunk size %d" % chunk_size)
+
+    def test_matches_json_loads_for_any_chunking(self):
+        self.assertParsesLike(sample_tree())
+
+    def test_pretty_printed_and_ascii_escaped_output(self):
+        self.assertParsesLike(sample_tree(), indent=4)
+        text = json.dumps(sample_tree(), ensure_ascii=True)
+        self.assertEqual(canonical(parse(text, 5)), canonical(flatten_tree(json.loads(text))))
+
+    def test_empty_listing(self):
+        self.assertEqual(parse('[]', 1), [])
+        self.assertEqual(parse('  [ ]  \n', 1 << 20), [])
+
+    def test_children_are_stripped(self):
+        for node in parse(json.dumps(sample_tree()), 4):
+            self.assertNotIn('children', node)
+
+    def test_deep_tree(self):
+        # deeper than both the C decoder's and Python's recursion limits
+        depth = 5000
+        text = '[' + ''.join('{"id": %d, "children": [' % i for i in range(depth)) + \
+               ']}' * depth + ']'
+        for chunk_size in (97, 1 << 20):
+            ids = sorted(node['id'] for node in parse(text, chunk_size))
+            self.assertEqual(ids, list(range(depth)))
+
+    def test_wide_tree(self):
+        tree = [{'id': 0, 'type': 'group', 'children': [
+            {'id': i, 'name': 'Fileset %d' % i, 'type': 'fileset', 'size': i * 1024} for i in range(1, 2000)]}]
+        self.assertParsesLike(tree, chunk_sizes=(13, 4096))
+
+    def test_truncated_document(self):
+        text = json.dumps(sample_tree())
+        for cut in (1, len(text) // 2, len(text) - 1):
+            parser = JsonTreeStream()
+            parser.feed(text[:cut])
+            self.assertRaises(ValueError, parser.feed, '', True)
+
+    def test_extra_data(self):
+        self.assertRaises(ValueError, parse, '[] []', 1 << 20)
+
+    def test_not_a_node_list(self):
+        self.assertRaises(ValueError, parse, '[1, 2]', 1 << 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+"""FWAdminClient.prune_filesets and the FileWavePruner processor, against benchmarks/fake_admin.py.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+sys.path.insert(0, os.path.join(HERE, "..", "benchmarks"))
+
+import fake_admin
+from CommandLine import FilesetInventoryCache, FWAdminClient
+
+try:
+    from FileWavePruner import FileWavePruner
+except ImportError:
+    # autopkglib only exists inside autopkg
+    FileWavePruner = None
+
+# with FAKE_ADMIN_BUNDLES=2 the fake admin lists fileset n as version 1.(n // 2) of
+# com.example.app(n % 2), so each app has versions 1.1 up to 1.10
+APP0 = 'com.example.app0'
+APP1 = 'com.example.app1'
+
+
+class RecordingClient(FWAdminClient):
+    """Remembers the filesets it removed, and fails removing those in fail_removing."""
+
+    def __init__(self, **kwargs):
+        super(RecordingClient, self).__init__(**kwargs)
+        self.removed = []
+        self.fail_removing = set()
+        self._removed_lock = threading.Lock()
+
+    def remove_fileset(self, fileset_id):
+        with self._removed_lock:
+            self.removed.append(str(fileset_id))
+        if str(fileset_id) in self.fail_removing:
+            raise Exception("Database internal error")
+        return super(RecordingClient, self).remove_fileset(fileset_id)
+
+
+def ids(filesets):
+    return sorted(int(fileset.id) for fileset in filesets)
+
+
+class PruneTestCase(unittest.TestCase):
+
+    ENVIRONMENT = ('FILEWAVE_ADMIN_PATH', 'FILEWAVE_CACHE_DIR', 'FAKE_ADMIN_STATE', 'FAKE_ADMIN_FILESETS',
+                   'FAKE_ADMIN_BUNDLES', 'FAKE_ADMIN_UNVERSIONED', 'FAKE_ADMIN_ASSOCIATIONS',
+                   'FAKE_ADMIN_ERROR_RATE')
+
+    def setUp(self):
+        self.saved = dict((name, os.environ.get(name)) for name in self.ENVIRONMENT)
+        self.dir = tempfile.mkdtemp()
+        os.environ['FILEWAVE_ADMIN_PATH'] = fake_admin.install(os.path.join(self.dir, "admin"))
+        os.environ['FILEWAVE_CACHE_DIR'] = os.path.join(self.dir, "cache")
+        os.environ['FAKE_ADMIN_STATE'] = os.path.join(self.dir, "admin")
+        os.environ['FAKE_ADMIN_FILESETS'] = '20'
+        os.environ['FAKE_ADMIN_BUNDLES'] = '2'
+        os.environ['FAKE_ADMIN_UNVERSIONED'] = '0'
+        os.environ['FAKE_ADMIN_ASSOCIATIONS'] = '0'
+        os.environ['FAKE_ADMIN_ERROR_RATE'] = '0'
+        FilesetInventoryCache._memory.clear()
+        FilesetInventoryCache._dirty.clear()
+        self.client = RecordingClient()
+
+    def tearDown(self):
+        FilesetInventoryCache._memory.clear()
+        FilesetInventoryCache._dirty.clear()
+        for name, value in self.saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        shutil.rmtree(self.dir)
+
+
+class PruneFilesetsTest(PruneTestCase):
+
+    def test_keeps_the_newest_versions(self):
+        result = self.client.prune_filesets(keep=3)
+        # 1.10 is newer than 1.9
+        self.assertEqual(ids(result.kept[APP0]), [16, 18, 20])
+        self.assertEqual(ids(result.kept[APP1]), [17, 19, 21])
+        self.assertEqual(ids(result.removed[APP0]), [2, 4, 6, 8, 10, 12, 14])
+        self.assertEqual(sorted(int(fileset_id) for fileset_id in self.client.removed), list(range(2, 16)))
+        self.assertEqual(result.errors, [])
+
+    def test_only_the_given_bundles(self):
+        result = self.client.prune_filesets(keep=1, bundle_ids=[APP1])
+        self.assertEqual(list(result.removed), [APP1])
+        self.assertEqual(ids(result.kept[APP1]), [21])
+        self.assertEqual(sorted(int(fileset_id) for fileset_id in self.client.removed), list(range(3, 21, 2)))
+
+    def test_dry_run_removes_nothing(self):
+        result = self.client.prune_filesets(keep=3, dry_run=True)
+        self.assertEqual(len(result.removed[APP0]) + len(result.removed[APP1]), 14)
+        self.assertEqual(self.client.removed, [])
+        self.assertEqual([record for record in self.client.instrumentation.records
+                          if record.verb == '--deleteFileset'], [])
+
+    def test_filesets_without_a_version_are_left_alone(self):
+        os.environ['FAKE_ADMIN_UNVERSIONED'] = '5'
+        result = self.client.prune_filesets(keep=3)
+        self.assertEqual(ids(result.kept[APP0]), [14, 16, 18])
+        for fileset_id in ('5', '10', '15', '20'):
+            self.assertNotIn(fileset_id, self.client.removed)
+
+    def test_associated_filesets_are_kept(self):
+        # the fake admin's first association is for fileset 2
+        os.environ['FAKE_ADMIN_ASSOCIATIONS'] = '1'
+        result = self.client.prune_filesets(keep=3, bundle_ids=[APP0])
+        self.assertEqual(ids(result.associated[APP0]), [2])
+        self.assertNotIn('2', self.client.removed)
+        self.assertEqual(len(self.client.removed), 6)
+
+    def test_failed_removals_are_reported(self):
+        self.client.fail_removing = set(['2', '4'])
+        result = self.client.prune_filesets(keep=3)
+        self.assertEqual(sorted(fileset.id for fileset, _ in result.errors), ['2', '4'])
+        self.assertEqual(len(self.client.removed), 14)
+
+
+@unittest.skipIf(FileWavePruner is None, "autopkglib is not installed")
+class FileWavePrunerTest(PruneTestCase):
+
+    def run_pruner(self, dry_run):
+        env = dict((name, spec.get('default')) for name, spec in FileWavePruner.input_variables.items())
+        env.update(FW_SERVER_HOST='localhost', FW_SERVER_PORT='20016', FW_ADMIN_USER='autopkg',
+                   FW_ADMIN_PASSWORD='secret', fw_prune_keep='3', fw_prune_dry_run=dry_run)
+        pruner = FileWavePruner(env)
+        pruner.make_client = lambda *args, **kwargs: self.client
+        pruner.main()
+        return pruner
+
+    def test_dry_run_strings(self):
+        for setting in ('true', 'Yes', '1', True):
+            self.client = RecordingClient()
+            summary = self.run_pruner(setting).env['filewave_prune_summary_result']
+            self.assertEqual(self.client.removed, [], setting)
+            self.assertEqual(summary['summary_text'], 'The following filesets would be removed:')
+
+    def test_false_strings_prune(self):
+        for setting in ('False', 'false', '0', 'no', 'off', '', None, False):
+            self.client = RecordingClient()
+            self.run_pruner(setting)
+            self.assertEqual(len(self.client.removed), 14, setting)
+
+
+if __name__ == '__main__':
+    unittest.main()
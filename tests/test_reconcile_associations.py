@@ -0,0 +1,142 @@
+"""What reconcile_associations plans, and the order it runs the plan in.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+
+from AsyncCommandLine import AsyncFWAdminClient
+from CommandLine import Association, FWAdminClient
+
+
+class RecordingClient(FWAdminClient):
+    """Records the association changes instead of running the admin tool."""
+
+    def __init__(self, associations, fail_removing=()):
+        super(RecordingClient, self).__init__()
+        self.associations = associations
+        self.fail_removing = set(fail_removing)
+        self.calls = []
+        self._calls_lock = threading.Lock()
+
+    def get_associations(self):
+        return iter(self.associations)
+
+    def remove_association(self, assoc_id):
+        # slow removals would finish after the adds if they overlapped
+        time.sleep(0.02)
+        with self._calls_lock:
+            self.calls.append(('remove', assoc_id))
+        if assoc_id in self.fail_removing:
+            raise Exception("Database internal error")
+
+    def create_association(self, client_id, fileset_id, kiosk=False, sw_update=False, error_expected=False):
+        with self._calls_lock:
+            self.calls.append(('add', (client_id, fileset_id, kiosk, sw_update)))
+
+
+class ReconcilePlanTest(unittest.TestCase):
+
+    def plan(self, desired, associations, scope=None):
+        result, to_remove, to_add = FWAdminClient()._reconcile_plan(desired, scope, associations)
+        return result, sorted(assoc.id for assoc in to_remove), to_add
+
+    def test_only_the_difference_is_changed(self):
+        existing = [Association(1, 'c1', '10'), Association(2, 'c2', '10'), Association(3, 'c3', '10')]
+        result, to_remove, to_add = self.plan([('c1', '10'), ('c2', 10), ('c4', '10')], existing)
+        self.assertEqual(to_remove, ['3'])
+        self.assertEqual(to_add, [('c4', '10', False, False)])
+        self.assertEqual(result.unchanged, 2)
+
+    def test_flag_change_replaces_the_association(self):
+        result, to_remove, to_add = self.plan([{'client_id': 'c1', 'fileset_id': '10', 'kiosk': True}],
+                                              [Association(1, 'c1', '10')])
+        self.assertEqual(to_remove, ['1'])
+        self.assertEqual(to_add, [('c1', '10', True, False)])
+
+    def test_first_entry_per_client_and_fileset_wins(self):
+        result, to_remove, to_add = self.plan([('c1', '10', True), ('c1', '10'), ('c1', '10', True, True)], [])
+        self.assertEqual(to_add, [('c1', '10', True, False)])
+
+    def test_scope(self):
+        existing = [Association(1, 'c1', '10'), Association(2, 'c1', '11'), Association(3, 'c1', '12')]
+        result, to_remove, to_add = self.plan([('c1', '11')], existing, scope=['10', '11'])
+        self.assertEqual(to_remove, ['1'])
+        self.assertEqual(to_add, [])
+
+    def test_duplicate_existing_associations_are_removed(self):
+        existing = [Association(1, 'c1', '10'), Association(2, 'c1', '10')]
+        result, to_remove, to_add = self.plan([('c1', '10')], existing)
+        self.assertEqual(to_remove, ['2'])
+
+    def test_many_desired_associations(self):
+        desired = [('c%d' % i, '10') for i in range(20000)] * 2
+        started = time.time()
+        result, to_remove, to_add = self.plan(desired, [])
+        self.assertEqual(len(to_add), 20000)
+        self.assertLess(time.time() - started, 5)
+
+
+class ReconcileOrderTest(unittest.TestCase):
+
+    def test_removals_finish_before_adds(self):
+        existing = [Association(i, 'c%d' % i, '10') for i in range(8)]
+        client = RecordingClient(existing)
+        result = client.reconcile_associations([('c%d' % i, '10', True) for i in range(8)], max_workers=4)
+        actions = [action for action, _ in client.calls]
+        self.assertEqual(actions, ['remove'] * 8 + ['add'] * 8)
+        self.assertEqual(result.errors, [])
+
+    def test_failed_removal_blocks_its_replacement(self):
+        client = RecordingClient([Association(1, 'c1', '10'), Association(2, 'c2', '10')], fail_removing=['1'])
+        result = client.reconcile_associations([('c1', '10', True), ('c2', '10', True)])
+        self.assertEqual([call for call in client.calls if call[0] == 'add'], [('add', ('c2', '10', True, False))])
+        self.assertEqual(sorted(action for action, _, _ in result.errors), ['add', 'remove'])
+
+    def test_dry_run_changes_nothing(self):
+        client = RecordingClient([Association(1, 'c1', '10')])
+        result = client.reconcile_associations([('c2', '10')], dry_run=True)
+        self.assertEqual(client.calls, [])
+        self.assertEqual(len(result.added), 1)
+        self.assertEqual(len(result.removed), 1)
+
+
+class AsyncRecordingClient(AsyncFWAdminClient):
+
+    def __init__(self, associations):
+        super(AsyncRecordingClient, self).__init__()
+        self.associations = associations
+        self.calls = []
+
+    async def get_associations(self, timeout=None):
+        for assoc in self.associations:
+            yield assoc
+
+    async def remove_association(self, assoc_id, timeout=None):
+        await asyncio.sleep(0.02)
+        self.calls.append('remove')
+
+    async def create_association(self, client_id, fileset_id, kiosk=False, sw_update=False, error_expected=False,
+                                 timeout=None):
+        self.calls.append('add')
+
+
+class AsyncReconcileOrderTest(unittest.TestCase):
+
+    def test_removals_finish_before_adds(self):
+        client = AsyncRecordingClient([Association(i, 'c%d' % i, '10') for i in range(4)])
+        asyncio.run(client.reconcile_associations([('c%d' % i, '10', True) for i in range(4)]))
+        self.assertEqual(client.calls, ['remove'] * 4 + ['add'] * 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+"""FileWaveImporter importing into several servers (FW_SERVER_TARGETS), against benchmarks/fake_admin.py.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+sys.path.insert(0, os.path.join(HERE, "..", "benchmarks"))
+
+import fake_admin
+from CommandLine import Fileset, FilesetInventoryCache, ValidationCache
+
+try:
+    from FileWaveImporter import FileWaveImporter
+    from autopkglib import ProcessorError
+except ImportError:
+    # autopkglib only exists inside autopkg
+    FileWaveImporter = None
+
+PROBES = ('-v', '--listFilesets')
+
+
+@unittest.skipIf(FileWaveImporter is None, "autopkglib is not installed")
+class ServerTargetsTest(unittest.TestCase):
+
+    ENVIRONMENT = ('FILEWAVE_ADMIN_PATH', 'FILEWAVE_CACHE_DIR', 'FAKE_ADMIN_STATE', 'FAKE_ADMIN_ERROR_RATE',
+                   'FAKE_ADMIN_DOWN_HOSTS')
+
+    def setUp(self):
+        self.saved = dict((name, os.environ.get(name)) for name in self.ENVIRONMENT)
+        self.dir = tempfile.mkdtemp()
+        os.environ['FILEWAVE_ADMIN_PATH'] = fake_admin.install(os.path.join(self.dir, "admin"))
+        os.environ['FILEWAVE_CACHE_DIR'] = os.path.join(self.dir, "cache")
+        os.environ['FAKE_ADMIN_STATE'] = os.path.join(self.dir, "admin")
+        os.environ['FAKE_ADMIN_ERROR_RATE'] = '0'
+        os.environ['FAKE_ADMIN_DOWN_HOSTS'] = ''
+        self.source = os.path.join(self.dir, "Test.app")
+        os.makedirs(self.source)
+        FilesetInventoryCache._memory.clear()
+        FilesetInventoryCache._dirty.clear()
+        ValidationCache._memory.clear()
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+
+    def tearDown(self):
+        FilesetInventoryCache._memory.clear()
+        FilesetInventoryCache._dirty.clear()
+        ValidationCache._memory.clear()
+        for name, value in self.saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        shutil.rmtree(self.dir)
+
+    def importer(self, targets):
+        env = dict((name, spec.get('default')) for name, spec in FileWaveImporter.input_variables.items())
+        env.update(FW_SERVER_HOST='main', FW_SERVER_PORT='20016', FW_ADMIN_USER='autopkg',
+                   FW_ADMIN_PASSWORD='secret', FW_SERVER_TARGETS=targets, FW_ADMIN_RETRIES=0,
+                   fw_import_source=self.source, fw_fileset_name='Test', fw_app_bundle_id='com.example.test',
+                   fw_app_version='1.0')
+        importer = FileWaveImporter(env)
+        make_client = importer.make_client
+
+        def recording_make_client(server_host, *args, **kwargs):
+            client = make_client(server_host, *args, **kwargs)
+            with self.clients_lock:
+                self.clients.setdefault(server_host, []).append(client)
+            return client
+        importer.make_client = recording_make_client
+        return importer
+
+    def probes(self, host):
+        return [record.verb for client in self.clients[host] for record in client.instrumentation.records
+                if record.verb in PROBES]
+
+    def test_every_target_is_validated_and_imported(self):
+        importer = self.importer(['eu', 'us:20017'])
+        importer.main()
+        results = importer.env['fw_server_results']
+        self.assertEqual([(result['fw_server'], result['fw_status']) for result in results],
+                         [('eu:20016', 'imported'), ('us:20017', 'imported')])
+        for host in ('eu', 'us'):
+            self.assertEqual(sorted(set(self.probes(host))), sorted(PROBES), host)
+        self.assertNotEqual(results[0]['fw_fileset_id'], results[1]['fw_fileset_id'])
+
+    def test_failing_target_doesnt_stop_the_others(self):
+        os.environ['FAKE_ADMIN_DOWN_HOSTS'] = 'us'
+        importer = self.importer(['eu', 'us', 'asia'])
+        with self.assertRaises(ProcessorError) as raised:
+            importer.main()
+        self.assertIn('us:20016', str(raised.exception))
+        results = dict((result['fw_server'], result) for result in importer.env['fw_server_results'])
+        self.assertEqual(results['eu:20016']['fw_status'], 'imported')
+        self.assertEqual(results['asia:20016']['fw_status'], 'imported')
+        self.assertEqual(results['us:20016']['fw_status'], 'failed')
+        self.assertIn('validation failed', results['us:20016']['fw_error'])
+        self.assertIn('us:20016: failed', importer.env['filewave_summary_result']['data']['fw_server_status'])
+        # nothing but the validation was tried on the failed server
+        self.assertEqual([record.verb for client in self.clients['us'] for record in client.instrumentation.records],
+                         ['-v'])
+
+    def test_already_satisfied_targets_are_reported(self):
+        importer = self.importer(['eu', 'us'])
+        satisfied = Fileset(id='7', name='Test', type='fileset', size=0, parent_id=None)
+        importer.satisfying_fileset = lambda client: satisfied if client.connection_key[1] == 'us' else None
+        importer.main()
+        self.assertEqual([(result['fw_status'], result.get('fw_fileset_id'))
+                          for result in importer.env['fw_server_results']][1], ('satisfied', '7'))
+        self.assertEqual(importer.env['fw_server_results'][0]['fw_status'], 'imported')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+"""ValidationCache and how FWTool.check_client uses it, against benchmarks/fake_admin.py.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+sys.path.insert(0, os.path.join(HERE, "..", "benchmarks"))
+
+import fake_admin
+from CommandLine import FWAdminClient, ValidationCache
+
+try:
+    from FWTool import FWTool
+except ImportError:
+    # autopkglib only exists inside autopkg
+    FWTool = None
+
+RESULT = {'version': '13.1.0', 'can_list_filesets': 'Yes'}
+
+
+class ValidationCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.executable = os.path.join(self.dir, "FileWave Admin")
+        open(self.executable, 'w').close()
+        ValidationCache._memory.clear()
+
+    def tearDown(self):
+        ValidationCache._memory.clear()
+        shutil.rmtree(self.dir)
+
+    def key(self, **kwargs):
+        args = dict(executable=self.executable, host='fw', port='20016', user='autopkg', password='secret')
+        args.update(kwargs)
+        return ValidationCache.key_for(**args)
+
+    def test_key_covers_the_connection_and_password(self):
+        key = self.key()
+        self.assertEqual(self.key(), key)
+        for change in ({'host': 'other'}, {'port': '20017'}, {'user': 'fwadmin'}, {'password': 'changed'},
+                       {'password': ''}):
+            self.assertNotEqual(self.key(**change), key, change)
+        self.assertNotIn('secret', key)
+
+    def test_key_changes_with_the_admin_binary(self):
+        key = self.key()
+        os.utime(self.executable, (time.time() + 10, time.time() + 10))
+        self.assertNotEqual(self.key(), key)
+        self.assertIsNone(self.key(executable=os.path.join(self.dir, "missing")))
+
+    def test_put_and_get(self):
+        cache = ValidationCache(cache_dir=self.dir)
+        self.assertIsNone(cache.get(self.key()))
+        cache.put(self.key(), RESULT)
+        self.assertEqual(cache.get(self.key()), RESULT)
+        self.assertIsNone(cache.get(self.key(password='changed')))
+        self.assertIsNone(cache.get(None))
+
+    def test_kept_on_disk(self):
+        ValidationCache(cache_dir=self.dir).put(self.key(), RESULT)
+        ValidationCache._memory.clear()
+        self.assertEqual(ValidationCache(cache_dir=self.dir).get(self.key()), RESULT)
+
+    def test_expiry(self):
+        ValidationCache(ttl=0.05, cache_dir=self.dir).put(self.key(), RESULT)
+        time.sleep(0.1)
+        self.assertIsNone(ValidationCache(ttl=0.05, cache_dir=self.dir).get(self.key()))
+
+    def test_disabled(self):
+        cache = ValidationCache(ttl=0, cache_dir=self.dir)
+        cache.put(self.key(), RESULT)
+        self.assertIsNone(cache.get(self.key()))
+        self.assertFalse(os.path.exists(cache.path))
+
+
+@unittest.skipIf(FWTool is None, "autopkglib is not installed")
+class CheckClientTest(unittest.TestCase):
+
+    ENVIRONMENT = ('FILEWAVE_ADMIN_PATH', 'FILEWAVE_CACHE_DIR', 'FAKE_ADMIN_STATE', 'FAKE_ADMIN_ERROR_RATE')
+
+    def setUp(self):
+        self.saved = dict((name, os.environ.get(name)) for name in self.ENVIRONMENT)
+        self.dir = tempfile.mkdtemp()
+        os.environ['FILEWAVE_ADMIN_PATH'] = fake_admin.install(self.dir)
+        os.environ['FILEWAVE_CACHE_DIR'] = os.path.join(self.dir, "cache")
+        os.environ['FAKE_ADMIN_STATE'] = self.dir
+        os.environ['FAKE_ADMIN_ERROR_RATE'] = '0'
+        ValidationCache._memory.clear()
+        self.tool = FWTool({})
+        self.tool.relaxed_version_check = False
+
+    def tearDown(self):
+        ValidationCache._memory.clear()
+        for name, value in self.saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        shutil.rmtree(self.dir)
+
+    def check(self, password='secret'):
+        client = FWAdminClient(admin_name='autopkg', admin_pwd=password, server_host='fw')
+        result = self.tool.check_client(client)
+        return result, len(client.instrumentation.records)
+
+    def test_reused_for_the_same_password(self):
+        result, calls = self.check()
+        self.assertEqual(result, ('13.1.0', 'Yes', 'VALIDATION OK', None))
+        self.assertEqual(calls, 2)
+        self.assertEqual(self.check(), (result, 0))
+
+    def test_not_reused_for_another_password(self):
+        self.check()
+        result, calls = self.check(password='changed')
+        self.assertEqual(calls, 2)
+
+    def test_failed_validation_is_not_kept(self):
+        os.environ['FAKE_ADMIN_ERROR_RATE'] = '1'
+        self.assertRaises(Exception, self.check)
+        os.environ['FAKE_ADMIN_ERROR_RATE'] = '0'
+        result, calls = self.check()
+        self.assertEqual(calls, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+"""FilesetVersionIndex: versions per bundle id and content digests.
+
+    $ python -m pytest -q tests
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "FWTool"))
+
+from CommandLine import Fileset, FilesetVersionIndex
+
+try:
+    from FileWaveImporter import FileWaveImporter
+except ImportError:
+    # autopkglib only exists inside autopkg
+    FileWaveImporter = None
+
+
+def fileset(id, bundle_id=None, version=None, digest=None):
+    properties = {}
+    if bundle_id is not None:
+        properties[FilesetVersionIndex.BUNDLE_ID_PROPERTY] = bundle_id
+    if version is not None:
+        properties[FilesetVersionIndex.VERSION_PROPERTY] = version
+    if digest is not None:
+        properties[FilesetVersionIndex.DIGEST_PROPERTY] = digest
+    return Fileset(id=id, name='Fileset %s' % id, type='fileset', size=0, parent_id=None,
+                   custom_properties=properties)
+
+
+class FilesetVersionIndexTest(unittest.TestCase):
+
+    def test_versions_are_ordered(self):
+        index = FilesetVersionIndex([fileset(1, 'app', '1.10'), fileset(2, 'app', '1.9'), fileset(3, 'app', '1.2')])
+        self.assertEqual([fs.id for fs in index.filesets('app')], ['3', '2', '1'])
+        self.assertEqual(index.newest('app').id, '1')
+        self.assertEqual(index.is_satisfied('app', '1.5').id, '2')
+        self.assertIsNone(index.is_satisfied('app', '2.0'))
+
+    def test_filesets_without_both_properties_are_not_versioned(self):
+        index = FilesetVersionIndex([fileset(1, 'app'), fileset(2, version='1.0'), fileset(3, digest='d')])
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.bundle_ids(), [])
+        self.assertEqual(index.with_digest('d').id, '3')
+
+    def test_remove(self):
+        index = FilesetVersionIndex([fileset(1, 'app', '1.0', 'd1'), fileset(2, 'app', '2.0')])
+        index.remove(2)
+        self.assertEqual(index.newest('app').id, '1')
+        index.remove('1')
+        self.assertNotIn('app', index)
+        self.assertIsNone(index.with_digest('d1'))
+        index.remove('404')
+
+    def test_readding_replaces_the_entry(self):
+        index = FilesetVersionIndex([fileset(1, 'app', '1.0', 'd1')])
+        index.add(fileset(1, 'app', '2.0', 'd2'))
+        self.assertEqual(len(index.filesets('app')), 1)
+        self.assertIsNone(index.with_digest('d1'))
+        self.assertEqual(index.with_digest('d2').id, '1')
+
+    def test_removing_filesets_sharing_a_digest(self):
+        index = FilesetVersionIndex([fileset(1, 'app', '1.0', 'd'), fileset(2, 'app', '1.0', 'd')])
+        self.assertEqual(index.with_digest('d').id, '2')
+        index.remove('1')
+        self.assertEqual(index.with_digest('d').id, '2')
+        index.remove('2')
+        self.assertIsNone(index.with_digest('d'))
+
+    def test_removing_after_the_digest_holder_is_gone(self):
+        index = FilesetVersionIndex([fileset(1, digest='d'), fileset(2, digest='d')])
+        index.remove('2')
+        index.remove('1')
+        self.assertIsNone(index.with_digest('d'))
+
+
+class ListingClient(object):
+    """Lists a fixed set of filesets and counts the listings."""
+
+    inventory_key = 'server'
+
+    def __init__(self, filesets):
+        self.filesets = filesets
+        self.listings = 0
+
+    def get_version_index(self, use_cache=True):
+        self.listings += 1
+        return FilesetVersionIndex(self.filesets)
+
+
+@unittest.skipIf(FileWaveImporter is None, "autopkglib is not installed")
+class VersionCheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = ListingClient([fileset(1, 'com.example.app', '1.9'), fileset(2, 'com.example.app', '1.10'),
+                                     fileset(3, 'com.example.other', '5.0')])
+        # shared like the index of one run
+        self.version_indexes = {}
+
+    def satisfying(self, version, bundle_id='com.example.app'):
+        importer = FileWaveImporter({'fw_app_bundle_id': bundle_id, 'fw_app_version': version,
+                                     'FW_IMPORT_JOURNAL': False})
+        importer.version_indexes = self.version_indexes
+        return importer.satisfying_fileset(self.client)
+
+    def test_same_or_newer_version_satisfies(self):
+        self.assertEqual(self.satisfying('1.10').id, '2')
+        self.assertEqual(self.satisfying('1.9.1').id, '2')
+        self.assertEqual(self.satisfying('1.2').id, '1')
+        self.assertIsNone(self.satisfying('1.11'))
+        self.assertIsNone(self.satisfying('1.0', bundle_id='com.example.new'))
+
+    def test_listed_once_per_run(self):
+        for version in ('1.0', '2.0', '3.0'):
+            self.satisfying(version)
+        self.assertEqual(self.client.listings, 1)
+
+    def test_no_check_without_bundle_id_and_version(self):
+        self.assertIsNone(self.satisfying(None))
+        self.assertIsNone(self.satisfying('1.0', bundle_id=None))
+        self.assertEqual(self.client.listings, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()